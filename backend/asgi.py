@@ -0,0 +1,388 @@
+"""
+Async serving mode.
+
+    gunicorn -b :$PORT -k uvicorn.workers.UvicornWorker asgi:app
+
+The scan, batch scan, submit, submission status and submission events
+handlers run on the event loop. Scans call uris:search through a shared
+httpx.AsyncClient, so a worker keeps hundreds of upstream calls in flight
+instead of one (or one per thread). Long-polls and event streams await the
+operation poller (OperationPoller.wait_async) and hold no thread, so they
+need none of the caps main.py puts on them. The rest of the logic is shared
+with main.py: the scan result cache (with coalescing), the local threat
+lists, the submission queue and the operation poller. The few calls into
+those that can block (threat list lookups, SQLite writes) run in a thread
+pool. Handlers are timed under the same names as the Flask views, so
+/api/metrics reads the same in either mode.
+
+Every other route is passed to the Flask app through asgiref's WSGI adapter,
+so all existing routes and response shapes keep working. asgiref runs every
+WSGI request on one shared thread; here they run on a pool of
+ASYNC_FLASK_THREADS threads instead, so a slow request does not hold up the
+health checks behind it.
+"""
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgiInstance
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from urllib.parse import parse_qs
+from utils import format_url
+import asyncio
+import clients
+import contextvars
+import json
+import logging
+import metrics
+import oppoller
+import os
+import time
+import httpx
+import main
+import requests
+import scanner
+import threatlists
+import urlcanon
+
+logger = logging.getLogger(__name__)
+
+POOL_SIZE = int(os.getenv('ASYNC_POOL_SIZE', '500'))
+# Threads for the routes served by the Flask app, as many as app.yaml gives gthread
+FLASK_THREADS = int(os.getenv('ASYNC_FLASK_THREADS', '16'))
+MAX_BODY_SIZE = 1024 * 1024
+
+_flask_threads = ThreadPoolExecutor(max_workers=FLASK_THREADS, thread_name_prefix='async-flask')
+_client = None
+
+
+def client():
+    """The event loop's pooled HTTP client for Web Risk."""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE),
+            timeout=clients.REQUEST_TIMEOUT,
+        )
+    return _client
+
+
+# --- Handlers ---
+
+async def scan_url(data):
+    """The async counterpart of main.scan_url; returns (body, status)."""
+    raw_url = data.get('url')
+    if not raw_url:
+        logger.error("No URL provided in request")
+        return {'error': 'URL is required'}, 400
+
+    with metrics.stage('format'):
+        formatted_url = format_url(raw_url)
+    api_key = os.getenv('WEBRISK_API_KEY')
+    if not api_key:
+        logger.error("Missing WEBRISK_API_KEY environment variable")
+        return {'error': 'Server configuration error: API key missing'}, 500
+
+    try:
+        response_data = await scanner.result_cache.get_or_load_async(
+            urlcanon.lookup_key(formatted_url), lambda: _lookup_uncached(formatted_url, api_key))
+    except (httpx.HTTPStatusError, requests.exceptions.HTTPError) as http_err:
+        error_details = http_err.response.text
+        logger.error(f"HTTP error calling Web Risk API: {str(http_err)} - Details: {error_details}")
+        return {'error': f"Web Risk API request failed: {http_err.response.status_code}",
+                'details': error_details}, 502
+    except (httpx.RequestError, requests.exceptions.RequestException) as e:
+        logger.error(f"Network error calling Web Risk API: {str(e)}")
+        return {'error': f"Could not connect to Web Risk API: {str(e)}"}, 504
+    except Exception as e:
+        logger.error(f"Unexpected error in scan_url: {str(e)}", exc_info=True)
+        return {'error': "Internal server error"}, 500
+
+    found_threat = response_data.get('threat') or {}
+    logger.info("Scanned URL", extra={'url': formatted_url, 'threat_types': found_threat.get('threatTypes', [])})
+    return {'scores': scanner.build_scores(response_data)}, 200
+
+
+async def _lookup_uncached(formatted_url, api_key):
+    database = threatlists.get_database(api_key)
+    if database is not None and database.ready:
+        # Local and usually instant, but a prefix match makes a (blocking) hashes:search call
+        with metrics.stage('local'):
+            response_data = await _in_thread(None, database.lookup, formatted_url, api_key)
+    else:
+        with metrics.stage('upstream'):
+            response = await client().get(scanner.search_uri_url(formatted_url),
+                                          headers=clients.api_key_headers(api_key))
+        response.raise_for_status()
+        with metrics.stage('parse'):
+            response_data = response.json() if response.content else {}
+    return response_data, scanner.cache_expiry(response_data)
+
+
+async def scan_batch(scope, receive, send):
+    """The async counterpart of main.scan_batch; streamed results are sent as they complete."""
+    data = await _read_json(scope, receive, send)
+    if data is None:
+        return
+    batch, error = main.batch_scan_request(data)
+    if error is not None:
+        return await _respond(scope, send, *error)
+    formatted_urls, concurrency, api_key = batch
+
+    query = parse_qs(scope['query_string'].decode('latin-1'))
+    accept = dict(scope['headers']).get(b'accept', b'').decode('latin-1')
+    if not main.batch_streamed(query.get('stream', [''])[0], accept):
+        by_url = {}
+        async for formatted_url, response_data, error in _lookup_many(formatted_urls, api_key, concurrency):
+            by_url[formatted_url] = _batch_result(formatted_url, response_data, error)
+        return await _respond(scope, send, {'results': [by_url[u] for u in formatted_urls]}, 200)
+
+    await _start(scope, send, 200, b'application/x-ndjson')
+    results = _lookup_many(formatted_urls, api_key, concurrency)
+    async with _watching_disconnect(receive) as disconnected:
+        try:
+            async for formatted_url, response_data, error in results:
+                if disconnected.is_set():
+                    return
+                line = json.dumps(_batch_result(formatted_url, response_data, error)) + '\n'
+                await send({'type': 'http.response.body', 'body': line.encode('utf-8'), 'more_body': True})
+        finally:
+            await results.aclose()
+    await send({'type': 'http.response.body'})
+
+
+async def _lookup_many(formatted_urls, api_key, concurrency):
+    """The async counterpart of scanner.lookup_many: yields (formatted_url, response_data, error) as they complete."""
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def lookup(formatted_url):
+        async with semaphore:
+            try:
+                return formatted_url, await scanner.result_cache.get_or_load_async(
+                    urlcanon.lookup_key(formatted_url), lambda: _lookup_uncached(formatted_url, api_key)), None
+            except Exception as e:
+                return formatted_url, None, e
+
+    tasks = [asyncio.ensure_future(lookup(u)) for u in formatted_urls]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # Stops queued lookups early if the client goes away mid-batch
+        for task in tasks:
+            task.cancel()
+
+
+def _batch_result(formatted_url, response_data, error):
+    if isinstance(error, httpx.HTTPStatusError):
+        return {'url': formatted_url, 'error': f"Web Risk API request failed: {error.response.status_code}",
+                'status': 502}
+    if isinstance(error, httpx.RequestError):
+        return {'url': formatted_url, 'error': f"Could not connect to Web Risk API: {str(error)}", 'status': 504}
+    return main.batch_result(formatted_url, response_data, error)
+
+
+async def submit_url(data):
+    # A SQLite write that can wait on the database lock, or uris:submit itself when the queue is off
+    return await _in_thread(None, main.queue_submission, data)
+
+
+async def check_submission_status(scope, receive, send):
+    """The async counterpart of main.check_submission_status."""
+    query = parse_qs(scope['query_string'].decode('latin-1'))
+    try:
+        wait = min(float(query.get('wait', ['0'])[0]), main.LONG_POLL_MAX_WAIT)
+        version = int(query.get('version', ['0'])[0])
+    except ValueError:
+        return await _respond(scope, send, {'error': 'wait and version must be numbers'}, 400)
+
+    operation = scope['path'][len('/api/submission/'):].rsplit('/', 1)[-1]
+    poller = oppoller.get_poller()
+    with metrics.stage('wait'):
+        if wait > 0 and version > 0:
+            changed = await poller.wait_async({operation: version}, wait)
+        else:
+            changed = await poller.wait_async({operation: 0}, main.OPERATION_FIRST_POLL_WAIT)
+        snapshot = changed[0] if changed else poller.snapshot(operation)
+    await _respond(scope, send, *main.status_response(snapshot))
+
+
+async def submission_events(scope, receive, send):
+    """
+    The async counterpart of main.submission_events.
+
+    Streams still end after main.SSE_MAX_STREAM_SECONDS (EventSource
+    reconnects and resumes), but are never turned away as busy.
+    """
+    query = parse_qs(scope['query_string'].decode('latin-1'))
+    operations = main.sse_operations(query.get('operations', [''])[0])
+    if not operations:
+        return await _respond(scope, send, {'error': 'At least one operation is required'}, 400)
+    if len(operations) > main.SSE_MAX_OPERATIONS:
+        return await _respond(scope, send, {
+            'error': f"At most {main.SSE_MAX_OPERATIONS} operations can be watched per stream"}, 400)
+
+    poller = oppoller.get_poller()
+    last_event_id = dict(scope['headers']).get(b'last-event-id', b'').decode('latin-1')
+    versions, sent = main.sse_resume(operations, last_event_id, poller)
+    await _start(scope, send, 200, b'text/event-stream', [(b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')])
+
+    async def event(text):
+        await send({'type': 'http.response.body', 'body': text.encode('utf-8'), 'more_body': True})
+
+    await event(f"retry: {main.SSE_RETRY_MS}\n\n")
+    deadline = time.monotonic() + main.SSE_MAX_STREAM_SECONDS
+    async with _watching_disconnect(receive) as disconnected:
+        while versions and not disconnected.is_set():
+            remaining = deadline - time.monotonic()
+            changed = await poller.wait_async(versions, min(main.SSE_HEARTBEAT_INTERVAL, max(0, remaining)))
+            for snapshot in changed:
+                await event(main.sse_status_event(snapshot, versions, sent))
+            if not changed:
+                if remaining <= 0:
+                    break
+                await event(': keep-alive\n\n')
+    if not versions:
+        await event('event: end\ndata: {}\n\n')
+    await send({'type': 'http.response.body'})
+
+
+def _in_thread(executor, fn, *args):
+    """Runs fn on executor in a copy of this task's context, so its stages count against this handler."""
+    return asyncio.get_running_loop().run_in_executor(executor, contextvars.copy_context().run, fn, *args)
+
+
+# --- ASGI plumbing ---
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] == 'http':
+        method, path = scope['method'], scope['path']
+        if method == 'POST' and path == '/api/scan':
+            return await _timed('scan_url', _json_route, scope, receive, send, scan_url)
+        if method == 'POST' and path == '/api/scan/batch':
+            return await _timed('scan_batch', scan_batch, scope, receive, send)
+        if method == 'POST' and path == '/api/submit':
+            return await _timed('submit_url', _json_route, scope, receive, send, submit_url)
+        if method == 'GET' and path.startswith('/api/submission/') and len(path) > len('/api/submission/'):
+            return await _timed('check_submission_status', check_submission_status, scope, receive, send)
+        if method == 'GET' and path == '/api/submissions/events':
+            return await _timed('submission_events', submission_events, scope, receive, send)
+    await flask_app(scope, receive, send)
+
+
+class _WsgiInstance(WsgiToAsgiInstance):
+    # asgiref runs this with thread_sensitive=True: every request on one shared thread
+    run_wsgi_app = sync_to_async(WsgiToAsgiInstance.run_wsgi_app.__wrapped__, thread_sensitive=False,
+                                 executor=_flask_threads)
+
+
+async def flask_app(scope, receive, send):
+    """The Flask app (main.app) as an ASGI app, each request on a thread of _flask_threads."""
+    await _WsgiInstance(main.app)(scope, receive, send)
+
+
+async def _timed(handler, route, scope, receive, send, *args):
+    """
+    Runs route with its stages attributed to handler. Its duration, up to the
+    start of the response as Flask's after_request measures it, is recorded
+    under the status it sent (499 if the client left before a response).
+    """
+    started = time.perf_counter()
+    status = None
+
+    async def timed_send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+            metrics.observe_request(handler, status, time.perf_counter() - started)
+        await send(message)
+
+    with metrics.handling(handler):
+        await route(scope, receive, timed_send, *args)
+    if status is None:
+        metrics.observe_request(handler, 499, time.perf_counter() - started)
+
+
+async def _json_route(scope, receive, send, handler):
+    data = await _read_json(scope, receive, send)
+    if data is not None:
+        await _respond(scope, send, *await handler(data))
+
+
+async def _read_json(scope, receive, send):
+    """Returns the request body's JSON object; answers the request and returns None if there is none."""
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None  # Client closed the request
+        chunks.append(message.get('body', b''))
+        size += len(chunks[-1])
+        if size > MAX_BODY_SIZE:
+            await _respond(scope, send, {'error': 'Request body too large'}, 413)
+            return None
+        if not message.get('more_body'):
+            break
+    try:
+        data = json.loads(b''.join(chunks))
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        await _respond(scope, send, {'error': 'Request body must be a JSON object'}, 400)
+        return None
+    return data
+
+
+@asynccontextmanager
+async def _watching_disconnect(receive):
+    """Yields an event that is set once the client goes away (for streamed responses, after reading the body)."""
+    disconnected = asyncio.Event()
+
+    async def watch():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+
+    watcher = asyncio.ensure_future(watch())
+    try:
+        yield disconnected
+    finally:
+        watcher.cancel()
+
+
+def _cors_headers(scope):
+    # Same CORS behaviour as flask_cors gives the Flask routes
+    origin = dict(scope['headers']).get(b'origin')
+    if origin == main.CORS_ORIGIN.encode():
+        return [(b'access-control-allow-origin', origin), (b'vary', b'Origin')]
+    return []
+
+
+async def _start(scope, send, status, content_type, headers=()):
+    """Starts a streamed response; the caller sends the body."""
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type), *headers, *_cors_headers(scope)]})
+
+
+async def _respond(scope, send, body, status):
+    """Sends body as the JSON response."""
+    with metrics.stage('serialize'):
+        payload = (json.dumps(body) + '\n').encode('utf-8')
+    headers = [(b'content-type', b'application/json'), (b'content-length', str(len(payload)).encode())]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers + _cors_headers(scope)})
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+async def _lifespan(receive, send):
+    global _client
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _client is not None:
+                await _client.aclose()
+                _client = None
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
@@ -0,0 +1,416 @@
+"""
+Offline benchmarks for the backend's hot paths.
+
+    python bench.py ctparse [--fixture PATH] [--rounds N]
+    python bench.py ctparse --capture LOG_URL [--count N] [--fixture PATH]
+    python bench.py canonicalize [--rounds N]
+    python bench.py load [--scenario scan|submit|status|health|ct] [--requests N] [--concurrency N] ...
+
+ctparse compares the certificate parser in ctparse.py with the regex
+extraction the CT scanner used to run over the decoded leaf bytes. Use
+--capture to refresh the fixture with the newest entries of a live log.
+
+canonicalize measures canonicalization and hashing throughput with and
+without the memo caches (conformance with the Web Risk docs is checked in
+test_urlcanon.py).
+
+load starts the stub Web Risk API (or, for the ct scenario, the stub CT
+log) from stubserver.py and the backend itself as it runs on App Engine,
+then drives one endpoint with concurrent requests and reports throughput,
+p50/p99 latency and the backend's own per-stage timings from /api/metrics
+(with --target, set METRICS_TOKEN to the backend's token to see those).
+The health scenario hits a route the Flask app serves in either --server
+mode; with --streams N, N submission event streams stay open during the
+run, as open browser tabs keep them. No network access is needed.
+--max-p99 and --min-throughput make it exit non-zero on a regression;
+--target load-tests a backend that is already running instead.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from ctfetch import CTFetcher
+import argparse
+import base64
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import ctlogs
+import ctparse
+import metrics
+import requests
+import urlcanon
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def _load_jsonl(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _measure(fn, items, rounds):
+    """Runs fn over every item `rounds` times; returns (items per second, last results)."""
+    started = time.perf_counter()
+    for _ in range(rounds):
+        results = [fn(item) for item in items]
+    elapsed = time.perf_counter() - started
+    return len(items) * rounds / elapsed, results
+
+
+# --- ctparse ---
+
+def _regex_domains(entry):
+    """The extraction ctlogs.py used before ctparse: regexes over the decoded bytes."""
+    cert_bytes = base64.b64decode(entry['leaf_input'])
+    common_names = re.findall(r"CN=([^,\n]+)", cert_bytes.decode('utf-8', errors='ignore'))
+    san_names = re.findall(r"DNS:([^,\n]+)", cert_bytes.decode('utf-8', errors='ignore'))
+    return set(common_names + san_names)
+
+
+def bench_ctparse(args):
+    if args.capture:
+        fetcher = CTFetcher(max_workers=4, per_log_concurrency=4)
+        end = fetcher.get_tree_size(args.capture) - 1
+        with open(args.fixture, 'w') as f:
+            for batch in fetcher.fetch([args.capture], start=max(0, end - args.count + 1), end=end):
+                for entry in batch.entries:
+                    f.write(json.dumps({'leaf_input': entry['leaf_input'], 'extra_data': ''}) + '\n')
+        print(f"Captured entries from {args.capture} into {args.fixture}")
+        return
+
+    entries = _load_jsonl(args.fixture)
+    print(f"{len(entries)} leaf entries from {args.fixture}, {args.rounds} rounds")
+    for label, fn in (('regex', _regex_domains), ('ctparse', ctparse.extract_domains)):
+        rate, results = _measure(fn, entries, args.rounds)
+        found = sum(len(domains) for domains in results)
+        print(f"  {label:8} {rate:12,.0f} entries/s  {found:6} domains found")
+
+
+
+# --- canonicalize ---
+
+def bench_canonicalize(args):
+    # Scan-like input: a few thousand hosts with varied paths, queries and spellings, every URL distinct
+    urls = [f"{'HTTPS' if i % 3 else 'http'}://www.Site{i % 2000}.example.com/a/./b/../p{i}%2Fx?q={i}#frag"
+            for i in range(20000)]
+    print(f"{len(urls)} URLs, {args.rounds} rounds")
+
+    def clear_caches():
+        for memoized in (urlcanon.canonicalize, urlcanon.lookup_expressions, urlcanon.lookup_hashes):
+            memoized.cache_clear()
+
+    rate, _ = _measure(urlcanon.canonicalize.__wrapped__, urls, args.rounds)
+    print(f"  {'canonicalize, uncached':34} {rate:12,.0f} URLs/s")
+
+    # Cold caches each round, and no URL repeats within one, so every step runs exactly once per URL
+    for label, fn in (('lookup_hashes, cold', lambda: [urlcanon.lookup_hashes(url) for url in urls]),
+                      ('lookup_hashes_many, cold', lambda: urlcanon.lookup_hashes_many(urls))):
+        elapsed = 0.0
+        for _ in range(args.rounds):
+            clear_caches()
+            started = time.perf_counter()
+            fn()
+            elapsed += time.perf_counter() - started
+        print(f"  {label:34} {len(urls) * args.rounds / elapsed:12,.0f} URLs/s")
+
+    rate, _ = _measure(urlcanon.lookup_hashes, urls, args.rounds)
+    print(f"  {'lookup_hashes, memoized':34} {rate:12,.0f} URLs/s")
+
+
+# --- load ---
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_COMMANDS = {
+    # As app.yaml runs it
+    'gthread': ['-m', 'gunicorn', '-b', '127.0.0.1:{port}', '--worker-class', 'gthread', '--threads', '16',
+                'main:app'],
+    'async': ['-m', 'uvicorn', 'asgi:app', '--port', '{port}', '--log-level', 'warning'],
+}
+STARTUP_TIMEOUT = 30
+BENCH_METRICS_TOKEN = 'bench'
+_STAGE_BUCKET = re.compile(r'^webrisk_stage_duration_seconds_bucket\{handler="([^"]*)",stage="([^"]*)",'
+                           r'le="([^"]*)"\} (\d+)$', re.MULTILINE)
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _start_stub(args, log):
+    """Starts stubserver.py on a free port; returns (process, root URL)."""
+    command = [sys.executable, 'stubserver.py', '--port', '0', '--latency', str(args.latency)]
+    if args.scenario == 'ct':
+        command += ['--ct', '--tree-size', str(args.requests)]
+    process = subprocess.Popen(command, cwd=BACKEND_DIR, stdout=subprocess.PIPE, stderr=log, text=True)
+    banner = process.stdout.readline()  # "... listening on <root URL>"
+    if not banner:
+        raise RuntimeError("The stub server did not start")
+    return process, banner.split()[-1]
+
+
+def _start_backend(args, stub_root, workdir, log):
+    """Starts the backend against the stub on a free port; returns (process, base URL)."""
+    port = _free_port()
+    env = dict(os.environ,
+               WEBRISK_API_ROOT=stub_root,
+               WEBRISK_API_KEY='stub',
+               GOOGLE_CLOUD_PROJECT_NUMBER='0',  # Submissions queue fine; dispatching them fails without credentials
+               THREATLIST_ENABLED='true' if args.threatlists else 'false',
+               THREATLIST_DIR=os.path.join(workdir, 'threatlists'),
+               SUBMIT_QUEUE_PATH=os.path.join(workdir, 'submissions.sqlite3'),
+               CT_INDEX_PATH=os.path.join(workdir, 'ct_index.sqlite3'),
+               METRICS_TOKEN=BENCH_METRICS_TOKEN)
+    command = [sys.executable] + [part.format(port=port) for part in BACKEND_COMMANDS[args.server]]
+    process = subprocess.Popen(command, cwd=BACKEND_DIR, env=env, stdout=log, stderr=log)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            if requests.get(f"{base_url}/_ah/health", timeout=1).ok:
+                return process, base_url
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"The backend did not start; see {log.name}")
+
+
+def _percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def _histogram_quantile(buckets, q):
+    """Estimates a quantile from cumulative (upper bound, count) buckets, as Prometheus does."""
+    total = buckets[-1][1]
+    if not total:
+        return 0.0
+    rank = q * total
+    lower, below = 0.0, 0
+    for bound, cumulative in buckets:
+        if cumulative >= rank:
+            if bound == float('inf'):
+                return lower
+            return lower + (bound - lower) * (rank - below) / max(1, cumulative - below)
+        lower, below = bound, cumulative
+    return lower
+
+
+def _print_stages(text):
+    """Prints count, p50 and p99 of every stage in a /api/metrics page."""
+    stages = {}
+    for handler, stage, bound, count in _STAGE_BUCKET.findall(text):
+        stages.setdefault((handler, stage), []).append((float(bound), int(count)))
+    if not stages:
+        return
+    print("  Backend stages (estimated from histogram buckets):")
+    for (handler, stage), buckets in sorted(stages.items()):
+        print(f"    {handler:24} {stage:18} {buckets[-1][1]:8} calls  p50 {_histogram_quantile(buckets, 0.5) * 1000:9.2f} ms"
+              f"  p99 {_histogram_quantile(buckets, 0.99) * 1000:9.2f} ms")
+
+
+def _scenario_requests(args, base_url):
+    """Returns a function making the i-th request of the scenario with a session; it returns the status code."""
+    def scan(session, i):
+        return session.post(f"{base_url}/api/scan", json={'url': f"https://site{i % args.distinct}.bench.example/p"},
+                            timeout=60).status_code
+
+    def submit(session, i):
+        return session.post(f"{base_url}/api/submit", json={
+            'url': f"https://site{i % args.distinct}.bench.example/login",
+            'evidence': 'Load test', 'abuseType': 'SOCIAL_ENGINEERING',
+        }, timeout=60).status_code
+
+    def health(session, i):
+        return session.get(f"{base_url}/_ah/health", timeout=60).status_code
+
+    if args.scenario == 'scan':
+        return scan
+    if args.scenario == 'submit':
+        return submit
+    if args.scenario == 'health':
+        return health
+
+    # status: poll the jobs of a few submissions, as open browser tabs do
+    with requests.Session() as session:
+        operations = [session.post(f"{base_url}/api/submit", json={
+            'url': f"https://site{i}.bench.example/login", 'evidence': 'Load test', 'abuseType': 'MALWARE',
+        }, timeout=60).json()['operation'] for i in range(min(args.distinct, 100))]
+
+    def status(session, i):
+        return session.get(f"{base_url}/api/submission/{operations[i % len(operations)]}", timeout=60).status_code
+    return status
+
+
+def _open_streams(base_url, count):
+    """Holds count submission event streams open in the background, reconnecting as EventSource does."""
+    opened = threading.Semaphore(0)
+
+    def hold(i):
+        # Operations the backend cannot read stay pending, so their streams only end at the backend's time limit
+        params = {'operations': f"bench-stream-{i}"}
+        retry = 1.0
+        while True:
+            try:
+                with requests.get(f"{base_url}/api/submissions/events", params=params, stream=True,
+                                  timeout=60) as response:
+                    opened.release()
+                    for line in response.iter_lines():
+                        if line.startswith(b'retry:'):
+                            retry = int(line.split(b':')[1]) / 1000
+            except requests.exceptions.RequestException:
+                pass
+            time.sleep(retry)
+
+    for i in range(count):
+        threading.Thread(target=hold, args=(i,), daemon=True).start()
+    for _ in range(count):
+        if not opened.acquire(timeout=STARTUP_TIMEOUT):
+            raise RuntimeError("Could not open the submission event streams")
+
+
+def _drive(request, count, concurrency):
+    """Makes count requests, concurrency at a time; returns (latencies in seconds, statuses, elapsed seconds)."""
+    local = threading.local()
+    latencies, statuses = [0.0] * count, [None] * count
+
+    def one(i):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        started = time.perf_counter()
+        try:
+            statuses[i] = request(session, i)
+        except requests.exceptions.RequestException as e:
+            statuses[i] = type(e).__name__
+        latencies[i] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(count)))
+    return latencies, statuses, time.perf_counter() - started
+
+
+def _report(label, count, unit, elapsed, latencies, failures):
+    latencies = sorted(latencies)
+    throughput = count / elapsed
+    p99 = _percentile(latencies, 0.99) * 1000 if latencies else 0.0
+    print(f"{label}: {count} {unit} in {elapsed:.2f}s = {throughput:,.1f} {unit}/s")
+    if latencies:
+        print(f"  latency ms: p50 {_percentile(latencies, 0.5) * 1000:.2f}  p90 {_percentile(latencies, 0.9) * 1000:.2f}"
+              f"  p99 {p99:.2f}  max {latencies[-1] * 1000:.2f}")
+    if failures:
+        print(f"  failures: {failures}")
+    return throughput, p99
+
+
+def _load_ct(args, log_url):
+    """Scans the stub CT log in-process; returns (throughput, p99 of get-entries calls in ms)."""
+    metrics.reset()
+    stats = {}
+    started = time.perf_counter()
+    hits = sum(1 for _ in ctlogs.iter_ct_log_hits(['examplecorp', 'google'], [f"{log_url}/get-entries"],
+                                                  start_index=0, end_index=args.requests - 1,
+                                                  max_workers=args.concurrency, stats=stats))
+    elapsed = time.perf_counter() - started
+    failed = {f"{f.start}-{f.end}": f.error for f in stats.get('failed_ranges', [])}
+    throughput, _ = _report('ct', args.requests, 'entries', elapsed, [], failed)
+    print(f"  {hits} brand hits, {stats.get('unparsed_entries', 0)} unparsed entries")
+    text = metrics.render()
+    _print_stages(text)
+    upstream = [(float(bound), int(count)) for handler, stage, bound, count in _STAGE_BUCKET.findall(text)
+                if stage == 'upstream']
+    return throughput, _histogram_quantile(upstream, 0.99) * 1000 if upstream else 0.0
+
+
+def bench_load(args):
+    args.distinct = args.distinct or args.requests
+    processes = []
+    with tempfile.TemporaryDirectory(prefix='webrisk-bench-') as workdir, \
+            open(os.path.join(workdir, 'servers.log'), 'w') as log:
+        try:
+            if args.scenario == 'ct':
+                stub, log_url = _start_stub(args, log)
+                processes.append(stub)
+                throughput, p99 = _load_ct(args, log_url)
+            else:
+                base_url = args.target
+                if base_url is None:
+                    stub, stub_root = _start_stub(args, log)
+                    processes.append(stub)
+                    backend, base_url = _start_backend(args, stub_root, workdir, log)
+                    processes.append(backend)
+                request = _scenario_requests(args, base_url)
+                _open_streams(base_url, args.streams)
+                if args.warmup:
+                    _drive(request, args.warmup, args.concurrency)
+                latencies, statuses, elapsed = _drive(request, args.requests, args.concurrency)
+                failures = {}
+                for status in statuses:
+                    if not isinstance(status, int) or status >= 400:
+                        failures[status] = failures.get(status, 0) + 1
+                throughput, p99 = _report(args.scenario, args.requests, 'requests', elapsed, latencies, failures)
+                _print_stages(requests.get(f"{base_url}/api/metrics", timeout=10, headers={
+                    'Authorization': f"Bearer {os.getenv('METRICS_TOKEN', BENCH_METRICS_TOKEN)}"}).text)
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+    regressions = []
+    if args.max_p99 is not None and p99 > args.max_p99:
+        regressions.append(f"p99 {p99:.2f} ms is over {args.max_p99} ms")
+    if args.min_throughput is not None and throughput < args.min_throughput:
+        regressions.append(f"throughput {throughput:,.1f}/s is under {args.min_throughput}/s")
+    for regression in regressions:
+        print(f"  REGRESSION: {regression}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ctparse_parser = subparsers.add_parser('ctparse', help='CT leaf parsing throughput')
+    ctparse_parser.add_argument('--fixture', default=os.path.join(FIXTURE_DIR, 'ct_entries.jsonl'))
+    ctparse_parser.add_argument('--rounds', type=int, default=200)
+    ctparse_parser.add_argument('--capture', metavar='LOG_URL', help='record live entries into the fixture instead')
+    ctparse_parser.add_argument('--count', type=int, default=64)
+    ctparse_parser.set_defaults(func=bench_ctparse)
+
+    canonicalize_parser = subparsers.add_parser('canonicalize', help='URL canonicalization throughput')
+    canonicalize_parser.add_argument('--rounds', type=int, default=3)
+    canonicalize_parser.set_defaults(func=bench_canonicalize)
+
+    load_parser = subparsers.add_parser('load', help='Throughput and latency of the backend against local stubs')
+    load_parser.add_argument('--scenario', choices=('scan', 'submit', 'status', 'health', 'ct'), default='scan')
+    load_parser.add_argument('--requests', type=int, default=2000,
+                             help='requests to make (for ct, log entries to scan)')
+    load_parser.add_argument('--concurrency', type=int, default=32)
+    load_parser.add_argument('--distinct', type=int,
+                             help='distinct URLs to cycle through (default: one per request, so scans all miss '
+                                  'the cache)')
+    load_parser.add_argument('--latency', type=float, default=0.02, help='seconds the stubs wait before answering')
+    load_parser.add_argument('--streams', type=int, default=0,
+                             help='submission event streams to hold open during the run')
+    load_parser.add_argument('--warmup', type=int, default=0, help='requests to make before measuring')
+    load_parser.add_argument('--server', choices=sorted(BACKEND_COMMANDS), default='gthread',
+                             help='serve the backend as app.yaml does (gthread) or in async mode (asgi.py)')
+    load_parser.add_argument('--threatlists', action='store_true',
+                             help='answer scans from the local threat lists instead of uris:search')
+    load_parser.add_argument('--target', metavar='URL', help='load-test a backend that is already running')
+    load_parser.add_argument('--max-p99', type=float, metavar='MS', help='exit 1 if p99 latency is higher')
+    load_parser.add_argument('--min-throughput', type=float, metavar='PER_SECOND',
+                             help='exit 1 if throughput is lower')
+    load_parser.set_defaults(func=bench_load)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,235 @@
+"""
+Matches domains against many brands, and lookalikes of them, in one pass.
+
+Every brand is expanded into variants (the brand itself, common typos, and
+homoglyph substitutions), and all variants of all brands are compiled into
+a single Aho-Corasick automaton. Matching a domain is then one linear walk
+over its characters regardless of how many brands are tracked.
+
+Domains are also matched after folding lookalikes back to plain letters:
+internationalised (xn--) labels are decoded and Cyrillic/Greek/accented
+characters folded to ASCII ('idna-homoglyph'), and ASCII lookalikes such as
+0/o, 1/l and rn/m are folded too ('homoglyph'). That catches lookalikes with
+several substitutions, which single-edit variants alone would miss.
+
+The brand and its homoglyph variants match anywhere in a domain
+(examplecorp-login.net). Typo variants only match whole labels or
+hyphen-separated tokens (gooogle.com, login-gooogle.com). As raw substrings
+they turn up inside ordinary words: a repetition of "chase" is part of
+"purchasse".
+"""
+from collections import deque, namedtuple
+import unicodedata
+
+# A brand hit: which brand, which variant string matched, and the rule that produced it.
+Match = namedtuple('Match', ['brand', 'variant', 'rule', 'domain'])
+
+EXACT = 'exact'
+OMISSION = 'omission'
+REPETITION = 'repetition'
+TRANSPOSITION = 'transposition'
+REPLACEMENT = 'replacement'
+INSERTION = 'insertion'
+HOMOGLYPH = 'homoglyph'
+IDNA_HOMOGLYPH = 'idna-homoglyph'
+
+# Rules in order of preference when two rules produce the same variant.
+_RULE_ORDER = [EXACT, IDNA_HOMOGLYPH, HOMOGLYPH, TRANSPOSITION, OMISSION, REPETITION, REPLACEMENT, INSERTION]
+# Single-edit typo rules, whose variants must make up a whole token of the domain
+_TYPO_RULES = {TRANSPOSITION, OMISSION, REPETITION, REPLACEMENT, INSERTION}
+_TOKEN_SEPARATORS = '.-'
+
+# Neighbouring keys on a QWERTY keyboard, for fat-finger replacements/insertions.
+_KEYBOARD = {
+    'q': 'wa', 'w': 'qeas', 'e': 'wrsd', 'r': 'etdf', 't': 'ryfg', 'y': 'tugh', 'u': 'yihj',
+    'i': 'uojk', 'o': 'ipkl', 'p': 'ol', 'a': 'qwsz', 's': 'weadzx', 'd': 'ersfxc',
+    'f': 'rtdgcv', 'g': 'tyfhvb', 'h': 'yugjbn', 'j': 'uihknm', 'k': 'iojlm', 'l': 'opk',
+    'z': 'asx', 'x': 'zsdc', 'c': 'xdfv', 'v': 'cfgb', 'b': 'vghn', 'n': 'bhjm', 'm': 'njk',
+    '1': '2q', '2': '13qw', '3': '24we', '4': '35er', '5': '46rt', '6': '57ty', '7': '68yu',
+    '8': '79ui', '9': '80io', '0': '9op',
+}
+
+# ASCII lookalikes a brand's characters are commonly swapped for.
+_ASCII_HOMOGLYPHS = {
+    'a': ['4'], 'b': ['8'], 'e': ['3'], 'g': ['9', 'q'], 'i': ['1', 'l'], 'l': ['1', 'i'],
+    'm': ['rn', 'nn'], 'o': ['0'], 's': ['5'], 't': ['7'], 'u': ['v'], 'w': ['vv'], 'z': ['2'],
+}
+
+# Non-ASCII characters folded to the ASCII letter they imitate before matching.
+# NFKD handles accented Latin letters; this covers the common cross-script confusables.
+_CONFUSABLES = str.maketrans({
+    'а': 'a', 'в': 'b', 'е': 'e', 'к': 'k', 'м': 'm', 'н': 'h', 'о': 'o', 'р': 'p', 'с': 'c',
+    'т': 't', 'у': 'y', 'х': 'x', 'ѕ': 's', 'і': 'i', 'ј': 'j', 'ԁ': 'd', 'ԛ': 'q', 'ԝ': 'w',
+    'ɡ': 'g', 'ı': 'i', 'ł': 'l', 'ο': 'o', 'α': 'a', 'ν': 'v', 'τ': 't', 'ρ': 'p', 'κ': 'k',
+    'ι': 'i', 'υ': 'u', 'ε': 'e', 'ß': 'b', 'ӏ': 'l', 'һ': 'h', 'ү': 'y', 'ց': 'g', 'օ': 'o',
+})
+
+# ASCII lookalikes folded back to the letter they imitate (the reverse of _ASCII_HOMOGLYPHS).
+_ASCII_FOLD = str.maketrans({'0': 'o', '1': 'l', '3': 'e', '4': 'a', '5': 's', '7': 't', '8': 'b', '$': 's', '@': 'a'})
+_ASCII_FOLD_PAIRS = [('rn', 'm'), ('vv', 'w')]
+
+MIN_VARIANT_LENGTH = 4
+
+
+def brand_variants(brand):
+    """
+    Returns {variant: rule} for a brand.
+
+    Variants shorter than MIN_VARIANT_LENGTH are dropped (except the brand
+    itself), since they would match far too many unrelated domains. So are
+    variants contained in the brand itself, such as the omissions "appl" and
+    "pple" of "apple": they are ordinary word fragments ("applications"),
+    and the brand itself matches wherever they would.
+    """
+    brand = brand.lower()
+    generated = {EXACT: {brand}}
+
+    generated[OMISSION] = {brand[:i] + brand[i + 1:] for i in range(len(brand))}
+    generated[REPETITION] = {brand[:i] + c + brand[i:] for i, c in enumerate(brand)}
+    generated[TRANSPOSITION] = {
+        brand[:i] + brand[i + 1] + brand[i] + brand[i + 2:]
+        for i in range(len(brand) - 1) if brand[i] != brand[i + 1]
+    }
+    generated[REPLACEMENT] = {
+        brand[:i] + k + brand[i + 1:] for i, c in enumerate(brand) for k in _KEYBOARD.get(c, '')
+    }
+    generated[INSERTION] = {
+        brand[:i] + k + brand[i:] for i, c in enumerate(brand) for k in _KEYBOARD.get(c, '')
+    }
+    homoglyphs = set()
+    for i, c in enumerate(brand):
+        for glyph in _ASCII_HOMOGLYPHS.get(c, []):
+            homoglyphs.add(brand[:i] + glyph + brand[i + 1:])
+    generated[HOMOGLYPH] = homoglyphs
+
+    variants = {}
+    for rule in _RULE_ORDER:
+        for variant in generated.get(rule, ()):
+            if variant not in variants and (variant == brand or (variant not in brand
+                                                                and len(variant) >= MIN_VARIANT_LENGTH)):
+                variants[variant] = rule
+    return variants
+
+
+def skeleton(domain):
+    """
+    Decodes xn-- labels and folds lookalike characters to ASCII.
+
+    Returns the lowercased domain unchanged when it contains nothing to fold.
+    """
+    domain = domain.lower()
+    if 'xn--' in domain:
+        labels = []
+        for label in domain.split('.'):
+            if label.startswith('xn--'):
+                try:
+                    label = label.encode('ascii').decode('idna')
+                except UnicodeError:
+                    pass
+            labels.append(label)
+        domain = '.'.join(labels)
+    if domain.isascii():
+        return domain
+    folded = unicodedata.normalize('NFKD', domain.translate(_CONFUSABLES))
+    return ''.join(c for c in folded if not unicodedata.combining(c))
+
+
+def fold_ascii_homoglyphs(domain):
+    """Replaces digits and letter pairs commonly used as lookalikes (g00gle, rnicrosoft)."""
+    domain = domain.translate(_ASCII_FOLD)
+    for lookalike, letter in _ASCII_FOLD_PAIRS:
+        domain = domain.replace(lookalike, letter)
+    return domain
+
+
+def _preference(match):
+    """Sort key: exact hits first, then folded lookalikes, then the longest typo variant."""
+    return (_RULE_ORDER.index(match.rule) if match.rule in (EXACT, IDNA_HOMOGLYPH, HOMOGLYPH) else 3,
+            -len(match.variant), _RULE_ORDER.index(match.rule))
+
+
+def _is_token(text, start, end):
+    """Whether text[start:end] is a whole label or hyphen-separated token."""
+    return (start == 0 or text[start - 1] in _TOKEN_SEPARATORS) and \
+        (end == len(text) or text[end] in _TOKEN_SEPARATORS)
+
+
+class BrandMatcher:
+    """An Aho-Corasick automaton over every variant of every brand."""
+
+    def __init__(self, brands, typosquats=True):
+        """
+        Args:
+            brands (list): Brand names to watch for (e.g., ["examplecorp", "google"]).
+            typosquats (bool): Also match generated typo and homoglyph variants.
+                               With False, only the brand names themselves match.
+        """
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]  # state -> [(variant, brand, rule)]
+
+        for brand in brands:
+            variants = brand_variants(brand) if typosquats else {brand.lower(): EXACT}
+            for variant, rule in variants.items():
+                self._add(variant, (variant, brand, rule))
+        self._build_failure_links()
+
+    def _add(self, word, payload):
+        state = 0
+        for c in word:
+            next_state = self._goto[state].get(c)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+                self._goto[state][c] = next_state
+            state = next_state
+        self._output[state].append(payload)
+
+    def _build_failure_links(self):
+        pending = deque(self._goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for c, next_state in self._goto[state].items():
+                pending.append(next_state)
+                fail = self._fail[state]
+                while fail and c not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(c, 0)
+                # Inherit the outputs of the longest proper suffix that is also a variant
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def _scan(self, text):
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for end, c in enumerate(text, 1):
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            for variant, brand, rule in output[state]:
+                if rule in _TYPO_RULES and not _is_token(text, end - len(variant), end):
+                    continue
+                yield variant, brand, rule
+
+    def match(self, domain):
+        """
+        Returns every brand the domain targets, at most one Match per brand.
+
+        When several variants of one brand hit, the most specific wins: an
+        exact hit beats a folded lookalike, which beats the longest typo.
+        """
+        lowered = domain.lower()
+        matches = [Match(brand, variant, rule, domain) for variant, brand, rule in self._scan(lowered)]
+
+        unicode_folded = skeleton(lowered)
+        folded = fold_ascii_homoglyphs(unicode_folded)
+        if folded != lowered:
+            fold_rule = IDNA_HOMOGLYPH if unicode_folded != lowered else HOMOGLYPH
+            matches.extend(Match(brand, variant, fold_rule if rule == EXACT else rule, domain)
+                           for variant, brand, rule in self._scan(folded))
+
+        best = {}
+        for match in sorted(matches, key=_preference):
+            best.setdefault(match.brand, match)
+        return list(best.values())
@@ -0,0 +1,149 @@
+"""
+A bounded, thread-safe LRU cache whose entries each carry their own expiry.
+
+Concurrent misses for the same key are coalesced: the first caller runs the
+loader and every other caller waits for (and shares) its result or error.
+get_or_load_async does the same for coroutines on an event loop.
+"""
+from collections import OrderedDict
+import asyncio
+import threading
+import time
+
+
+class _Pending:
+    """A load in progress that other callers can wait on."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # key -> (expires_at, value), least recently used first
+        self._pending = {}
+        self._pending_tasks = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """Returns the cached value, or None if it is missing or expired."""
+        with self._lock:
+            return self._get(key, time.time())
+
+    def _get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            del self._entries[key]
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._set(key, value, expires_at)
+
+    def _set(self, key, value, expires_at):
+        if expires_at <= time.time():
+            return
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get_or_load(self, key, loader):
+        """
+        Returns the cached value for key, calling loader() on a miss.
+
+        loader must return a (value, expires_at) tuple, where expires_at is in
+        epoch seconds. Errors raised by the loader are not cached; they are
+        re-raised in the caller and in every request coalesced with it.
+        """
+        with self._lock:
+            value = self._get(key, time.time())
+            if value is not None:
+                self.hits += 1
+                return value
+
+            pending = self._pending.get(key)
+            leader = pending is None
+            if leader:
+                pending = self._pending[key] = _Pending()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            pending.event.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.value
+
+        try:
+            value, expires_at = loader()
+            pending.value = value
+            with self._lock:
+                self._set(key, value, expires_at)
+            return value
+        except BaseException as e:
+            pending.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._pending[key]
+            pending.event.set()
+
+    async def get_or_load_async(self, key, loader):
+        """
+        Like get_or_load, for callers on an event loop.
+
+        loader is a coroutine function returning (value, expires_at). It runs
+        as its own task, so the load still completes (and is cached) if the
+        caller that started it goes away.
+        """
+        with self._lock:
+            value = self._get(key, time.time())
+            if value is not None:
+                self.hits += 1
+                return value
+
+            task = self._pending_tasks.get(key)
+            if task is None:
+                self.misses += 1
+                task = self._pending_tasks[key] = asyncio.ensure_future(self._load_async(key, loader))
+            else:
+                self.coalesced += 1
+        return await asyncio.shield(task)
+
+    async def _load_async(self, key, loader):
+        try:
+            value, expires_at = await loader()
+            with self._lock:
+                self._set(key, value, expires_at)
+            return value
+        finally:
+            with self._lock:
+                del self._pending_tasks[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
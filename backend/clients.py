@@ -0,0 +1,120 @@
+"""
+Shared HTTP clients for calling the Web Risk API.
+
+Sessions are created once per process and reused across requests so that
+connections to webrisk.googleapis.com are kept alive and pooled instead of
+being opened (and TLS-negotiated) for every call. Application default
+credentials are likewise discovered once, and a background thread refreshes
+the access token shortly before it expires so requests never wait on it.
+"""
+from google.auth.transport.requests import AuthorizedSession, Request
+from requests.adapters import HTTPAdapter
+import datetime
+import google.auth
+import logging
+import os
+import threading
+import time
+import requests
+
+logger = logging.getLogger(__name__)
+
+SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
+POOL_SIZE = int(os.getenv('WEBRISK_POOL_SIZE', '32'))
+REQUEST_TIMEOUT = 30
+REFRESH_MARGIN = 5 * 60       # refresh tokens this long before they expire
+REFRESH_RETRY_INTERVAL = 30
+
+_api_session = None
+_credentials = None
+_authed_session = None
+_refresh_thread = None
+_lock = threading.RLock()
+
+
+def _pooled(session):
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def api_session():
+    """The keep-alive session used for API-key authenticated calls."""
+    global _api_session
+    if _api_session is None:
+        with _lock:
+            if _api_session is None:
+                _api_session = _pooled(requests.Session())
+    return _api_session
+
+
+def api_key_headers(api_key):
+    """
+    Headers authenticating a call with an API key.
+
+    The key goes in a header rather than the ?key= parameter so it never
+    ends up in request URLs, which requests quotes in its error messages.
+    """
+    return {'X-Goog-Api-Key': api_key}
+
+
+def credentials():
+    """Application default credentials, discovered once and kept fresh in the background."""
+    global _credentials, _refresh_thread
+    if _credentials is None:
+        with _lock:
+            if _credentials is None:
+                creds, _ = google.auth.default(scopes=SCOPES)
+                creds.refresh(Request(api_session()))
+                _credentials = creds
+                _refresh_thread = threading.Thread(target=_refresh_forever, name='credentials-refresh', daemon=True)
+                _refresh_thread.start()
+                logger.debug("Obtained Google Cloud credentials")
+    return _credentials
+
+
+def authed_session():
+    """The keep-alive session used for OAuth authenticated calls (submissions and operations)."""
+    global _authed_session
+    if _authed_session is None:
+        creds = credentials()
+        with _lock:
+            if _authed_session is None:
+                _authed_session = _pooled(AuthorizedSession(creds))
+    return _authed_session
+
+
+def _refresh_forever():
+    request = Request(api_session())
+    while True:
+        expiry = _credentials.expiry
+        if expiry is None:
+            # Credentials without an expiry (e.g. some service accounts) never need refreshing
+            return
+        now = datetime.datetime.utcnow()
+        time.sleep(max(REFRESH_RETRY_INTERVAL, (expiry - now).total_seconds() - REFRESH_MARGIN))
+        try:
+            _credentials.refresh(request)
+            logger.debug(f"Refreshed Google Cloud credentials; new expiry {_credentials.expiry}")
+        except Exception as e:
+            logger.error(f"Failed to refresh Google Cloud credentials: {str(e)}")
+            time.sleep(REFRESH_RETRY_INTERVAL)
+
+
+def prime(api_root):
+    """
+    Creates the credentials and both sessions and opens a connection to the API.
+
+    Called from the warmup handler so the first real request on a new
+    instance does not pay for credential discovery, token minting or TLS.
+    Failures are logged rather than raised; requests will retry lazily.
+    """
+    try:
+        api_session().head(api_root, timeout=REQUEST_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Could not pre-connect to {api_root}: {str(e)}")
+    try:
+        authed_session().head(api_root, timeout=REQUEST_TIMEOUT)
+    except Exception as e:
+        logger.error(f"Could not prime the authorized session during warmup: {str(e)}")
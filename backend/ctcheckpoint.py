@@ -0,0 +1,82 @@
+"""
+Persisted per-log progress for tailing Certificate Transparency logs.
+
+The checkpoint file is a JSON object mapping each log URL to the index of
+the next entry to fetch. It is rewritten atomically (write, fsync, rename)
+so a crash leaves either the old or the new checkpoint, never a torn file.
+
+Batches arrive out of order from the concurrent fetcher, so a log's
+checkpoint only advances over a contiguous run of completed entries. A
+range that failed leaves a gap the checkpoint will not move past; the next
+run fetches it again, which means hits after a gap can be reported twice.
+
+When hits go through further stages before they are delivered (see
+ctpipeline.check_hits), the tailer yields a CheckpointMarker after each
+batch instead of committing, and whoever delivers the hits commits it once
+everything before it in the stream has been delivered.
+"""
+import json
+import os
+
+
+class CheckpointStore:
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.positions = {url: int(index) for url, index in json.load(f).items()}
+        except FileNotFoundError:
+            self.positions = {}
+
+    def get(self, log_url, default=None):
+        return self.positions.get(log_url, default)
+
+    def commit(self, log_url, next_index):
+        """Records that every entry of log_url before next_index has been processed."""
+        self.positions[log_url] = next_index
+        directory = os.path.dirname(os.path.abspath(self.path))
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.positions, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        # Make the rename itself durable
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class Watermark:
+    """Tracks how far a log has been processed without gaps, given out-of-order batches."""
+
+    def __init__(self, next_index):
+        self.next_index = next_index
+        self._done = {}  # start -> end (exclusive) of completed batches past the watermark
+
+    def complete(self, start, count):
+        """Marks [start, start + count) as processed; returns True if the watermark advanced."""
+        if start < self.next_index:
+            # Refetched after a failure; only the part past the watermark is news
+            count -= self.next_index - start
+            start = self.next_index
+            if count <= 0:
+                return False
+        self._done[start] = max(self._done.get(start, 0), start + count)
+        advanced = False
+        while self.next_index in self._done:
+            self.next_index = self._done.pop(self.next_index)
+            advanced = True
+        return advanced
+
+
+class CheckpointMarker:
+    """Stands in a hit stream for "every hit of this batch is above me"; commit() records the batch as done."""
+
+    def __init__(self, commit):
+        self._commit = commit
+
+    def commit(self):
+        self._commit()
@@ -0,0 +1,214 @@
+"""
+Concurrent fetch engine for Certificate Transparency logs.
+
+Each log's tree is split into ranges of entries, and ranges from several
+logs are fetched at the same time on a thread pool, with a cap on how many
+requests are in flight against any one log. Within a range, entries are
+paged through get-entries; when a server returns fewer entries than asked
+for, that becomes the log's page size from then on. 429 and 5xx responses
+are retried with exponential backoff (honouring Retry-After), and a range
+that still fails is recorded in `failed_ranges` without stopping the log.
+
+See RFC 6962 section 4 for the get-sth and get-entries endpoints.
+"""
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+import metrics
+import queue
+import random
+import threading
+import time
+import requests
+
+# A page of entries fetched from one log, starting at index `start`.
+Batch = namedtuple('Batch', ['log_url', 'start', 'entries'])
+
+# A range of entries that could not be fetched, with the reason.
+FailedRange = namedtuple('FailedRange', ['log_url', 'start', 'end', 'error'])
+
+REQUEST_TIMEOUT = 30
+MAX_BACKOFF = 60
+METRICS_HANDLER = 'ct_scan'  # see metrics.py
+
+
+class FetchError(Exception):
+    pass
+
+
+def log_base_url(log_url):
+    """Accepts either a log's base URL or its get-entries URL and returns the base."""
+    log_url = log_url.rstrip('/')
+    for endpoint in ('/get-entries', '/get-sth'):
+        if log_url.endswith(endpoint):
+            return log_url[:-len(endpoint)]
+    return log_url
+
+
+class _LogState:
+    def __init__(self, log_url, page_size):
+        self.log_url = log_url
+        self.base_url = log_base_url(log_url)
+        self.page_size = page_size
+        self.pending = deque()
+        self.in_flight = 0
+
+
+class CTFetcher:
+    def __init__(self, max_workers=16, per_log_concurrency=4, page_size=1000,
+                 range_pages=32, max_retries=6, backoff=1.0, session=None):
+        """
+        Args:
+            max_workers (int): Total requests in flight across all logs.
+            per_log_concurrency (int): Requests in flight against any single log.
+            page_size (int): Entries requested per get-entries call to start with.
+            range_pages (int): Pages per range handed to a worker.
+            max_retries (int): Retries of a 429/5xx/network failure before a range is given up.
+            backoff (float): Base delay in seconds for exponential backoff.
+        """
+        self.max_workers = max_workers
+        self.per_log_concurrency = per_log_concurrency
+        self.page_size = page_size
+        self.range_pages = range_pages
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.failed_ranges = []
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=max_workers)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        self.session = session
+        self._stop = threading.Event()
+
+    def get_tree_size(self, log_url):
+        """Returns the log's current tree size from get-sth."""
+        data = self._get_json(f"{log_base_url(log_url)}/get-sth")
+        return int(data['tree_size'])
+
+    def fetch(self, logs, start=0, end=None):
+        """
+        Fetches entries [start, end] from every log concurrently.
+
+        Args:
+            logs (list or dict): Log URLs. A dict maps each log URL to its own
+                                 (start, end) pair, overriding the defaults.
+            start (int): First entry index to fetch.
+            end (int, optional): Last entry index to fetch. Defaults to the
+                                 last entry in each log's current tree.
+
+        Yields:
+            Batch: Pages of entries, in completion order across all logs.
+        """
+        self._stop.clear()
+        bounds = logs if isinstance(logs, dict) else {log_url: (start, end) for log_url in logs}
+
+        states = []
+        for log_url, (log_start, log_end) in bounds.items():
+            state = _LogState(log_url, self.page_size)
+            if log_end is None:
+                try:
+                    log_end = self.get_tree_size(log_url) - 1
+                except (FetchError, KeyError, TypeError, ValueError) as e:
+                    self.failed_ranges.append(FailedRange(log_url, log_start, None, str(e)))
+                    continue
+            step = self.page_size * self.range_pages
+            for range_start in range(log_start, log_end + 1, step):
+                state.pending.append((range_start, min(range_start + step - 1, log_end)))
+            states.append(state)
+
+        results = queue.Queue(maxsize=self.max_workers * 4)
+        executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='ct-fetch')
+        in_flight = 0
+        try:
+            while True:
+                # Hand out ranges round-robin so every log makes progress at once.
+                scheduled = True
+                while scheduled and in_flight < self.max_workers:
+                    scheduled = False
+                    for state in states:
+                        if state.pending and state.in_flight < self.per_log_concurrency \
+                                and in_flight < self.max_workers:
+                            range_start, range_end = state.pending.popleft()
+                            state.in_flight += 1
+                            in_flight += 1
+                            executor.submit(self._fetch_range, state, range_start, range_end, results)
+                            scheduled = True
+
+                if in_flight == 0:
+                    return
+
+                kind, state, payload = results.get()
+                if kind == 'batch':
+                    yield payload
+                else:
+                    state.in_flight -= 1
+                    in_flight -= 1
+        finally:
+            self._stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _fetch_range(self, state, start, end, results):
+        try:
+            while start <= end and not self._stop.is_set():
+                page_end = min(start + state.page_size - 1, end)
+                try:
+                    data = self._get_json(f"{state.base_url}/get-entries?start={start}&end={page_end}")
+                except FetchError as e:
+                    self.failed_ranges.append(FailedRange(state.log_url, start, end, str(e)))
+                    return
+
+                entries = data.get('entries') or []
+                if not entries:
+                    self.failed_ranges.append(FailedRange(state.log_url, start, end, 'no entries returned'))
+                    return
+                if len(entries) < page_end - start + 1:
+                    # The server caps page sizes; ask for no more than it returns.
+                    state.page_size = min(state.page_size, len(entries))
+
+                self._put(results, ('batch', state, Batch(state.log_url, start, entries)))
+                start += len(entries)
+        except Exception as e:
+            # Nobody reads this future's exception, so anything unexpected (say, a body that is
+            # not a JSON object) must still be recorded or the range would be skipped silently.
+            self.failed_ranges.append(FailedRange(state.log_url, start, end, f"{type(e).__name__}: {e}"))
+        finally:
+            self._put(results, ('done', state, None))
+
+    def _put(self, results, item):
+        # Block while the consumer is busy, but give up once fetching is stopped.
+        while not self._stop.is_set():
+            try:
+                results.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    def _get_json(self, url):
+        """GETs a JSON document, retrying rate limits, server errors and network failures."""
+        for attempt in range(self.max_retries + 1):
+            delay = None
+            try:
+                with metrics.stage('upstream', handler=METRICS_HANDLER):
+                    response = self.session.get(url, timeout=REQUEST_TIMEOUT)
+                if response.status_code == 429 or response.status_code >= 500:
+                    retry_after = response.headers.get('Retry-After', '')
+                    delay = float(retry_after) if retry_after.isdigit() else None
+                    error = f"HTTP {response.status_code}"
+                else:
+                    response.raise_for_status()
+                    with metrics.stage('parse', handler=METRICS_HANDLER):
+                        return response.json()
+            except requests.exceptions.HTTPError as e:
+                raise FetchError(str(e))
+            except ValueError as e:
+                raise FetchError(f"Invalid JSON from {url}: {e}")
+            except requests.exceptions.RequestException as e:
+                error = str(e)
+
+            if attempt == self.max_retries or self._stop.is_set():
+                break
+            if delay is None:
+                delay = min(MAX_BACKOFF, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+            time.sleep(delay)
+        raise FetchError(f"Giving up on {url} after {self.max_retries + 1} attempts: {error}")
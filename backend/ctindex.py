@@ -0,0 +1,232 @@
+"""
+A persistent, searchable index of every domain seen in CT logs.
+
+Domains extracted by the CT scanner are stored in SQLite with the log and
+entry they were first seen in and when (the log's timestamp for that
+entry). A trigram table makes substring searches an index lookup rather
+than a scan, and an index on the registrable domain answers "everything
+under example.co.uk" directly. New brands can then be checked against
+months of history without downloading the logs again.
+
+The index is built by the CT tailer, not by the web backend:
+
+    python ctlogs.py --tail checkpoints.json --follow --index /data/ct_index.sqlite3 [brands...]
+
+run wherever there is persistent storage. /api/ct/search reads the file at
+CT_INDEX_PATH and answers 503 until it exists and holds domains; the backend
+never creates it. On App Engine, where only /tmp is writable and it is
+neither persistent nor shared between instances, deploy a snapshot with the
+app instead: stop the tailer (its last connection folds the write-ahead log
+into the file), copy the file into backend/ and set CT_INDEX_PATH to it. A
+file the backend cannot write is opened read-only as an immutable snapshot.
+"""
+from datetime import datetime, timezone
+from urllib.parse import quote
+import os
+import sqlite3
+import threading
+
+INDEX_PATH = os.getenv('CT_INDEX_PATH', '/tmp/ct_index.sqlite3')
+# SQLite page cache per connection; the trigram B-tree is written all over on ingest
+CACHE_KIB = int(os.getenv('CT_INDEX_CACHE_KIB', '65536'))
+MIN_QUERY_LENGTH = 3
+
+_SQL_CHUNK = 500
+# Counting a trigram's postings stops here; past it a trigram is simply "common".
+_POSTINGS_COUNT_CAP = 5000
+
+# Multi-label public suffixes common enough to matter for registrable-domain
+# grouping. This is a deliberately small subset of the Public Suffix List;
+# anything not listed is treated as a single-label suffix.
+_MULTI_LABEL_SUFFIXES = {
+    'co.uk', 'org.uk', 'ac.uk', 'gov.uk', 'me.uk', 'ltd.uk', 'plc.uk', 'net.uk',
+    'com.au', 'net.au', 'org.au', 'edu.au', 'gov.au', 'co.nz', 'org.nz', 'net.nz',
+    'co.jp', 'ne.jp', 'or.jp', 'ac.jp', 'co.kr', 'or.kr', 'com.br', 'net.br', 'org.br',
+    'com.cn', 'net.cn', 'org.cn', 'com.hk', 'com.tw', 'com.sg', 'com.my', 'co.in', 'net.in',
+    'org.in', 'co.za', 'com.mx', 'com.ar', 'com.tr', 'com.ru', 'co.id', 'co.il', 'com.ua',
+    'appspot.com', 'blogspot.com', 'github.io', 'herokuapp.com', 'azurewebsites.net',
+    'cloudfront.net', 'web.app', 'firebaseapp.com', 'netlify.app', 'vercel.app', 'pages.dev',
+    'workers.dev',
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS domains (
+    id INTEGER PRIMARY KEY,
+    domain TEXT NOT NULL UNIQUE,
+    registrable TEXT NOT NULL,
+    log_url TEXT NOT NULL,
+    entry_index INTEGER NOT NULL,
+    first_seen REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS domains_registrable ON domains (registrable);
+CREATE TABLE IF NOT EXISTS trigrams (
+    trigram TEXT NOT NULL,
+    domain_id INTEGER NOT NULL,
+    PRIMARY KEY (trigram, domain_id)
+) WITHOUT ROWID;
+"""
+
+
+def normalize_domain(domain):
+    domain = domain.strip().lower().rstrip('.')
+    return domain[2:] if domain.startswith('*.') else domain
+
+
+def registrable_domain(domain):
+    """Returns the registrable part of a domain (eTLD+1), e.g. login.example.co.uk -> example.co.uk."""
+    labels = normalize_domain(domain).split('.')
+    if len(labels) <= 2:
+        return '.'.join(labels)
+    suffix_labels = 2 if '.'.join(labels[-2:]) in _MULTI_LABEL_SUFFIXES else 1
+    return '.'.join(labels[-(suffix_labels + 1):])
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class DomainIndex:
+    def __init__(self, path=INDEX_PATH, readonly=False):
+        """
+        Args:
+            path (str): The SQLite file; created, with its schema, unless readonly.
+            readonly (bool): Open an existing snapshot that nothing writes to anymore
+                             (see the module docstring); add() then fails.
+        """
+        self.path = path
+        self.readonly = readonly
+        self._local = threading.local()
+        if not readonly:
+            with self._connection() as conn:
+                conn.executescript(_SCHEMA)
+
+    def _connection(self):
+        # sqlite3 connections cannot be shared across threads, so keep one per thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if self.readonly:
+                conn = sqlite3.connect(f"file:{quote(os.path.abspath(self.path))}?immutable=1", uri=True)
+            else:
+                conn = sqlite3.connect(self.path, timeout=30)
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('PRAGMA synchronous=NORMAL')
+            conn.row_factory = sqlite3.Row
+            conn.execute(f'PRAGMA cache_size=-{CACHE_KIB}')
+            self._local.conn = conn
+        return conn
+
+    def add(self, rows):
+        """
+        Indexes (domain, log_url, entry_index, seen_at) rows in one transaction.
+
+        seen_at is in epoch seconds. A domain already in the index keeps its
+        earliest sighting. Returns the number of domains that were new.
+        """
+        earliest = {}
+        for domain, log_url, entry_index, seen_at in rows:
+            domain = normalize_domain(domain)
+            if domain and (domain not in earliest or seen_at < earliest[domain][2]):
+                earliest[domain] = (log_url, entry_index, seen_at)
+        if not earliest:
+            return 0
+
+        conn = self._connection()
+        with conn:
+            # Take the write lock before reading: a deferred transaction that reads and then
+            # writes fails with "database is locked" when another writer got there first
+            conn.execute('BEGIN IMMEDIATE')
+            existing = {}
+            domains = list(earliest)
+            for i in range(0, len(domains), _SQL_CHUNK):
+                chunk = domains[i:i + _SQL_CHUNK]
+                placeholders = ','.join('?' * len(chunk))
+                for row in conn.execute(f'SELECT id, domain, first_seen FROM domains WHERE domain IN ({placeholders})',
+                                        chunk):
+                    existing[row['domain']] = row
+
+            conn.executemany(
+                'UPDATE domains SET log_url = ?, entry_index = ?, first_seen = ? WHERE id = ?',
+                [(*earliest[domain], row['id']) for domain, row in existing.items()
+                 if earliest[domain][2] < row['first_seen']],
+            )
+            new = [domain for domain in domains if domain not in existing]
+            conn.executemany(
+                'INSERT OR IGNORE INTO domains (domain, registrable, log_url, entry_index, first_seen) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(domain, registrable_domain(domain), *earliest[domain]) for domain in new],
+            )
+            for i in range(0, len(new), _SQL_CHUNK):
+                chunk = new[i:i + _SQL_CHUNK]
+                placeholders = ','.join('?' * len(chunk))
+                conn.executemany('INSERT OR IGNORE INTO trigrams (trigram, domain_id) VALUES (?, ?)', [
+                    (t, row['id'])
+                    for row in conn.execute(f'SELECT id, domain FROM domains WHERE domain IN ({placeholders})', chunk)
+                    for t in _trigrams(row['domain'])
+                ])
+        return len(new)
+
+    def search_substring(self, query, limit=100):
+        """
+        Returns indexed domains containing query, most recently indexed first.
+
+        query must be at least MIN_QUERY_LENGTH characters long.
+        """
+        query = normalize_domain(query)
+        if len(query) < MIN_QUERY_LENGTH:
+            raise ValueError(f"Substring queries need at least {MIN_QUERY_LENGTH} characters")
+        # Walk the postings of the query's rarest trigram, newest first, and
+        # confirm each candidate with instr(). A selective query touches few
+        # postings; a broad one fills the limit almost immediately.
+        return self._rows(
+            'SELECT domains.* FROM trigrams JOIN domains ON domains.id = trigrams.domain_id '
+            'WHERE trigrams.trigram = ? AND instr(domains.domain, ?) > 0 '
+            'ORDER BY trigrams.domain_id DESC LIMIT ?',
+            (self._rarest_trigram(query), query, limit),
+        )
+
+    def _rarest_trigram(self, query):
+        conn = self._connection()
+        counts = {}
+        for trigram in _trigrams(query):
+            counts[trigram] = conn.execute(
+                'SELECT COUNT(*) FROM (SELECT 1 FROM trigrams WHERE trigram = ? LIMIT ?)',
+                (trigram, _POSTINGS_COUNT_CAP),
+            ).fetchone()[0]
+        return min(counts, key=counts.get)
+
+    def search_registrable(self, domain, limit=100):
+        """Returns every indexed domain under the same registrable domain as domain, most recently indexed first."""
+        return self._rows('SELECT * FROM domains WHERE registrable = ? ORDER BY id DESC LIMIT ?',
+                          (registrable_domain(domain), limit))
+
+    def _rows(self, sql, params):
+        return [{
+            'domain': row['domain'],
+            'registrable': row['registrable'],
+            'log_url': row['log_url'],
+            'entry_index': row['entry_index'],
+            'first_seen': datetime.fromtimestamp(row['first_seen'], timezone.utc).replace(microsecond=0)
+                                  .isoformat().replace('+00:00', 'Z'),
+        } for row in self._connection().execute(sql, params)]
+
+    def count(self):
+        return self._connection().execute('SELECT COUNT(*) FROM domains').fetchone()[0]
+
+    def empty(self):
+        """Whether no domain has been indexed yet (cheaper than count() on a large index)."""
+        return self._connection().execute('SELECT NOT EXISTS (SELECT 1 FROM domains)').fetchone()[0] == 1
+
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_index():
+    """
+    Returns this process's handle on the index at CT_INDEX_PATH, or None while
+    there is no such file. A file this process cannot write is opened read-only.
+    """
+    global _index
+    with _index_lock:
+        if _index is None and os.path.exists(INDEX_PATH):
+            _index = DomainIndex(INDEX_PATH, readonly=not os.access(INDEX_PATH, os.W_OK))
+    return _index
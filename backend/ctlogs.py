@@ -1,23 +1,66 @@
-import requests
+from brandmatch import BrandMatcher
+from ctcheckpoint import CheckpointMarker, CheckpointStore, Watermark
+from ctfetch import CTFetcher, FailedRange, FetchError, METRICS_HANDLER
+from ctindex import DomainIndex, INDEX_PATH
+from ctparse import parse_leaf
+from ctpipeline import check_hits
+import argparse
 import json
-import re
+import metrics
+import os
+import sys
+import time
 
-def search_ct_logs_for_brand(brand_name, logs=['https://ct.googleapis.com/aviator/ct/v1/get-entries']):
+def search_ct_logs_for_brand(brand_name, logs=['https://ct.googleapis.com/aviator/ct/v1/get-entries'], **kwargs):
     """
     Scans Certificate Transparency logs for domain names potentially targeting a brand.
 
+    A convenience wrapper around search_ct_logs_for_brands for a single brand;
+    see that function for the optional arguments and the returned hits.
+
     Args:
         brand_name (str): The brand name to search for (e.g., "examplecorp").
         logs (list, optional): A list of CT log URLs to query.
                                Defaults to Google's Aviator log. You can find more logs at
                                https://www.certificate-transparency.org/known-logs
+    """
+    return search_ct_logs_for_brands([brand_name], logs, **kwargs)
+
+def search_ct_logs_for_brands(brand_names, logs=['https://ct.googleapis.com/aviator/ct/v1/get-entries'],
+                              start_index=0, end_index=None, max_workers=16, per_log_concurrency=4,
+                              typosquats=True, index=None):
+    """
+    Scans Certificate Transparency logs for domain names potentially targeting any of several brands.
+
+    All brands (and, with typosquats, their typo and homoglyph variants) are
+    compiled into one matcher, so every domain is checked against every brand
+    in a single pass over the logs.
+
+    Args:
+        brand_names (list): The brand names to search for (e.g., ["examplecorp", "google"]).
+        logs (list, optional): A list of CT log URLs to query.
+                               Defaults to Google's Aviator log. You can find more logs at
+                               https://www.certificate-transparency.org/known-logs
+        start_index (int, optional): First entry index to scan in each log.
+        end_index (int, optional): Last entry index to scan in each log. Defaults to
+                                   the end of each log's current tree (from get-sth).
+        max_workers (int, optional): Total get-entries requests in flight across all logs.
+        per_log_concurrency (int, optional): Requests in flight against any single log.
+        typosquats (bool, optional): Also match typo and homoglyph/IDNA lookalikes of
+                                     each brand, not just the brand name itself.
+        index (ctindex.DomainIndex, optional): Also record every domain seen, hit or
+                                               not, in this index.
 
     Returns:
         list: A list of dictionaries, each containing information about a potentially
-              malicious domain targeting the brand. Each dictionary includes:
+              malicious domain targeting a brand. Each dictionary includes:
               - 'domain': The domain name found in the CT log.
               - 'entry_index': The index of the log entry where the domain was found.
               - 'log_url': The URL of the CT log where the entry was found.
+              - 'brand': The brand the domain appears to target.
+              - 'variant': The brand variant found in the domain.
+              - 'rule': How the variant was derived from the brand ('exact', 'homoglyph',
+                        'idna-homoglyph', 'omission', 'transposition', ...).
               - 'certificate': (Optional, if you want to fetch full cert details - be mindful of API limits)
                                 The full certificate data from the CT log entry.
               (Currently only returns domain, index and log_url for brevity and to avoid
@@ -27,75 +70,214 @@ def search_ct_logs_for_brand(brand_name, logs=['https://ct.googleapis.com/aviato
     """
 
     potential_threats = []
-    brand_name_lower = brand_name.lower() # Case-insensitive search
+    stats = {}
 
     for log_url in logs:
         print(f"Scanning CT Log: {log_url}")
-        start_index = 0
-        batch_size = 1000 # Adjust batch size as needed, be mindful of API limits
 
-        while True:
-            url = f"{log_url}?start={start_index}&end={start_index + batch_size - 1}"
-            try:
-                response = requests.get(url)
-                response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
-                data = response.json()
+    for threat in iter_ct_log_hits(brand_names, logs, start_index, end_index, max_workers,
+                                   per_log_concurrency, typosquats, stats, index):
+        potential_threats.append(threat)
+        print(f"  Potential threat found in {threat['log_url']} at index {threat['entry_index']}: "
+              f"Domain '{threat['domain']}' ({threat['rule']} match for '{threat['brand']}')")
+
+    _print_problems(stats)
+
+    if potential_threats:
+        print("\nPotential Brand Targeting Domains Found:")
+        for threat in potential_threats:
+            print(f"  - Domain: {threat['domain']}, Brand: {threat['brand']} ({threat['rule']}), "
+                  f"Log: {threat['log_url']}, Entry Index: {threat['entry_index']}")
+    else:
+        print("\nNo potential brand targeting domains found in the scanned logs.")
+
+    return potential_threats
+
+def iter_ct_log_hits(brand_names, logs=['https://ct.googleapis.com/aviator/ct/v1/get-entries'],
+                     start_index=0, end_index=None, max_workers=16, per_log_concurrency=4,
+                     typosquats=True, stats=None, index=None):
+    """
+    Like search_ct_logs_for_brands, but yields each hit as it is found instead
+    of collecting them, so memory stays flat however many hits a scan produces.
 
-                if 'entries' not in data:
-                    print(f"  No 'entries' found in response from {log_url}. Possibly end of log or API issue.")
-                    break # Assume no more entries
+    Args:
+        stats (dict, optional): Filled in with 'unparsed_entries' (a count) and
+                                'failed_ranges' (ctfetch.FailedRange tuples) as
+                                the scan runs.
+        index (ctindex.DomainIndex, optional): See search_ct_logs_for_brands.
+    """
+    stats = {} if stats is None else stats
+    matcher = BrandMatcher(brand_names, typosquats=typosquats) # Case-insensitive search
+    fetcher = CTFetcher(max_workers=max_workers, per_log_concurrency=per_log_concurrency)
+    stats['failed_ranges'] = fetcher.failed_ranges
+    for batch in fetcher.fetch(logs, start=start_index, end=end_index):
+        yield from _batch_hits(matcher, batch, stats, index)
 
-                entries = data['entries']
-                if not entries:
-                    print(f"  No more entries found in this batch from {log_url}. Moving to next log or finishing.")
-                    break # No more entries in this batch, likely end of log segment
+def tail_ct_logs(brand_names, logs, checkpoint_path, initial_index=None, follow=False, poll_interval=60,
+                 max_workers=16, per_log_concurrency=4, typosquats=True, stats=None, index=None,
+                 checkpoint_markers=False):
+    """
+    Yields hits from entries added to each log since the last run.
 
-                for index, entry_data in enumerate(entries):
-                    entry_index = start_index + index # Actual index in the entire log
+    Each log's tree size is read with get-sth, and only the entries between
+    its persisted checkpoint and that size are fetched. The checkpoint is
+    committed (atomically) after each batch's hits have been yielded, so a
+    crash resumes from the last completed batch; hits are delivered at
+    least once. With an index, each batch's domains are indexed before its
+    checkpoint is committed.
 
-                    leaf_cert = entry_data['leaf_input']['leaf_certificate']
-                    # Decode Base64 certificate
-                    import base64
-                    cert_bytes = base64.b64decode(leaf_cert)
+    When the hits are handed to further stages rather than delivered
+    straight away, pass checkpoint_markers: a ctcheckpoint.CheckpointMarker
+    is then yielded after each batch's hits instead, and the checkpoint
+    only advances when the consumer calls its commit(), i.e. once the hits
+    before it are really delivered. check_hits does this.
 
-                    # Basic domain extraction using regex (may need refinement)
-                    common_names = re.findall(r"CN=([^,\n]+)", cert_bytes.decode('utf-8', errors='ignore'))
-                    san_names = re.findall(r"DNS:([^,\n]+)", cert_bytes.decode('utf-8', errors='ignore')) # Subject Alternative Names
+    Args:
+        brand_names (list): The brand names to search for.
+        logs (list): CT log URLs to tail.
+        checkpoint_path (str): JSON file holding each log's next entry index.
+        initial_index (int, optional): Where to start in a log that has no checkpoint
+                                       yet. Defaults to the current end of the log,
+                                       so only entries logged from now on are scanned.
+        follow (bool, optional): Keep polling for new entries instead of returning
+                                 once every log has been caught up.
+        poll_interval (int, optional): Seconds between polls when following.
+        stats (dict, optional): See iter_ct_log_hits.
+        index (ctindex.DomainIndex, optional): See search_ct_logs_for_brands.
+        checkpoint_markers (bool, optional): Yield markers for the consumer to commit
+                                             instead of committing checkpoints here.
+    """
+    stats = {} if stats is None else stats
+    checkpoints = CheckpointStore(checkpoint_path)
+    matcher = BrandMatcher(brand_names, typosquats=typosquats)
+    fetcher = CTFetcher(max_workers=max_workers, per_log_concurrency=per_log_concurrency)
+    stats['failed_ranges'] = fetcher.failed_ranges
+    # Next entry to fetch in each log, which runs ahead of its checkpoint while markers are uncommitted
+    positions = {}
+    committed = {}  # log URL -> Watermark of what consumers have committed
 
-                    domains = set(common_names + san_names) # Use set to avoid duplicates
+    def marker(log_url, start, count):
+        def commit():
+            watermark = committed[log_url]
+            if watermark.complete(start, count):
+                checkpoints.commit(log_url, watermark.next_index)
+        return CheckpointMarker(commit)
 
-                    for domain in domains:
-                        if brand_name_lower in domain.lower():
-                            potential_threats.append({
-                                'domain': domain,
-                                'entry_index': entry_index,
-                                'log_url': log_url,
-                                # 'certificate': entry_data # Optionally include full cert data - be careful with volume
-                            })
-                            print(f"  Potential threat found in {log_url} at index {entry_index}: Domain '{domain}'")
+    while True:
+        # Failures from the previous poll are retried, since checkpoints never skip them
+        del fetcher.failed_ranges[:]
+        bounds, watermarks = {}, {}
+        for log_url in logs:
+            try:
+                tree_size = fetcher.get_tree_size(log_url)
+            except (FetchError, KeyError, ValueError) as e:
+                fetcher.failed_ranges.append(FailedRange(log_url, checkpoints.get(log_url), None, str(e)))
+                continue
 
-                start_index += batch_size
+            start = positions.get(log_url, checkpoints.get(log_url))
+            if start is None:
+                start = tree_size if initial_index is None else initial_index
+                checkpoints.commit(log_url, start)
+            committed.setdefault(log_url, Watermark(checkpoints.get(log_url)))
+            if start < tree_size:
+                bounds[log_url] = (start, tree_size - 1)
+                watermarks[log_url] = Watermark(start)
 
-            except requests.exceptions.RequestException as e:
-                print(f"  Error fetching from {log_url}: {e}")
-                break # Stop scanning this log if there's a persistent error (rate limiting, etc.)
-            except json.JSONDecodeError:
-                print(f"  Error decoding JSON from {log_url}. Possibly invalid response format.")
-                break # Stop if JSON is invalid
+        for batch in fetcher.fetch(bounds):
+            yield from _batch_hits(matcher, batch, stats, index)
+            watermark = watermarks[batch.log_url]
+            if watermark.complete(batch.start, len(batch.entries)):
+                positions[batch.log_url] = watermark.next_index
+            if checkpoint_markers:
+                yield marker(batch.log_url, batch.start, len(batch.entries))
+            else:
+                marker(batch.log_url, batch.start, len(batch.entries)).commit()
 
+        if not follow:
+            return
+        time.sleep(poll_interval)
 
-    if potential_threats:
-        print("\nPotential Brand Targeting Domains Found:")
-        for threat in potential_threats:
-            print(f"  - Domain: {threat['domain']}, Log: {threat['log_url']}, Entry Index: {threat['entry_index']}")
-    else:
-        print("\nNo potential brand targeting domains found in the scanned logs (based on basic search).")
+def write_jsonl(hits, path):
+    """Appends each hit to a JSON Lines file as it arrives; returns how many were written."""
+    count = 0
+    with open(path, 'a') as sink:
+        for hit in hits:
+            sink.write(json.dumps(hit) + '\n')
+            sink.flush()
+            count += 1
+    return count
 
-    return potential_threats
+def _batch_hits(matcher, batch, stats, domain_index=None):
+    # Stage times are summed over the batch and recorded once per batch (see metrics.py)
+    seen = []
+    parse_time = match_time = 0.0
+    for index, entry_data in enumerate(batch.entries):
+        entry_index = batch.start + index # Actual index in the entire log
+
+        started = time.perf_counter()
+        try:
+            leaf = parse_leaf(entry_data['leaf_input'])
+        except (ValueError, KeyError): # CTParseError, bad base64 or a malformed entry
+            stats['unparsed_entries'] = stats.get('unparsed_entries', 0) + 1
+            continue
+        finally:
+            parse_time += time.perf_counter() - started
+
+        domains = set(leaf.common_names) | set(leaf.dns_names) # Subject CNs and all SAN dNSNames
+        if domain_index is not None:
+            seen.extend((domain, batch.log_url, entry_index, leaf.timestamp / 1000) for domain in domains)
+        for domain in domains:
+            started = time.perf_counter()
+            matches = matcher.match(domain)
+            match_time += time.perf_counter() - started
+            for match in matches:
+                yield {
+                    'domain': domain,
+                    'entry_index': entry_index,
+                    'log_url': batch.log_url,
+                    'brand': match.brand,
+                    'variant': match.variant,
+                    'rule': match.rule,
+                    # 'certificate': entry_data # Optionally include full cert data - be careful with volume
+                }
+
+    metrics.observe_stage('parse_leaf_batch', parse_time, METRICS_HANDLER)
+    metrics.observe_stage('match_batch', match_time, METRICS_HANDLER)
+    if seen:
+        with metrics.stage('index_batch', handler=METRICS_HANDLER):
+            domain_index.add(seen)
+
+def _print_problems(stats, file=None):
+    if stats.get('unparsed_entries'):
+        print(f"  Skipped {stats['unparsed_entries']} entries that could not be parsed", file=file)
+    for failed in stats.get('failed_ranges', []):
+        print(f"  Error fetching entries {failed.start}-{failed.end} from {failed.log_url}: {failed.error}", file=file)
 
 if __name__ == "__main__":
-    your_brand_name = "Google" # Replace with your actual brand name
-    logs_to_scan = [
+    parser = argparse.ArgumentParser(description="Scan Certificate Transparency logs for domains targeting brands.")
+    parser.add_argument('brands', nargs='*', help="Brand names to search for, e.g. Google")
+    parser.add_argument('--log', action='append', dest='logs', metavar='URL',
+                        help="CT log get-entries URL (repeatable). Defaults to a set of Google logs.")
+    parser.add_argument('--no-typosquats', action='store_true', help="Only match the brand names themselves")
+    parser.add_argument('--tail', metavar='CHECKPOINT',
+                        help="Only scan entries added since the checkpoints in this JSON file")
+    parser.add_argument('--from-start', action='store_true',
+                        help="With --tail, scan logs without a checkpoint from entry 0 instead of their current end")
+    parser.add_argument('--follow', action='store_true', help="With --tail, keep polling for new entries")
+    parser.add_argument('--poll-interval', type=int, default=60)
+    parser.add_argument('--sink', metavar='PATH', help="Append hits to this JSON Lines file instead of stdout")
+    parser.add_argument('--check', action='store_true',
+                        help="Check each new domain with Web Risk (needs WEBRISK_API_KEY) and add the verdict")
+    parser.add_argument('--index', metavar='PATH', nargs='?', const=INDEX_PATH,
+                        help="Record every domain seen in this SQLite index (defaults to CT_INDEX_PATH), "
+                             "searchable through /api/ct/search")
+    parser.add_argument('--metrics', metavar='PATH',
+                        help="When done, write stage timings here in the Prometheus text format")
+    args = parser.parse_args()
+    if not args.brands and not args.index:
+        parser.error("give at least one brand, or --index to only build the domain index")
+
+    logs_to_scan = args.logs or [
         'https://ct.googleapis.com/aviator/ct/v1/get-entries',
         'https://ct.googleapis.com/icarus/ct/v1/get-entries',
         'https://ct.googleapis.com/rocketeer/ct/v1/get-entries',
@@ -103,8 +285,31 @@ if __name__ == "__main__":
         # Add more CT log URLs from https://www.certificate-transparency.org/known-logs if needed
     ]
 
-    print(f"Starting scan for brand: '{your_brand_name}' across CT logs...")
-    threats_found = search_ct_logs_for_brand(your_brand_name, logs_to_scan)
+    print(f"Starting scan for brands: {args.brands} across CT logs...", file=sys.stderr)
+    stats = {}
+    index = DomainIndex(args.index) if args.index else None
+    if args.tail:
+        hits = tail_ct_logs(args.brands, logs_to_scan, args.tail, initial_index=0 if args.from_start else None,
+                            follow=args.follow, poll_interval=args.poll_interval,
+                            typosquats=not args.no_typosquats, stats=stats, index=index,
+                            checkpoint_markers=args.check)
+    else:
+        hits = iter_ct_log_hits(args.brands, logs_to_scan, typosquats=not args.no_typosquats, stats=stats,
+                                index=index)
 
-    # You can further process the 'threats_found' list, e.g., save to a file,
-    # perform deeper analysis, or integrate with alert systems.
\ No newline at end of file
+    if args.check:
+        api_key = os.getenv('WEBRISK_API_KEY')
+        if not api_key:
+            parser.error("--check needs the WEBRISK_API_KEY environment variable")
+        hits = check_hits(hits, api_key)
+
+    if args.sink:
+        count = write_jsonl(hits, args.sink)
+        print(f"Wrote {count} hits to {args.sink}", file=sys.stderr)
+    else:
+        for hit in hits:
+            print(json.dumps(hit), flush=True)
+    _print_problems(stats, file=sys.stderr)
+    if args.metrics:
+        with open(args.metrics, 'w') as f:
+            f.write(metrics.render())
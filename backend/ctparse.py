@@ -0,0 +1,204 @@
+"""
+Decoder for Certificate Transparency log entries.
+
+get-entries returns each entry's leaf_input as a base64-encoded
+MerkleTreeLeaf (RFC 6962 section 3.4). Its TimestampedEntry holds either a
+DER X.509 certificate or, for precertificates, the DER TBSCertificate. This
+module walks just enough of the DER to pull out the subject common names
+and every dNSName in the subjectAltName extension.
+
+The decoded leaf is never copied: elements are located by offset, OIDs are
+found with bytes.find/startswith over ranges of the leaf, and names are
+decoded straight out of memoryview slices.
+"""
+from collections import namedtuple
+import base64
+
+X509_ENTRY = 0
+PRECERT_ENTRY = 1
+
+# A decoded leaf: timestamp is in milliseconds since the epoch.
+Leaf = namedtuple('Leaf', ['timestamp', 'entry_type', 'common_names', 'dns_names'])
+
+_SEQUENCE = 0x30
+_SET = 0x31
+_OID = 0x06
+_OCTET_STRING = 0x04
+_VERSION = 0xa0        # [0] EXPLICIT version
+_EXTENSIONS = 0xa3     # [3] EXPLICIT extensions
+_DNS_NAME = 0x82       # [2] IMPLICIT IA5String within GeneralName
+
+# OID elements (tag, length, value) of the attributes we look for.
+_CN_OID = b'\x06\x03\x55\x04\x03'       # 2.5.4.3 commonName
+_SAN_OID = b'\x06\x03\x55\x1d\x11'      # 2.5.29.17 subjectAltName
+
+_STRING_CODECS = {
+    0x0c: 'utf-8',       # UTF8String
+    0x13: 'ascii',       # PrintableString
+    0x14: 'latin-1',     # TeletexString (close enough for host names)
+    0x16: 'ascii',       # IA5String
+    0x1c: 'utf-32-be',   # UniversalString
+    0x1e: 'utf-16-be',   # BMPString
+}
+
+
+class CTParseError(ValueError):
+    pass
+
+
+def _tlv(data, pos, end):
+    """Reads the DER element at pos; returns (tag, content_start, content_end)."""
+    if pos + 2 > end:
+        raise CTParseError("Truncated DER element")
+    tag = data[pos]
+    length = data[pos + 1]
+    pos += 2
+    if length & 0x80:
+        count = length & 0x7f
+        if count == 0 or count > 4 or pos + count > end:
+            raise CTParseError("Unsupported DER length")
+        length = int.from_bytes(data[pos:pos + count], 'big')
+        pos += count
+    if pos + length > end:
+        raise CTParseError("DER element runs past its container")
+    return tag, pos, pos + length
+
+
+def _expect(data, pos, end, tag):
+    found, start, stop = _tlv(data, pos, end)
+    if found != tag:
+        raise CTParseError(f"Expected DER tag {tag:#x}, found {found:#x}")
+    return start, stop
+
+
+def _common_names(data, view, start, end):
+    """Returns the CN attributes of the Name in data[start:end]."""
+    names = []
+    pos = data.find(_CN_OID, start, end)
+    while pos != -1:
+        tag, value_start, value_end = _tlv(data, pos + len(_CN_OID), end)
+        names.append(str(view[value_start:value_end], _STRING_CODECS.get(tag, 'latin-1'), 'replace'))
+        pos = data.find(_CN_OID, value_end, end)
+    return names
+
+
+def _extension_start(data, pos):
+    """
+    Returns where the Extension SEQUENCE whose OID begins at pos starts, or -1.
+
+    Checking for the SEQUENCE header right before the OID rules out matches
+    of the OID bytes inside some other extension's value.
+    """
+    if pos >= 2 and data[pos - 2] == _SEQUENCE and data[pos - 1] < 0x80:
+        return pos - 2
+    if pos >= 3 and data[pos - 3] == _SEQUENCE and data[pos - 2] == 0x81:
+        return pos - 3
+    if pos >= 4 and data[pos - 4] == _SEQUENCE and data[pos - 3] == 0x82:
+        return pos - 4
+    return -1
+
+
+def _san_dns_names(data, view, start, end):
+    """Returns the dNSName entries from the Extensions in data[start:end]."""
+    # Each extension is a SEQUENCE { OID, critical BOOLEAN OPTIONAL, OCTET STRING }.
+    # Searching for the SAN OID is much cheaper than walking every extension.
+    pos = data.find(_SAN_OID, start, end)
+    while pos != -1:
+        ext_start = _extension_start(data, pos)
+        if ext_start != -1:
+            break
+        pos = data.find(_SAN_OID, pos + 1, end)
+    else:
+        return []
+    ext_end = _expect(data, ext_start, end, _SEQUENCE)[1]
+
+    tag, value_start, value_end = _tlv(data, pos + len(_SAN_OID), ext_end)
+    if tag != _OCTET_STRING:
+        # Skip the optional critical BOOLEAN
+        tag, value_start, value_end = _tlv(data, value_end, ext_end)
+    pos, names_end = _expect(data, value_start, value_end, _SEQUENCE)
+
+    # This loop runs once per SAN entry, so the common short-form length is
+    # decoded inline rather than through _tlv.
+    names = []
+    while pos < names_end:
+        if pos + 2 > names_end:
+            raise CTParseError("Truncated DER element")
+        tag = data[pos]
+        length = data[pos + 1]
+        if length < 0x80:
+            name_start = pos + 2
+            pos = name_start + length
+            if pos > names_end:
+                raise CTParseError("DER element runs past its container")
+        else:
+            tag, name_start, pos = _tlv(data, pos, names_end)
+        if tag == _DNS_NAME:
+            names.append(str(view[name_start:pos], 'ascii', 'replace'))
+    return names
+
+
+def parse_tbs_certificate(data, start, end):
+    """Returns (common_names, dns_names) from the TBSCertificate in data[start:end]."""
+    view = memoryview(data)
+    pos, end = _expect(data, start, end, _SEQUENCE)
+    tag, _, stop = _tlv(data, pos, end)
+    if tag == _VERSION:
+        pos = stop
+    # serialNumber, signature, issuer, validity
+    for _ in range(4):
+        pos = _tlv(data, pos, end)[2]
+    subject_start, subject_end = _expect(data, pos, end, _SEQUENCE)
+    # subjectPublicKeyInfo
+    pos = _tlv(data, subject_end, end)[2]
+
+    common_names = _common_names(data, view, subject_start, subject_end)
+    dns_names = []
+    while pos < end:
+        tag, value_start, value_end = _tlv(data, pos, end)
+        if tag == _EXTENSIONS:
+            extensions_start, extensions_end = _expect(data, value_start, value_end, _SEQUENCE)
+            dns_names = _san_dns_names(data, view, extensions_start, extensions_end)
+        pos = value_end
+    return common_names, dns_names
+
+
+def parse_leaf(leaf_input):
+    """
+    Decodes a MerkleTreeLeaf.
+
+    Args:
+        leaf_input (str or bytes): The base64 leaf_input from get-entries, or
+                                   the already decoded leaf bytes.
+
+    Returns:
+        Leaf: The entry's timestamp, type, subject CNs and SAN dNSNames.
+
+    Raises:
+        CTParseError: If the leaf is not a well-formed v1 timestamped entry.
+    """
+    data = base64.b64decode(leaf_input) if isinstance(leaf_input, str) else leaf_input
+    end = len(data)
+    if end < 15 or data[0] != 0 or data[1] != 0:
+        raise CTParseError("Not a v1 timestamped_entry MerkleTreeLeaf")
+
+    timestamp = int.from_bytes(data[2:10], 'big')
+    entry_type = (data[10] << 8) | data[11]
+    pos = 12
+    if entry_type == X509_ENTRY:
+        length = int.from_bytes(data[pos:pos + 3], 'big')
+        cert_start, cert_end = _expect(data, pos + 3, min(end, pos + 3 + length), _SEQUENCE)
+        common_names, dns_names = parse_tbs_certificate(data, cert_start, cert_end)
+    elif entry_type == PRECERT_ENTRY:
+        pos += 32  # issuer_key_hash
+        length = int.from_bytes(data[pos:pos + 3], 'big')
+        common_names, dns_names = parse_tbs_certificate(data, pos + 3, min(end, pos + 3 + length))
+    else:
+        raise CTParseError(f"Unknown entry type {entry_type}")
+    return Leaf(timestamp, entry_type, common_names, dns_names)
+
+
+def extract_domains(entry):
+    """Returns the set of subject CNs and SAN dNSNames in a get-entries entry."""
+    leaf = parse_leaf(entry['leaf_input'])
+    return set(leaf.common_names) | set(leaf.dns_names)
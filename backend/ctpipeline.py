@@ -0,0 +1,170 @@
+"""
+Checks domains found in CT logs against Web Risk as the scanner emits them.
+
+Hits from ctlogs (iter_ct_log_hits or tail_ct_logs) are deduplicated
+against a bounded seen-set and checked in batches through the same cached
+lookup path /api/scan uses (scanner.lookup_many). Each hit comes out as an
+enriched record with its CT position, the brand that matched and the Web
+Risk verdict.
+
+The stages are joined by bounded queues: when Web Risk checks fall behind,
+the queue in front of them fills up and the CT fetch simply stops being
+pulled, so memory use stays flat however fast the logs can be read.
+
+With tail_ct_logs(checkpoint_markers=True), each batch's CheckpointMarker
+travels through both queues behind that batch's hits and is committed
+only when it reaches the consumer, i.e. after every enriched record before
+it has been delivered. A crash therefore re-reads whatever was still in
+the pipeline instead of losing it.
+"""
+from collections import OrderedDict
+from ctcheckpoint import CheckpointMarker
+from ctfetch import METRICS_HANDLER
+from utils import format_url
+import metrics
+import queue
+import threading
+import time
+import scanner
+
+_DONE = object()
+
+
+class SeenSet:
+    """A set that forgets its least recently seen keys beyond maxsize."""
+
+    def __init__(self, maxsize=1000000):
+        self.maxsize = maxsize
+        self._keys = OrderedDict()
+
+    def add(self, key):
+        """Adds key; returns False if it was already present."""
+        if key in self._keys:
+            self._keys.move_to_end(key)
+            return False
+        self._keys[key] = None
+        if len(self._keys) > self.maxsize:
+            self._keys.popitem(last=False)
+        return True
+
+
+def check_hits(hits, api_key, batch_size=50, batch_wait=1.0, queue_size=1000,
+               concurrency=scanner.BATCH_CONCURRENCY, seen=None):
+    """
+    Yields each new CT hit enriched with its Web Risk verdict.
+
+    Args:
+        hits (iterable): Hit dicts from ctlogs.iter_ct_log_hits or ctlogs.tail_ct_logs,
+                         possibly interleaved with CheckpointMarkers.
+        api_key (str): Web Risk API key.
+        batch_size (int): Domains checked per batch.
+        batch_wait (float): Seconds to wait for a batch to fill before checking
+                            what has arrived so far.
+        queue_size (int): Capacity of each queue between stages.
+        concurrency (int): Lookups in flight per batch.
+        seen (SeenSet, optional): Shared seen-set, e.g. to dedupe across runs
+                                  of a long-lived process.
+
+    Yields:
+        dict: The hit's fields plus 'url' (the formatted URL that was checked),
+              'scores' in the /api/scan shape, 'threatTypes' found, and 'error'
+              when the lookup failed.
+    """
+    seen = SeenSet() if seen is None else seen
+    pending = queue.Queue(maxsize=queue_size)
+    results = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors = []
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for hit in hits:
+                if isinstance(hit, CheckpointMarker):
+                    if not put(pending, hit):
+                        return
+                    continue
+                # Wildcard certificates cover the parent domain; check that instead
+                domain = hit['domain'].lower()
+                if domain.startswith('*.'):
+                    domain = domain[2:]
+                if seen.add((domain, hit.get('brand'))) and not put(pending, (domain, hit)):
+                    return
+        except Exception as e:
+            errors.append(e)
+        finally:
+            put(pending, _DONE)
+
+    def check():
+        metrics.set_handler(METRICS_HANDLER)  # Time the Web Risk lookups as part of the CT scan
+        try:
+            finished = False
+            while not finished and not stop.is_set():
+                batch, markers = [], []
+                deadline = time.monotonic() + batch_wait
+                while len(batch) < batch_size:
+                    try:
+                        item = pending.get(timeout=max(0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                    if item is _DONE:
+                        finished = True
+                        break
+                    if isinstance(item, CheckpointMarker):
+                        markers.append(item)
+                    else:
+                        batch.append(item)
+                # Markers go out after the whole batch: later than needed is safe, earlier is not
+                for record in _check_batch(batch, api_key, concurrency) if batch else ():
+                    if not put(results, record):
+                        return
+                for marker in markers:
+                    if not put(results, marker):
+                        return
+        except Exception as e:
+            errors.append(e)
+        finally:
+            put(results, _DONE)
+
+    threads = [threading.Thread(target=produce, name='ct-pipeline-produce', daemon=True),
+               threading.Thread(target=check, name='ct-pipeline-check', daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            record = results.get()
+            if record is _DONE:
+                break
+            if isinstance(record, CheckpointMarker):
+                # The consumer has handled every record before this one
+                record.commit()
+                continue
+            yield record
+        if errors:
+            raise errors[0]
+    finally:
+        stop.set()
+
+
+def _check_batch(batch, api_key, concurrency):
+    by_url = {}
+    for domain, hit in batch:
+        by_url.setdefault(format_url(domain), []).append(hit)
+
+    for url, response_data, error in scanner.lookup_many(list(by_url), api_key, concurrency):
+        for hit in by_url[url]:
+            record = dict(hit, url=url)
+            if error is not None:
+                record['error'] = str(error)
+            else:
+                record['scores'] = scanner.build_scores(response_data)
+                record['threatTypes'] = (response_data.get('threat') or {}).get('threatTypes', [])
+            yield record
@@ -0,0 +1,66 @@
+"""
+Sampled, structured logging for the backend.
+
+Each record is written to stderr as one JSON object with "severity" and
+"message" fields (which Cloud Logging picks up as the entry's severity and
+summary), the logger name, and any fields passed through `extra`:
+
+    logger.info("Scanned URL", extra={'url': formatted_url, 'threat_types': types})
+
+Records below WARNING are sampled: only LOG_SAMPLE_RATE of them are written,
+each carrying the rate as "sample_rate" so counts can be scaled back up.
+Warnings and errors are always written. Latency belongs in metrics.py, not
+in per-request log lines.
+"""
+from datetime import datetime, timezone
+import json
+import logging
+import os
+import random
+import sys
+
+LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '0.1'))
+
+# Attributes every LogRecord has; anything else on a record came from `extra`
+_STANDARD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.rate >= 1:
+            return True
+        if random.random() >= self.rate:
+            return False
+        record.sample_rate = self.rate
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'severity': record.levelname,
+            'message': record.getMessage(),
+            'logger': record.name,
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat().replace('+00:00', 'Z'),
+        }
+        entry.update((k, v) for k, v in vars(record).items() if k not in _STANDARD_ATTRIBUTES)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure(level=LEVEL, sample_rate=SAMPLE_RATE):
+    """Sends the root logger's records through the sampler and the JSON formatter (once per process)."""
+    root = logging.getLogger()
+    if any(isinstance(h.formatter, JsonFormatter) for h in root.handlers):
+        return
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter())
+    handler.addFilter(SamplingFilter(sample_rate))
+    root.addHandler(handler)
+    root.setLevel(level)
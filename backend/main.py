@@ -1,21 +1,44 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
-from urllib.parse import urlencode
-from google.auth.transport.requests import AuthorizedSession
 from datetime import datetime
 from utils import format_url, validate_submission_evidence
-import google.auth
-import logging
+import clients
+import ctindex
+import hmac
+import json
+import logconfig
+import metrics
+import oppoller
 import os  # We need this for environment variables
 import requests  # This is used in the scan_url function
+import scanner
+import submitqueue
+import threading
+import threatlists
+import time
+import urlcanon
 
 
 app = Flask(__name__)
-CORS(app, origins="https://tamw-webrisk-demo.uc.r.appspot.com")
-# Configure logging to help us debug issues
-logging.basicConfig(level=logging.DEBUG)
+CORS_ORIGIN = "https://tamw-webrisk-demo.uc.r.appspot.com"
+CORS(app, origins=CORS_ORIGIN)
+# Sampled JSON logs (see logconfig.py); configured before app.logger is first used
+logconfig.configure()
 logger = app.logger
 
+@app.before_request
+def start_timing():
+    g.request_started = time.perf_counter()
+    metrics.set_handler(request.endpoint or 'unmatched')
+
+@app.after_request
+def record_timing(response):
+    started = g.get('request_started')
+    if started is not None:
+        metrics.observe_request(request.endpoint or 'unmatched', response.status_code,
+                                time.perf_counter() - started)
+    return response
+
 # --- Health Check Endpoint ---
 @app.route('/_ah/health')
 def health_check():
@@ -26,21 +49,26 @@ def health_check():
 @app.route('/_ah/warmup')
 def warmup():
     """App Engine warmup handler. See https://cloud.google.com/appengine/docs/standard/python3/configuring-warmup-requests."""
-    # This is where you could initialize database connections, load caches, etc.
-    # For now, a simple success response is all that's needed.
+    # Discover credentials and open pooled connections before real traffic arrives
+    clients.prime(threatlists.API_ROOT)
+    # Start syncing the local threat lists so scans can be answered locally sooner
+    api_key = os.getenv('WEBRISK_API_KEY')
+    if api_key:
+        threatlists.get_database(api_key)
+    # Resume dispatching submissions left in the queue by a previous instance (if there is a queue)
+    submitqueue.get_queue()
     return '', 200, {}
 
 @app.route('/api/scan', methods=['POST'])
 def scan_url():
-    logger.debug("Received scan request")
     data = request.json
     raw_url = data.get('url')
     if not raw_url:
         logger.error("No URL provided in request")
         return jsonify({'error': 'URL is required'}), 400
 
-    formatted_url = format_url(raw_url) # Use your formatting function
-    logger.debug(f"Formatted URL for checking: {formatted_url}")
+    with metrics.stage('format'):
+        formatted_url = format_url(raw_url) # Use your formatting function
 
     try:
         api_key = os.getenv('WEBRISK_API_KEY')
@@ -48,56 +76,16 @@ def scan_url():
             logger.error("Missing WEBRISK_API_KEY environment variable")
             return jsonify({'error': 'Server configuration error: API key missing'}), 500
 
-        threat_types = ["MALWARE", "SOCIAL_ENGINEERING", "UNWANTED_SOFTWARE"]
-
-        # --- Use Web Risk API v1 uris.search ---
-        search_params = {
-            'key': api_key,
-            'uri': formatted_url,
-            'threatTypes': threat_types
-        }
-        query_string = urlencode(search_params, doseq=True) # Encode params for GET request
-        search_url = f"https://webrisk.googleapis.com/v1/uris:search?{query_string}"
-
-        logger.debug(f"Calling Web Risk API v1: GET {search_url}")
-
-        response = requests.get(search_url) # Use GET request
-
-        logger.debug(f"Web Risk API Response Status: {response.status_code}")
-        logger.debug(f"Web Risk API Response Body: {response.text}")
+        response_data = scanner.lookup(formatted_url, api_key)
 
-        response.raise_for_status() # Raise exception for 4xx/5xx errors from Google
+        found_threat = response_data.get('threat') or {}
+        logger.info("Scanned URL", extra={'url': formatted_url, 'threat_types': found_threat.get('threatTypes', [])})
 
-        # Process the response from uris.search
-        response_data = response.json() if response.text else {} # Handle potentially empty response body if no threat
-
-        # Adapt response for frontend - uris.search returns a 'threat' object if found
-        scores = []
-        found_threat = response_data.get('threat')
-
-        if found_threat:
-            found_threat_types = found_threat.get('threatTypes', [])
-            logger.info(f"Threat found for {formatted_url}: {found_threat_types}")
-            for t_type in threat_types:
-                scores.append({
-                    "threatType": t_type,
-                    # Map found threats to HIGH confidence, others to SAFE
-                    "confidenceLevel": "HIGH" if t_type in found_threat_types else "SAFE"
-                })
-        else:
-            logger.info(f"No threat found for {formatted_url}")
-            # No threat found, all are SAFE
-            for t_type in threat_types:
-                scores.append({
-                    "threatType": t_type,
-                    "confidenceLevel": "SAFE"
-                })
-
-        frontend_response = {"scores": scores}
-        logger.debug(f"Sending response to frontend: {frontend_response}")
-        return jsonify(frontend_response)
+        with metrics.stage('serialize'):
+            return jsonify({"scores": scanner.build_scores(response_data)})
 
     except requests.exceptions.HTTPError as http_err:
+        response = http_err.response
         error_details = response.text # Try to get error details
         logger.error(f"HTTP error calling Web Risk API: {str(http_err)} - Details: {error_details}")
         return jsonify({'error': f"Web Risk API request failed: {response.status_code}", 'details': error_details}), 502 # 502 Bad Gateway
@@ -109,11 +97,146 @@ def scan_url():
         return jsonify({'error': f"Internal server error"}), 500
 
 
+BATCH_MAX_URLS = int(os.getenv('BATCH_SCAN_MAX_URLS', '5000'))
+
+@app.route('/api/scan/batch', methods=['POST'])
+def scan_batch():
+    """
+    Scans a list of URLs in one request.
+
+    Body: {"urls": [...], "concurrency": optional int}. URLs are deduplicated
+    on their canonical form and checked concurrently. Each result carries the
+    formatted URL plus either the same "scores" list /api/scan returns or an
+    "error". Pass ?stream=true (or Accept: application/x-ndjson) to receive
+    results as newline-delimited JSON in completion order.
+    """
+    batch, error = batch_scan_request(request.json or {})
+    if error is not None:
+        body, status = error
+        return jsonify(body), status
+    formatted_urls, concurrency, api_key = batch
+
+    def results():
+        for formatted_url, response_data, error in scanner.lookup_many(formatted_urls, api_key, concurrency):
+            yield batch_result(formatted_url, response_data, error)
+
+    if batch_streamed(request.args.get('stream', ''), request.headers.get('Accept', '')):
+        lines = (json.dumps(result) + '\n' for result in results())
+        return Response(stream_with_context(lines), mimetype='application/x-ndjson')
+
+    by_url = {result['url']: result for result in results()}
+    return jsonify({'results': [by_url[u] for u in formatted_urls]})
+
+def batch_scan_request(data):
+    """
+    Validates a batch scan request body (also used by asgi.py).
+
+    Returns ((formatted_urls, concurrency, api_key), None), or (None, (body,
+    status)) with the error response if the request cannot be served.
+    """
+    raw_urls = data.get('urls')
+    if not isinstance(raw_urls, list) or not raw_urls:
+        logger.error("No URLs provided in batch request")
+        return None, ({'error': 'A non-empty list of URLs is required'}, 400)
+    if len(raw_urls) > BATCH_MAX_URLS:
+        return None, ({'error': f"At most {BATCH_MAX_URLS} URLs can be scanned per batch"}, 400)
+
+    api_key = os.getenv('WEBRISK_API_KEY')
+    if not api_key:
+        logger.error("Missing WEBRISK_API_KEY environment variable")
+        return None, ({'error': 'Server configuration error: API key missing'}, 500)
+
+    # Dedupe on the canonical form, keeping the first spelling of each URL
+    by_key = {}
+    for u in raw_urls:
+        if isinstance(u, str) and u.strip():
+            formatted_url = format_url(u)
+            by_key.setdefault(urlcanon.lookup_key(formatted_url), formatted_url)
+    formatted_urls = list(by_key.values())
+    try:
+        concurrency = min(int(data.get('concurrency') or scanner.BATCH_CONCURRENCY), scanner.BATCH_CONCURRENCY)
+    except (TypeError, ValueError):
+        return None, ({'error': 'concurrency must be an integer'}, 400)
+    logger.info("Batch scan", extra={'urls': len(formatted_urls), 'concurrency': concurrency})
+    return (formatted_urls, concurrency, api_key), None
+
+def batch_streamed(stream_param, accept):
+    """Whether a batch scan asked for newline-delimited JSON (?stream=true or Accept: application/x-ndjson)."""
+    return stream_param.lower() in ('1', 'true') or 'application/x-ndjson' in accept
+
+def batch_result(formatted_url, response_data, error):
+    """One URL's entry in a batch scan response."""
+    if error is not None:
+        return {'url': formatted_url, **_batch_error(error)}
+    return {'url': formatted_url, 'scores': scanner.build_scores(response_data)}
+
+def _batch_error(error):
+    """Maps a lookup failure to the error body (and status) scan_url would return."""
+    if isinstance(error, requests.exceptions.HTTPError):
+        return {'error': f"Web Risk API request failed: {error.response.status_code}", 'status': 502}
+    if isinstance(error, requests.exceptions.RequestException):
+        return {'error': f"Could not connect to Web Risk API: {str(error)}", 'status': 504}
+    logger.error(f"Unexpected error in scan_batch: {str(error)}")
+    return {'error': "Internal server error", 'status': 500}
+
+
+@app.route('/api/scan/cache', methods=['GET'])
+def scan_cache_stats():
+    """Hit, miss and eviction counters for the scan result cache."""
+    return jsonify(scanner.result_cache.stats())
+
+
+CT_SEARCH_MAX_LIMIT = 1000
+
+@app.route('/api/ct/search', methods=['GET'])
+def search_ct_index():
+    """
+    Searches the local index of domains seen in CT logs.
+
+    Query: q (required), mode=substring (default; domains containing q) or
+    registrable (every domain under q's registrable domain), and limit.
+    Results are newest first, each with the log and entry index the domain
+    was first seen at. Answers 503 while there is no index at CT_INDEX_PATH,
+    or it holds no domains yet (see ctindex for how it is built and deployed).
+    """
+    query = request.args.get('q', '').strip()
+    mode = request.args.get('mode', 'substring')
+    if not query:
+        return jsonify({'error': 'A query (q) is required'}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', 100)), 1), CT_SEARCH_MAX_LIMIT)
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+
+    index = ctindex.get_index()
+    if index is None or index.empty():
+        return jsonify({'error': 'The CT domain index is not available'}), 503
+    try:
+        if mode == 'substring':
+            results = index.search_substring(query, limit)
+        elif mode == 'registrable':
+            results = index.search_registrable(query, limit)
+        else:
+            return jsonify({'error': "mode must be 'substring' or 'registrable'"}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'query': query, 'mode': mode, 'results': results})
+
+
 @app.route('/api/submit', methods=['POST'])
 def submit_url():
-    logger.debug("Received submission request")
+    body, status = queue_submission(request.json)
+    with metrics.stage('serialize'):
+        return jsonify(body), status
+
+def queue_submission(data):
+    """
+    Validates a submission request and queues it for uris:submit.
+
+    Shared by submit_url and the async handler in asgi.py. Returns the
+    response body and status code.
+    """
     try:
-        data = request.json
         url = data.get('url')
         evidence = data.get('evidence')
         abuse_type = data.get('abuseType')
@@ -122,21 +245,15 @@ def submit_url():
 
         if not all([url, evidence, abuse_type]):
             logger.error("Missing required fields in submission request")
-            return jsonify({'error': 'Missing required fields'}), 400
+            return {'error': 'Missing required fields'}, 400
 
-        formatted_url = format_url(url)
-        logger.debug(f"Formatted URL for submission: {formatted_url}")
+        with metrics.stage('format'):
+            formatted_url = format_url(url)
         
         project_number = os.getenv('GOOGLE_CLOUD_PROJECT_NUMBER')
         if not project_number:
             logger.error("Missing GOOGLE_CLOUD_PROJECT_NUMBER environment variable")
-            return jsonify({'error': 'Project configuration missing'}), 500
-
-        credentials, _ = google.auth.default(
-            scopes=['https://www.googleapis.com/auth/cloud-platform']
-        )
-        authed_session = AuthorizedSession(credentials)
-        logger.debug("Successfully obtained Google Cloud credentials")
+            return {'error': 'Project configuration missing'}, 500
 
         submission_request = {
             "submission": {
@@ -157,81 +274,247 @@ def submit_url():
                 "regionCodes": region_codes
             }
         }
-        
-        logger.debug(f"Request body: {submission_request}")
-        
-        response = authed_session.post(
-            f"https://webrisk.googleapis.com/v1/projects/{project_number}/uris:submit",
-            json=submission_request,
-            headers={"Content-Type": "application/json; charset=utf-8"}
-        )
-        
-        logger.debug(f"Submission API response status: {response.status_code}")
-        logger.debug(f"Response body: {response.text}")
-        
-        response.raise_for_status()
-        submission_data = response.json()
-        
-        return jsonify({
-        'operation': submission_data.get('name'),
-        'status': 'submitted',
+
+        queue = submitqueue.get_queue()
+        if queue is None:
+            # No durable queue configured (SUBMIT_QUEUE_PATH): a job in one would be lost on restart
+            return submit_now(submission_request)
+
+        # Queued and sent by the dispatcher in submitqueue.py, so a slow or
+        # throttled uris:submit never holds up this request
+        with metrics.stage('enqueue'):
+            operation, merged = queue.enqueue(formatted_url, submission_request)
+        oppoller.get_poller().watch(operation)
+        logger.info("Queued submission", extra={'url': formatted_url, 'operation': operation, 'merged': merged})
+
+        return {
+        'operation': operation,
+        'status': 'queued',
         'timestamp': datetime.utcnow().replace(microsecond=0).isoformat() + 'Z',  # Adding Z to indicate UTC
-        'message': 'URL submitted successfully for review'
-        })
+        'message': 'URL was already queued for review' if merged else 'URL queued for review'
+        }, 202
         
-    except requests.exceptions.HTTPError as http_err:
-        logger.error(f"HTTP error during submission: {str(http_err)}")
-        return jsonify({'error': f"API request failed: {str(http_err)}"}), response.status_code
     except Exception as e:
         logger.error(f"Unexpected error during submission: {str(e)}")
-        return jsonify({'error': str(e)}), 500
+        return {'error': str(e)}, 500
+
+def submit_now(submission_request):
+    """Sends a submission to uris:submit within the request; returns the response body and status code."""
+    try:
+        with metrics.stage('upstream'):
+            response = submitqueue.post_submission(json.dumps(submission_request))
+        response.raise_for_status()
+        with metrics.stage('parse'):
+            operation = response.json().get('name')
+    except requests.exceptions.HTTPError as http_err:
+        logger.error(f"HTTP error during submission: {http_err.response.status_code} {http_err.response.text[:500]}")
+        return {'error': f"API request failed: {http_err.response.status_code}"}, http_err.response.status_code
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Could not connect to Web Risk API: {str(e)}")
+        return {'error': f"Could not connect to Web Risk API: {str(e)}"}, 504
+    if operation:
+        oppoller.get_poller().watch(operation.rsplit('/', 1)[-1])
+    logger.info("Submitted", extra={'url': submission_request['submission']['uri'], 'operation': operation})
+
+    return {
+    'operation': operation,
+    'status': 'submitted',
+    'timestamp': datetime.utcnow().replace(microsecond=0).isoformat() + 'Z',  # Adding Z to indicate UTC
+    'message': 'URL submitted successfully for review'
+    }, 200
+
+@app.route('/api/submit/queue', methods=['GET'])
+def submit_queue_stats():
+    """Job counts by state for the submission queue."""
+    queue = submitqueue.get_queue()
+    if queue is None:
+        return jsonify({'error': 'The submission queue is off (SUBMIT_QUEUE_PATH is not set)'}), 404
+    return jsonify(queue.stats())
+
+
+OPERATION_FIRST_POLL_WAIT = clients.REQUEST_TIMEOUT
+LONG_POLL_MAX_WAIT = 60
+SSE_HEARTBEAT_INTERVAL = 15
+SSE_MAX_OPERATIONS = 100
+# Streams end after this long; EventSource reconnects and resumes from its Last-Event-ID
+SSE_MAX_STREAM_SECONDS = 45
+SSE_RETRY_MS = 2000
+SSE_BUSY_RETRY_MS = 30000
+# Long-polls, first polls and event streams each hold a worker thread while
+# they wait. At most this many wait at once, so scans always have threads
+# left (app.yaml runs 16); past it they answer with what is known right away.
+MAX_WAITING_REQUESTS = int(os.getenv('MAX_WAITING_REQUESTS', '8'))
+waiting_slots = threading.BoundedSemaphore(MAX_WAITING_REQUESTS)
 
 @app.route('/api/submission/<path:operation>', methods=['GET'])
 def check_submission_status(operation):
     """
     Checks the status of a URL submission using the full operation path.
+
+    Served from the shared operation poller rather than a fresh upstream
+    call. For long-polling, pass the version from the previous response and
+    ?wait=<seconds>: the request returns as soon as the status changes, or
+    with the unchanged status once the wait is over. When MAX_WAITING_REQUESTS
+    requests are already waiting, the current status is returned at once
+    (503 if there is none yet).
     """
+    body, status = submission_status(operation, request.args.get('wait', 0), request.args.get('version', 0))
+    with metrics.stage('serialize'):
+        return jsonify(body), status
+
+def submission_status(operation, wait=0, version=0):
+    """Returns the response body and status code for check_submission_status (also used by asgi.py)."""
     try:
-        # Use the actual project number instead of project ID
-        project_number = os.getenv('GOOGLE_CLOUD_PROJECT_NUMBER')  # Add this environment variable
-        if not project_number:
-            logger.error("Missing GOOGLE_CLOUD_PROJECT_NUMBER environment variable")
-            return jsonify({'error': 'Project configuration missing'}), 500
+        wait = min(float(wait), LONG_POLL_MAX_WAIT)
+        version = int(version)
+    except ValueError:
+        return {'error': 'wait and version must be numbers'}, 400
 
-        credentials, _ = google.auth.default(
-            scopes=['https://www.googleapis.com/auth/cloud-platform']
-        )
-        
-        # Use project number in the URL
-        operations_url = f"https://webrisk.googleapis.com/v1/projects/{project_number}/operations/{operation}"
-        logger.debug(f"Making request to: {operations_url}")
-        
-        authed_session = AuthorizedSession(credentials)
-        response = authed_session.get(operations_url)
-        logger.debug(f"Response status: {response.status_code}")
-        logger.debug(f"Response body: {response.text}")
-        
-        response.raise_for_status()
-        
-        operation_data = response.json()
-        logger.debug(f"Operation response: {operation_data}")
-        
-        # Extract state from metadata if present
-        status = 'PENDING'
-        if operation_data.get('done'):
-            metadata = operation_data.get('metadata', {})
-            if isinstance(metadata, dict):
-                status = metadata.get('state', 'SUCCEEDED' if operation_data.get('done') else 'PENDING')
-        
-        return jsonify({
-            'operation': operation_data.get('name'),
-            'status': status,
-            'details': operation_data
-        })
-        
-    except Exception as e:
-        logger.error(f"Error checking submission status: {str(e)}")
-        return jsonify({'error': str(e)}), 500
+    operation = operation.rsplit('/', 1)[-1] # Accept the full operation name too
+    poller = oppoller.get_poller()
+    held = waiting_slots.acquire(blocking=False)
+    try:
+        with metrics.stage('wait'):
+            if not held:
+                snapshot = poller.snapshot(operation)
+            elif wait > 0 and version > 0:
+                changed = poller.wait({operation: version}, wait)
+                snapshot = changed[0] if changed else poller.snapshot(operation)
+            else:
+                snapshot = poller.snapshot(operation, timeout=OPERATION_FIRST_POLL_WAIT)
+    finally:
+        if held:
+            waiting_slots.release()
+    return status_response(snapshot, busy=not held)
+
+def status_response(snapshot, busy=False):
+    """
+    Returns the response body and status code for an operation snapshot.
+
+    busy means the request did not wait for a first poll because too many
+    were waiting already.
+    """
+    if snapshot['details'] is None:
+        if snapshot['error']:
+            return {'error': snapshot['error']}, 500
+        if busy:
+            return {'error': 'Too many requests are waiting on operation status; retry shortly'}, 503
+        return {'error': 'Timed out waiting for operation status'}, 504
+
+    return {
+        'operation': snapshot['operation'],
+        'status': snapshot['status'],
+        'details': snapshot['details'],
+        'version': snapshot['version'],
+    }, 200
+
+@app.route('/api/submissions/events', methods=['GET'])
+def submission_events():
+    """
+    Streams status changes of submissions as Server-Sent Events.
+
+    Query: operations, a comma-separated list of operation ids. A "status"
+    event carries an operation's state (as /api/submission returns it, plus
+    "id", "done" and "error") when it is first known and whenever it
+    changes. An "end" event follows once every operation is done, at which
+    point the client should close the EventSource rather than reconnect.
+
+    A stream ends after SSE_MAX_STREAM_SECONDS (or straight after the
+    current states when MAX_WAITING_REQUESTS requests are already waiting)
+    and EventSource reconnects. Each event's id records the versions sent so
+    far, so the reconnected stream only sends what changed in between.
+
+    The bundled frontend long-polls /api/submission instead: App Engine
+    standard buffers responses, so events would arrive in bursts. This is for
+    clients of a deployment that streams (asgi.py, or gunicorn elsewhere).
+    """
+    operations = sse_operations(request.args.get('operations', ''))
+    if not operations:
+        return jsonify({'error': 'At least one operation is required'}), 400
+    if len(operations) > SSE_MAX_OPERATIONS:
+        return jsonify({'error': f"At most {SSE_MAX_OPERATIONS} operations can be watched per stream"}), 400
+
+    poller = oppoller.get_poller()
+    versions, sent = sse_resume(operations, request.headers.get('Last-Event-ID'), poller)
+    held = waiting_slots.acquire(blocking=False)
+
+    def events():
+        yield f"retry: {SSE_RETRY_MS if held else SSE_BUSY_RETRY_MS}\n\n"
+        deadline = time.monotonic() + (SSE_MAX_STREAM_SECONDS if held else 0)
+        while versions:
+            remaining = deadline - time.monotonic()
+            changed = poller.wait(versions, min(SSE_HEARTBEAT_INTERVAL, max(0, remaining)))
+            for snapshot in changed:
+                yield sse_status_event(snapshot, versions, sent)
+            if not changed:
+                if remaining <= 0:
+                    return
+                yield ': keep-alive\n\n'
+        yield 'event: end\ndata: {}\n\n'
+
+    response = Response(stream_with_context(events()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    if held:
+        response.call_on_close(waiting_slots.release)
+    return response
+
+def sse_operations(param):
+    """Operation ids from a comma-separated list of ids or full operation names, deduplicated."""
+    return list(dict.fromkeys(op.rsplit('/', 1)[-1] for op in param.split(',') if op))
+
+def sse_resume(operations, last_event_id, poller):
+    """
+    Works out where a (re)connected event stream starts.
+
+    Returns (versions, sent): the version of each operation still to be
+    watched, and the versions already sent, per the stream's Last-Event-ID.
+    Operations that were done when their last event was sent are dropped.
+    """
+    sent = {}
+    for item in (last_event_id or '').split(','):
+        operation, _, version = item.rpartition(':')
+        if operation in operations and version.isdigit():
+            sent[operation] = int(version)
+    versions = {}
+    for operation in operations:
+        if sent.get(operation):
+            snapshot = poller.snapshot(operation)
+            if snapshot['done'] and snapshot['version'] <= sent[operation]:
+                continue
+        versions[operation] = sent.get(operation, 0)
+    return versions, sent
+
+def sse_status_event(snapshot, versions, sent):
+    """Formats a "status" event and records it as sent; done operations stop being watched."""
+    versions[snapshot['id']] = sent[snapshot['id']] = snapshot['version']
+    if snapshot['done']:
+        del versions[snapshot['id']]
+    event_id = ','.join(f"{operation}:{version}" for operation, version in sent.items())
+    return f"id: {event_id}\nevent: status\ndata: {json.dumps(snapshot)}\n\n"
+
+# Bearer token Prometheus must send to read /api/metrics; metrics are not served without one
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Request and stage latency histograms plus cache and poller counters, for Prometheus to scrape.
+
+    Lives under /api/ so dispatch.yaml routes it to this service. Requires
+    "Authorization: Bearer <METRICS_TOKEN>"; 404 when METRICS_TOKEN is unset.
+    """
+    if not METRICS_TOKEN:
+        return jsonify({'error': 'Not found'}), 404
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}"):
+        return jsonify({'error': 'A valid metrics token is required'}), 401, {'WWW-Authenticate': 'Bearer'}
+    cache = scanner.result_cache.stats()
+    poller = oppoller.get_poller().stats()
+    return Response(metrics.render(
+        counters={f'scan_cache_{k}_total': cache[k] for k in ('hits', 'misses', 'coalesced', 'evictions', 'expirations')}
+        | {'operation_poll_upstream_requests_total': poller['upstream_requests']},
+        gauges={'scan_cache_size': cache['size'], 'operations_tracked': poller['tracked'],
+                'operations_pending': poller['pending']},
+    ), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
     app.run(debug=True)
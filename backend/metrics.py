@@ -0,0 +1,139 @@
+"""
+Latency histograms for the backend's hot paths, in the Prometheus text format.
+
+Every request is timed as a whole (request_duration_seconds, by handler and
+status code) and in stages (stage_duration_seconds, by handler and stage):
+"format" for URL formatting, "upstream" for the call to Web Risk or a CT
+log, "parse" for decoding its response and "serialize" for encoding ours,
+plus a few stages particular to one path (local threat list lookups,
+queueing a submission, waiting on the operation poller).
+
+Stages are counted against the handler of the request being served (see
+handling), so the uris:search call scanner.py makes shows up under scan_url
+or scan_batch depending on who asked. Work done outside a request - the
+operation poller, the submission dispatcher, the CT scanner - names its own
+handler.
+
+Metrics are kept per process; with several gunicorn workers each one serves
+its own from /api/metrics. Set METRICS_TOKEN on the backend and have
+Prometheus scrape https://<app host>/api/metrics with that token as its
+bearer token (authorization: {credentials: ...} in the scrape config).
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+import contextvars
+import threading
+import time
+
+PREFIX = 'webrisk_'
+# Upper bounds in seconds, from sub-millisecond local work up to a long-poll
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_handler = contextvars.ContextVar('metrics_handler', default='background')
+_lock = threading.Lock()
+_request_durations = {}  # (handler, status) -> _Histogram
+_stage_durations = {}    # (handler, stage) -> _Histogram
+
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # the last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _observe(histograms, key, seconds):
+    with _lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = _Histogram()
+        histogram.observe(seconds)
+
+
+def current_handler():
+    return _handler.get()
+
+
+@contextmanager
+def handling(handler):
+    """Attributes the stages timed inside the block (in this thread or task) to handler."""
+    token = _handler.set(handler)
+    try:
+        yield
+    finally:
+        _handler.reset(token)
+
+
+def set_handler(handler):
+    """Like handling, for code that cannot wrap the request in a block (e.g. Flask's before_request)."""
+    _handler.set(handler)
+
+
+def observe_request(handler, status, seconds):
+    _observe(_request_durations, (handler, str(status)), seconds)
+
+
+def observe_stage(stage, seconds, handler=None):
+    _observe(_stage_durations, (handler or _handler.get(), stage), seconds)
+
+
+@contextmanager
+def stage(name, handler=None):
+    """Times the block as stage name of handler (by default, the current request's)."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - started, handler)
+
+
+def _labels(**labels):
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in labels.values())
+    return ','.join(f'{k}="{v}"' for k, v in zip(labels, escaped))
+
+
+def _render_histograms(lines, name, help_text, histograms, label_names):
+    lines.append(f'# HELP {PREFIX}{name} {help_text}')
+    lines.append(f'# TYPE {PREFIX}{name} histogram')
+    for key, histogram in sorted(histograms.items()):
+        labels = _labels(**dict(zip(label_names, key)))
+        cumulative = 0
+        for bound, count in zip((*BUCKETS, '+Inf'), histogram.counts):
+            cumulative += count
+            lines.append(f'{PREFIX}{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{PREFIX}{name}_sum{{{labels}}} {histogram.sum:.6f}')
+        lines.append(f'{PREFIX}{name}_count{{{labels}}} {histogram.count}')
+
+
+def render(counters=None, gauges=None):
+    """
+    Returns every metric in the Prometheus text exposition format.
+
+    Args:
+        counters (dict, optional): Extra monotonic counts to include, name -> value.
+        gauges (dict, optional): Extra point-in-time values to include, name -> value.
+    """
+    with _lock:
+        lines = []
+        _render_histograms(lines, 'request_duration_seconds', 'Time to handle a request, by handler and status.',
+                           _request_durations, ('handler', 'status'))
+        _render_histograms(lines, 'stage_duration_seconds', 'Time spent in each stage of a handler.',
+                           _stage_durations, ('handler', 'stage'))
+    for kind, values in (('counter', counters or {}), ('gauge', gauges or {})):
+        for name, value in values.items():
+            lines.append(f'# TYPE {PREFIX}{name} {kind}')
+            lines.append(f'{PREFIX}{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    """Forgets every observation (e.g. between benchmark runs in one process)."""
+    with _lock:
+        _request_durations.clear()
+        _stage_durations.clear()
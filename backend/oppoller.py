@@ -0,0 +1,294 @@
+"""
+Shared polling of pending Web Risk submission operations.
+
+Every operation a client asks about is tracked here and refreshed upstream
+by one background thread on a shared schedule, however many browser tabs
+are watching it. An operation whose state has not changed is polled less
+and less often (OPERATION_POLL_MIN_INTERVAL doubling up to
+OPERATION_POLL_MAX_INTERVAL); a state change resets the interval. Finished
+operations are no longer polled, nor are ones upstream rejects with a client
+error (an unknown or foreign operation id), and operations nobody has asked
+about for OPERATION_IDLE_TIMEOUT seconds are forgotten.
+
+Clients read the cached state, or block in wait() until it changes, which
+is what the long-poll and Server-Sent Events endpoints in main.py are built
+on (asgi.py awaits wait_async instead, which holds no thread). Each gunicorn
+worker has its own poller.
+
+Ids of queued submissions ("job-<token>", see submitqueue.py) are tracked the
+same way: they resolve to the job's state until it has been submitted and
+to its Web Risk operation after. Reading a job is a local database read, so
+jobs still in the queue are re-read every OPERATION_POLL_MIN_INTERVAL.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import clients
+import logging
+import metrics
+import os
+import threading
+import time
+import requests
+import submitqueue
+import threatlists
+
+logger = logging.getLogger(__name__)
+
+MIN_INTERVAL = float(os.getenv('OPERATION_POLL_MIN_INTERVAL', '5'))
+MAX_INTERVAL = float(os.getenv('OPERATION_POLL_MAX_INTERVAL', '600'))
+IDLE_TIMEOUT = float(os.getenv('OPERATION_IDLE_TIMEOUT', '3600'))
+POLL_CONCURRENCY = int(os.getenv('OPERATION_POLL_CONCURRENCY', '8'))
+BACKOFF = 2.0
+RETRYABLE_STATUSES = (408, 429)  # The only client errors worth polling again after
+
+
+def operation_status(operation_data):
+    """Maps an operation resource to the status the frontend shows (PENDING until done)."""
+    status = 'PENDING'
+    if operation_data.get('done'):
+        metadata = operation_data.get('metadata', {})
+        if isinstance(metadata, dict):
+            status = metadata.get('state', 'SUCCEEDED')
+    return status
+
+
+def fetch_operation(operation):
+    """Returns a Web Risk operation of this project, or the state of a queued submission job."""
+    if submitqueue.job_id(operation) is not None:
+        queue = submitqueue.get_queue()
+        if queue is None:
+            raise LookupError(f"No submission job {operation}: the submission queue is off")
+        return queue.job_operation(operation, fetch_operation)
+    project_number = os.getenv('GOOGLE_CLOUD_PROJECT_NUMBER')
+    if not project_number:
+        raise RuntimeError("Missing GOOGLE_CLOUD_PROJECT_NUMBER environment variable")
+    operations_url = f"{threatlists.API_ROOT}/projects/{project_number}/operations/{operation}"
+    with metrics.stage('upstream', handler='operation_poll'):
+        response = clients.authed_session().get(operations_url, timeout=clients.REQUEST_TIMEOUT)
+    response.raise_for_status()
+    with metrics.stage('parse', handler='operation_poll'):
+        return response.json()
+
+
+def _is_queued_job(operation, data):
+    """Whether operation is a submission job whose state still comes from the local queue."""
+    return submitqueue.job_id(operation) is not None and (data or {}).get('name') == operation
+
+
+class _Tracked:
+    def __init__(self, now, interval):
+        self.data = None
+        self.error = None
+        self.done = False
+        self.version = 0      # bumped whenever what clients see changes
+        self.interval = interval
+        self.next_poll = now
+        self.last_seen = now
+
+
+class OperationPoller:
+    def __init__(self, fetch=fetch_operation, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL,
+                 idle_timeout=IDLE_TIMEOUT, concurrency=POLL_CONCURRENCY):
+        """
+        Args:
+            fetch (callable): Returns the operation resource for an operation id;
+                              raises on failure.
+            min_interval (float): Seconds between polls of an operation that just changed.
+            max_interval (float): Longest interval backoff grows to.
+            idle_timeout (float): Forget operations nobody has asked about for this long.
+            concurrency (int): Upstream requests in flight per polling round.
+        """
+        self._fetch = fetch
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.idle_timeout = idle_timeout
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='operation-poll')
+        self._tracked = {}
+        self._cond = threading.Condition()
+        self._listeners = set()  # called (under _cond) whenever an operation's version changes
+        self.upstream_requests = 0
+        threading.Thread(target=self._run, name='operation-poller', daemon=True).start()
+
+    def wait(self, versions, timeout):
+        """
+        Blocks until any of the operations has moved past the given version.
+
+        Unknown operations are tracked from now on and polled right away.
+
+        Args:
+            versions (dict): Operation id -> the version the caller last saw
+                             (0 if it has seen none).
+            timeout (float): Longest time to block, in seconds.
+
+        Returns:
+            list: Snapshots (see snapshot) of the operations that changed;
+                  empty on timeout.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                changed = []
+                for operation, version in versions.items():
+                    tracked = self._track(operation, now)
+                    if tracked.version > version:
+                        changed.append(self._snapshot(operation, tracked))
+                if changed or now >= deadline:
+                    return changed
+                self._cond.wait(deadline - now)
+
+    async def wait_async(self, versions, timeout):
+        """Like wait, for callers on an event loop: only the calling task waits, not a thread."""
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+        listener = lambda: loop.call_soon_threadsafe(changed.set)
+        deadline = loop.time() + timeout
+        with self._cond:
+            self._listeners.add(listener)
+        try:
+            while True:
+                changed.clear()  # before checking, so a change made meanwhile is not missed
+                result = self.wait(versions, 0)
+                remaining = deadline - loop.time()
+                if result or remaining <= 0:
+                    return result
+                try:
+                    await asyncio.wait_for(changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._cond:
+                self._listeners.discard(listener)
+
+    def watch(self, operation):
+        """Starts tracking an operation without waiting for its state."""
+        with self._cond:
+            self._track(operation, time.monotonic())
+
+    def snapshot(self, operation, timeout=0):
+        """
+        Returns an operation's latest known state as a dict with 'operation',
+        'status', 'details', 'done', 'error' and 'version'.
+
+        A newly tracked operation has no state yet; timeout is how long to wait
+        for its first poll (status stays PENDING and version 0 if it times out).
+        """
+        changed = self.wait({operation: 0}, timeout)
+        if changed:
+            return changed[0]
+        with self._cond:
+            return self._snapshot(operation, self._track(operation, time.monotonic()))
+
+    def _track(self, operation, now):
+        tracked = self._tracked.get(operation)
+        if tracked is None:
+            tracked = self._tracked[operation] = _Tracked(now, self.min_interval)
+            self._cond.notify_all()
+        tracked.last_seen = now
+        return tracked
+
+    def _snapshot(self, operation, tracked):
+        data = tracked.data or {}
+        return {
+            'operation': data.get('name', operation),
+            'id': operation,
+            'status': operation_status(data),
+            'details': tracked.data,
+            'done': tracked.done,
+            'error': tracked.error,
+            'version': tracked.version,
+        }
+
+    @staticmethod
+    def _visible_state(tracked):
+        data = tracked.data or {}
+        metadata = data.get('metadata')
+        return (data.get('name'), operation_status(data), isinstance(metadata, dict) and metadata.get('state'),
+                tracked.done, tracked.error)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'tracked': len(self._tracked),
+                'pending': sum(1 for t in self._tracked.values() if not t.done),
+                'upstream_requests': self.upstream_requests,
+            }
+
+    def _run(self):
+        while True:
+            try:
+                self._round()
+            except Exception as e:
+                # Never let one bad round stop polling for every client of this worker
+                logger.error(f"Error in operation polling round: {str(e)}")
+                time.sleep(self.min_interval)
+
+    def _round(self):
+        with self._cond:
+            now = time.monotonic()
+            for operation in [op for op, t in self._tracked.items() if now - t.last_seen > self.idle_timeout]:
+                del self._tracked[operation]
+            pending = [(op, t) for op, t in self._tracked.items() if not t.done]
+            due = [op for op, t in pending if t.next_poll <= now]
+            if not due:
+                next_poll = min((t.next_poll for _, t in pending), default=now + self.min_interval)
+                self._cond.wait(max(0.01, next_poll - now))
+                return
+        for operation, result in zip(due, self._executor.map(self._poll, due)):
+            self._update(operation, *result)
+
+    def _poll(self, operation):
+        try:
+            data = self._fetch(operation)
+        except Exception as e:
+            return None, e
+        if not isinstance(data, dict):
+            return None, TypeError(f"Expected an operation object, got {type(data).__name__}")
+        return data, None
+
+    def _update(self, operation, data, error):
+        with self._cond:
+            self.upstream_requests += 1
+            tracked = self._tracked.get(operation)
+            if tracked is None:
+                return
+            before = self._visible_state(tracked)
+            if error is None:
+                tracked.data, tracked.error = data, None
+                tracked.done = bool(data.get('done'))
+            else:
+                logger.error(f"Error polling operation {operation}: {str(error)}")
+                tracked.error = str(error)
+                response = getattr(error, 'response', None)
+                if isinstance(error, LookupError) or (isinstance(error, requests.exceptions.HTTPError)
+                                                      and response is not None
+                                                      and 400 <= response.status_code < 500
+                                                      and response.status_code not in RETRYABLE_STATUSES):
+                    tracked.done = True  # No such operation, or not ours to read; polling again will not help
+
+            changed = self._visible_state(tracked) != before
+            if changed or tracked.version == 0:
+                tracked.version += 1
+                tracked.interval = self.min_interval
+                self._cond.notify_all()
+                for listener in list(self._listeners):
+                    try:
+                        listener()
+                    except RuntimeError:
+                        # Its event loop has closed; nobody is left waiting on it
+                        self._listeners.discard(listener)
+            elif not _is_queued_job(operation, tracked.data):
+                tracked.interval = min(tracked.interval * BACKOFF, self.max_interval)
+            tracked.next_poll = time.monotonic() + tracked.interval
+
+
+_poller = None
+_poller_lock = threading.Lock()
+
+def get_poller():
+    """Returns this process's poller, starting it on first use."""
+    global _poller
+    with _poller_lock:
+        if _poller is None:
+            _poller = OperationPoller()
+    return _poller
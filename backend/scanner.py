@@ -0,0 +1,118 @@
+"""
+The URL lookup path shared by the scan endpoints.
+
+Lookups go through a bounded TTL cache keyed on the canonical URL (see
+urlcanon.lookup_key, so http/https and other spellings share an entry),
+then the local threat lists (see threatlists.py) when they are synced, and
+finally uris:search. Both threat hits and clean results are cached: hits until the
+expireTime Web Risk returns, clean results for SCAN_CACHE_NEGATIVE_TTL.
+"""
+from cache import TTLCache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlencode
+from utils import parse_timestamp
+import clients
+import contextvars
+import logging
+import metrics
+import os
+import time
+import threatlists
+import urlcanon
+
+logger = logging.getLogger(__name__)
+
+THREAT_TYPES = threatlists.THREAT_TYPES
+
+CACHE_SIZE = int(os.getenv('SCAN_CACHE_SIZE', '10000'))
+NEGATIVE_TTL = int(os.getenv('SCAN_CACHE_NEGATIVE_TTL', '300'))
+BATCH_CONCURRENCY = int(os.getenv('BATCH_SCAN_CONCURRENCY', '16'))
+
+result_cache = TTLCache(CACHE_SIZE)
+
+
+def lookup(formatted_url, api_key):
+    """
+    Returns the Web Risk verdict for an already formatted URL.
+
+    The result is shaped like a uris:search response: empty when no threat
+    was found, or {'threat': {'threatTypes': [...], 'expireTime': ...}}.
+    Concurrent lookups of the same uncached URL, however it is spelled,
+    share one upstream call.
+    """
+    return result_cache.get_or_load(urlcanon.lookup_key(formatted_url), lambda: _lookup_uncached(formatted_url, api_key))
+
+
+def lookup_many(formatted_urls, api_key, concurrency=BATCH_CONCURRENCY):
+    """
+    Looks up many formatted URLs concurrently over the pooled session.
+
+    Yields (formatted_url, response_data, error) tuples in completion order;
+    exactly one of response_data and error is None for each URL.
+    """
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix='scan-batch')
+    try:
+        # Each lookup runs in a copy of the caller's context, so its stages count against the caller's handler
+        futures = {executor.submit(contextvars.copy_context().run, lookup, url, api_key): url
+                   for url in formatted_urls}
+        for future in as_completed(futures):
+            error = future.exception()
+            yield futures[future], None if error else future.result(), error
+    finally:
+        # Stops queued lookups early if the consumer goes away mid-batch.
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _lookup_uncached(formatted_url, api_key):
+    database = threatlists.get_database(api_key)
+    if database is not None and database.ready:
+        # Answered from the local threat lists; only prefix matches go upstream
+        with metrics.stage('local'):
+            response_data = database.lookup(formatted_url, api_key)
+    else:
+        response_data = search_uri(formatted_url, api_key)
+
+    return response_data, cache_expiry(response_data)
+
+
+def cache_expiry(response_data):
+    """When a lookup result stops being valid: the threat's expireTime, or NEGATIVE_TTL from now."""
+    found_threat = response_data.get('threat')
+    if found_threat and found_threat.get('expireTime'):
+        return parse_timestamp(found_threat['expireTime'])
+    return time.time() + NEGATIVE_TTL
+
+
+def search_uri_url(formatted_url):
+    """The uris:search request URL for a single URL (the API key goes in a header, see clients.api_key_headers)."""
+    search_params = {
+        'uri': formatted_url,
+        'threatTypes': THREAT_TYPES
+    }
+    query_string = urlencode(search_params, doseq=True) # Encode params for GET request
+    return f"{threatlists.API_ROOT}/uris:search?{query_string}"
+
+
+def search_uri(formatted_url, api_key):
+    """Calls uris:search for a single URL."""
+    search_url = search_uri_url(formatted_url)
+
+    with metrics.stage('upstream'):
+        response = clients.api_session().get(search_url, headers=clients.api_key_headers(api_key),
+                                             timeout=clients.REQUEST_TIMEOUT)
+
+    response.raise_for_status() # Raise exception for 4xx/5xx errors from Google
+
+    # Handle potentially empty response body if no threat
+    with metrics.stage('parse'):
+        return response.json() if response.content else {}
+
+
+def build_scores(response_data):
+    """Adapts a uris:search-shaped response to the scores the frontend expects."""
+    found_threat_types = (response_data.get('threat') or {}).get('threatTypes', [])
+    # Map found threats to HIGH confidence, others to SAFE
+    return [{
+        "threatType": t_type,
+        "confidenceLevel": "HIGH" if t_type in found_threat_types else "SAFE"
+    } for t_type in THREAT_TYPES]
@@ -0,0 +1,191 @@
+"""
+Local stand-ins for the Web Risk API and a CT log, for running the backend offline.
+
+The Web Risk stub serves threatLists:computeDiff, hashes:search and
+uris:search from a small fixture of threat expressions. Start it and point
+the backend at it:
+
+    python stubserver.py --port 8081
+    WEBRISK_API_ROOT=http://localhost:8081/v1 WEBRISK_API_KEY=stub python main.py
+
+The fixture is a JSON object mapping threat types to lists of lookup
+expressions (host plus path, as produced by urlcanon.lookup_expressions).
+
+With --ct it serves an RFC 6962 log instead (get-sth and get-entries), whose
+entries repeat the captured leaves in fixtures/ct_entries.jsonl:
+
+    python stubserver.py --ct --port 8082 --tree-size 100000
+    python ctlogs.py --log http://localhost:8082/ct/v1/get-entries examplecorp
+
+--latency adds a fixed delay to every response of either stub, to stand in
+for the network. bench.py load starts both to load-test the backend.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from urlcanon import lookup_hashes
+import argparse
+import base64
+import hashlib
+import json
+import os
+import time
+
+# Google's public Web Risk test pages.
+DEFAULT_FIXTURE = {
+    "MALWARE": ["testsafebrowsing.appspot.com/s/malware.html"],
+    "SOCIAL_ENGINEERING": ["testsafebrowsing.appspot.com/s/phishing.html"],
+    "UNWANTED_SOFTWARE": ["testsafebrowsing.appspot.com/s/unwanted.html"],
+}
+PREFIX_SIZE = 4
+EXPIRE_TIME = "2099-01-01T00:00:00Z"
+CT_FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'ct_entries.jsonl')
+
+
+class StubWebRisk:
+    """The fixture, indexed the way the Web Risk endpoints need it."""
+
+    def __init__(self, fixture):
+        self.full_hashes = {}
+        for threat_type, expressions in fixture.items():
+            for expression in expressions:
+                full_hash = hashlib.sha256(expression.encode('utf-8')).digest()
+                self.full_hashes.setdefault(full_hash, []).append(threat_type)
+
+    def compute_diff(self, threat_type, version_token):
+        prefixes = sorted({h[:PREFIX_SIZE] for h, types in self.full_hashes.items() if threat_type in types})
+        checksum = hashlib.sha256(b''.join(prefixes)).digest()
+        token = base64.b64encode(checksum[:8]).decode('ascii')
+        response = {
+            'newVersionToken': token,
+            'checksum': {'sha256': base64.b64encode(checksum).decode('ascii')},
+            'recommendedNextDiff': "2099-01-01T00:00:00Z",
+        }
+        if version_token == token:
+            response['responseType'] = 'DIFF'
+        else:
+            response['responseType'] = 'RESET'
+            response['additions'] = {'rawHashes': [{
+                'prefixSize': PREFIX_SIZE,
+                'rawHashes': base64.b64encode(b''.join(prefixes)).decode('ascii'),
+            }]}
+        return response
+
+    def search_hashes(self, prefix, threat_types):
+        threats = [{
+            'threatTypes': [t for t in types if t in threat_types],
+            'hash': base64.b64encode(h).decode('ascii'),
+            'expireTime': EXPIRE_TIME,
+        } for h, types in self.full_hashes.items()
+            if h.startswith(prefix) and any(t in threat_types for t in types)]
+        return {'threats': threats, 'negativeExpireTime': EXPIRE_TIME}
+
+    def search_uri(self, uri, threat_types):
+        found = []
+        for full_hash in lookup_hashes(uri):
+            found.extend(t for t in self.full_hashes.get(full_hash, []) if t in threat_types and t not in found)
+        if not found:
+            return {}
+        return {'threat': {'threatTypes': found, 'expireTime': EXPIRE_TIME}}
+
+
+class StubCTLog:
+    """A CT log of tree_size entries that cycles through a list of captured ones."""
+
+    def __init__(self, entries, tree_size, page_size=256, start_time=1700000000000):
+        self.entries = entries
+        self.tree_size = tree_size
+        self.page_size = page_size
+        self.start_time = start_time
+
+    def get_sth(self):
+        return {
+            'tree_size': self.tree_size,
+            'timestamp': self.start_time + self.tree_size,
+            'sha256_root_hash': base64.b64encode(hashlib.sha256(str(self.tree_size).encode()).digest()).decode(),
+            'tree_head_signature': '',
+        }
+
+    def get_entries(self, start, end):
+        # Real logs cap pages too, and the fetcher adapts to it
+        end = min(end, start + self.page_size - 1, self.tree_size - 1)
+        return {'entries': [self.entries[i % len(self.entries)] for i in range(start, end + 1)]}
+
+
+def make_handler(stub, latency=0):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            parsed = urlparse(self.path)
+            params = parse_qs(parsed.query)
+            threat_types = params.get('threatTypes', [])
+
+            if latency:
+                time.sleep(latency)
+            if isinstance(stub, StubCTLog):
+                if parsed.path.endswith('/get-sth'):
+                    body = stub.get_sth()
+                elif parsed.path.endswith('/get-entries') and 'start' in params and 'end' in params:
+                    body = stub.get_entries(int(params['start'][0]), int(params['end'][0]))
+                else:
+                    return self._send(400, {'error': 'Unknown endpoint or missing start/end'})
+            elif parsed.path == '/v1/threatLists:computeDiff':
+                body = stub.compute_diff(params['threatType'][0], params.get('versionToken', [''])[0])
+            elif parsed.path == '/v1/hashes:search':
+                body = stub.search_hashes(base64.b64decode(params['hashPrefix'][0]), threat_types)
+            elif parsed.path == '/v1/uris:search':
+                body = stub.search_uri(params['uri'][0], threat_types)
+            else:
+                return self._send(404, {'error': {'code': 404, 'message': 'Not found'}})
+            self._send(200, body)
+
+        def _send(self, status, body):
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def make_server(port=0, fixture=None, latency=0):
+    """Creates (but does not start) a stub Web Risk server; port 0 picks a free port."""
+    stub = StubWebRisk(fixture or DEFAULT_FIXTURE)
+    return ThreadingHTTPServer(('127.0.0.1', port), make_handler(stub, latency))
+
+
+def make_ct_server(port=0, tree_size=100000, page_size=256, fixture=CT_FIXTURE, latency=0):
+    """Creates (but does not start) a stub CT log server, whose log URL is http://127.0.0.1:<port>/ct/v1."""
+    with open(fixture) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    stub = StubCTLog(entries, tree_size, page_size)
+    return ThreadingHTTPServer(('127.0.0.1', port), make_handler(stub, latency))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--fixture', help='JSON file mapping threat types to lookup expressions '
+                                          '(with --ct, a JSON Lines file of get-entries entries)')
+    parser.add_argument('--latency', type=float, default=0, help='seconds to delay every response by')
+    parser.add_argument('--ct', action='store_true', help='serve a CT log instead of the Web Risk API')
+    parser.add_argument('--tree-size', type=int, default=100000, help='with --ct, entries in the log')
+    parser.add_argument('--page-size', type=int, default=256, help='with --ct, most entries per get-entries call')
+    args = parser.parse_args()
+
+    if args.ct:
+        server = make_ct_server(args.port, args.tree_size, args.page_size, args.fixture or CT_FIXTURE, args.latency)
+        print(f"Stub CT log listening on http://127.0.0.1:{server.server_port}/ct/v1", flush=True)
+    else:
+        fixture = None
+        if args.fixture:
+            with open(args.fixture) as f:
+                fixture = json.load(f)
+        server = make_server(args.port, fixture, args.latency)
+        print(f"Stub Web Risk API listening on http://127.0.0.1:{server.server_port}/v1", flush=True)
+    server.serve_forever()
@@ -0,0 +1,351 @@
+"""
+A persistent queue between /api/submit and uris:submit.
+
+Submissions are written to SQLite and the request returns straight away
+with a job id ("job-<token>", random and unguessable, since it reveals the
+submitted URL) in place of the operation name. A background dispatcher
+drains the queue:
+
+- A submission of a URL (after format_url) for an abuse type it is
+  already queued or was submitted for within SUBMIT_DEDUPE_WINDOW seconds
+  is merged into that job instead of being sent again. Evidence it adds is
+  appended to a job still waiting in the queue. A job that has already been
+  sent only absorbs repeats of its own evidence; new evidence makes a new job.
+- Jobs are sent at most SUBMIT_RATE per second. The pacing is stored in
+  the database, so every worker process sharing the file shares the rate.
+- 429, 5xx and network errors are retried with exponential backoff,
+  honouring Retry-After, up to SUBMIT_MAX_ATTEMPTS attempts. Other errors
+  fail the job.
+- A job is leased while it is being sent. If the process dies mid-send,
+  the lease runs out and another dispatcher picks the job up, so jobs
+  survive restarts.
+
+A queue only keeps those promises on storage that outlives the instance
+and is shared by every instance serving /api/submit, so there is no default
+path: without SUBMIT_QUEUE_PATH the queue is off and /api/submit calls
+uris:submit itself (see main.queue_submission). App Engine standard has no
+such storage (/tmp is per instance and lost on restart).
+
+Job ids resolve to a queued/failed pseudo-operation, or to the real Web
+Risk operation once the job has been submitted (see job_operation).
+"""
+from utils import format_url
+import clients
+import json
+import logging
+import metrics
+import os
+import random
+import secrets
+import sqlite3
+import threading
+import time
+import requests
+import threatlists
+
+logger = logging.getLogger(__name__)
+
+# Persistent storage shared by every instance; the queue is off while unset
+QUEUE_PATH = os.getenv('SUBMIT_QUEUE_PATH')
+SUBMIT_RATE = float(os.getenv('SUBMIT_RATE', '1'))
+MAX_ATTEMPTS = int(os.getenv('SUBMIT_MAX_ATTEMPTS', '8'))
+DEDUPE_WINDOW = float(os.getenv('SUBMIT_DEDUPE_WINDOW', str(24 * 60 * 60)))
+BACKOFF = 5.0
+MAX_BACKOFF = 15 * 60
+LEASE = 2 * clients.REQUEST_TIMEOUT
+IDLE_WAIT = 5.0   # how often an idle dispatcher looks for jobs enqueued by other processes
+
+JOB_PREFIX = 'job-'
+
+QUEUED = 'QUEUED'
+SUBMITTING = 'SUBMITTING'
+SUBMITTED = 'SUBMITTED'
+FAILED = 'FAILED'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    token TEXT NOT NULL UNIQUE,
+    url TEXT NOT NULL,
+    abuse_type TEXT NOT NULL,
+    request TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    merged INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    lease_until REAL,
+    operation TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_url ON jobs (url, abuse_type, created);
+CREATE INDEX IF NOT EXISTS jobs_due ON jobs (state, next_attempt);
+CREATE TABLE IF NOT EXISTS dispatch (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    next_slot REAL NOT NULL
+);
+INSERT OR IGNORE INTO dispatch (id, next_slot) VALUES (1, 0);
+"""
+
+
+def job_id(operation):
+    """Returns the token of a "job-<token>" operation id, or None for a Web Risk operation."""
+    if operation.startswith(JOB_PREFIX) and len(operation) > len(JOB_PREFIX):
+        return operation[len(JOB_PREFIX):]
+    return None
+
+
+def post_submission(body):
+    """POSTs a JSON-encoded uris:submit request body; returns the response, whatever its status."""
+    project_number = os.getenv('GOOGLE_CLOUD_PROJECT_NUMBER')
+    if not project_number:
+        raise RuntimeError("Missing GOOGLE_CLOUD_PROJECT_NUMBER environment variable")
+    return clients.authed_session().post(
+        f"{threatlists.API_ROOT}/projects/{project_number}/uris:submit",
+        data=body,
+        headers={"Content-Type": "application/json; charset=utf-8"},
+        timeout=clients.REQUEST_TIMEOUT
+    )
+
+
+def _comments(submission_request):
+    return submission_request['threatInfo']['threatJustification']['comments']
+
+
+class SubmitQueue:
+    def __init__(self, path=QUEUE_PATH, rate=SUBMIT_RATE):
+        """
+        Args:
+            path (str): SQLite database file.
+            rate (float): Submissions per second, across every process using path.
+        """
+        self.path = path
+        self.rate = rate
+        self._local = threading.local()
+        self._wake = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Autocommit; transactions are opened explicitly with BEGIN IMMEDIATE
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self):
+        return _Transaction(self._connection())
+
+    # --- Producer side ---
+
+    def enqueue(self, url, submission_request):
+        """
+        Queues a uris:submit request body for url.
+
+        Returns (operation id, merged): merged is True when an equivalent
+        submission (same URL and abuse type) was already queued or recently
+        submitted and its job is returned instead.
+        """
+        formatted_url = format_url(url)
+        abuse_type = submission_request['threatInfo']['abuseType']
+        now = time.time()
+        with self._transaction() as conn:
+            for existing in conn.execute(
+                'SELECT id, token, state, request FROM jobs WHERE url = ? AND abuse_type = ? AND state != ? '
+                'AND created >= ? ORDER BY id DESC',
+                (formatted_url, abuse_type, FAILED, now - DEDUPE_WINDOW),
+            ).fetchall():
+                request = json.loads(existing['request'])
+                new_evidence = [c for c in _comments(submission_request) if c not in _comments(request)]
+                if new_evidence and existing['state'] != QUEUED:
+                    continue  # Already sent without this evidence
+                _comments(request).extend(new_evidence)
+                conn.execute('UPDATE jobs SET merged = merged + 1, request = ?, updated = ? WHERE id = ?',
+                             (json.dumps(request), now, existing['id']))
+                return f"{JOB_PREFIX}{existing['token']}", True
+            token = secrets.token_urlsafe(16)
+            conn.execute(
+                'INSERT INTO jobs (token, url, abuse_type, request, state, next_attempt, created, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (token, formatted_url, abuse_type, json.dumps(submission_request), QUEUED, now, now, now),
+            )
+        self.start()
+        self._wake.set()
+        return f"{JOB_PREFIX}{token}", False
+
+    def get(self, token):
+        row = self._connection().execute('SELECT * FROM jobs WHERE token = ?', (token,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def stats(self):
+        counts = dict(self._connection().execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+        return {state.lower(): counts.get(state, 0) for state in (QUEUED, SUBMITTING, SUBMITTED, FAILED)}
+
+    # --- Dispatcher ---
+
+    def start(self):
+        """Starts this process's dispatcher thread if it is not running yet."""
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='submit-dispatcher', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                job, wait = self._claim()
+            except sqlite3.Error as e:
+                logger.error(f"Error reading the submission queue: {str(e)}")
+                job, wait = None, IDLE_WAIT
+            if job is None:
+                self._wake.wait(wait)
+                self._wake.clear()
+                continue
+            try:
+                self._dispatch(job)
+            except Exception as e:
+                # Most likely the database was busy recording the outcome. The job keeps its
+                # lease, so it is picked up again once the lease runs out.
+                logger.error(f"Error dispatching submission job {job['id']}: {str(e)}")
+
+    def _claim(self):
+        """Leases the next due job if the rate allows; returns (job, None) or (None, seconds to wait)."""
+        now = time.time()
+        with self._transaction() as conn:
+            next_slot = conn.execute('SELECT next_slot FROM dispatch WHERE id = 1').fetchone()[0]
+            if next_slot > now:
+                return None, next_slot - now
+            row = conn.execute(
+                'SELECT * FROM jobs WHERE (state = ? AND next_attempt <= ?) OR (state = ? AND lease_until <= ?) '
+                'ORDER BY next_attempt, id LIMIT 1',
+                (QUEUED, now, SUBMITTING, now),
+            ).fetchone()
+            if row is None:
+                next_attempt = conn.execute('SELECT MIN(next_attempt) FROM jobs WHERE state = ?',
+                                            (QUEUED,)).fetchone()[0]
+                return None, IDLE_WAIT if next_attempt is None else min(IDLE_WAIT, max(0, next_attempt - now))
+            conn.execute('UPDATE jobs SET state = ?, attempts = attempts + 1, lease_until = ?, updated = ? WHERE id = ?',
+                         (SUBMITTING, now + LEASE, now, row['id']))
+            conn.execute('UPDATE dispatch SET next_slot = ? WHERE id = 1', (max(now, next_slot) + 1 / self.rate,))
+        job = dict(row)
+        job['attempts'] += 1
+        return job, None
+
+    def _dispatch(self, job):
+        retry_after, error = None, None
+        try:
+            with metrics.stage('upstream', handler='submit_dispatch'):
+                response = post_submission(job['request'])
+            if not response.ok:
+                error = f"API request failed: {response.status_code} {response.text[:500]}"
+                retryable = response.status_code == 429 or response.status_code >= 500
+                header = response.headers.get('Retry-After', '')
+                retry_after = float(header) if header.isdigit() else None
+        except requests.exceptions.RequestException as e:
+            error, retryable = f"Could not connect to Web Risk API: {str(e)}", True
+        except Exception as e:
+            error, retryable = str(e), False
+
+        # Outside the try: a database error recording an accepted submission must not mark
+        # the job FAILED (_run logs it and the job is picked up again when its lease runs out)
+        if error is None:
+            self._submitted(job, response)
+        elif retryable and job['attempts'] < MAX_ATTEMPTS:
+            delay = min(MAX_BACKOFF, BACKOFF * 2 ** (job['attempts'] - 1)) * random.uniform(0.5, 1.0)
+            delay = max(delay, retry_after or 0)
+            logger.warning(f"Submission job {job['id']} failed ({error}); retrying in {delay:.0f}s")
+            now = time.time()
+            with self._transaction() as conn:
+                conn.execute('UPDATE jobs SET state = ?, next_attempt = ?, lease_until = NULL, error = ?, updated = ? '
+                             'WHERE id = ?', (QUEUED, now + delay, error, now, job['id']))
+        else:
+            logger.error(f"Submission job {job['id']} failed: {error}")
+            self._finish(job, FAILED, error=error)
+
+    def _submitted(self, job, response):
+        """Records an accepted submission, even if its response does not name the operation."""
+        operation, error = None, None
+        try:
+            with metrics.stage('parse', handler='submit_dispatch'):
+                operation = response.json().get('name')
+        except (ValueError, AttributeError) as e:
+            # Upstream has the submission; sending it again would only duplicate it
+            error = f"Submitted, but the response did not name an operation: {str(e)}"
+            logger.warning(f"Submission job {job['id']}: {error}")
+        self._finish(job, SUBMITTED, operation=operation, error=error)
+        logger.info("Submitted job", extra={'job': job['id'], 'operation': operation})
+
+    def _finish(self, job, state, operation=None, error=None):
+        with self._transaction() as conn:
+            conn.execute('UPDATE jobs SET state = ?, operation = ?, error = ?, lease_until = NULL, updated = ? '
+                         'WHERE id = ?', (state, operation, error, time.time(), job['id']))
+
+    # --- Status ---
+
+    def job_operation(self, operation, fetch_operation):
+        """
+        Returns the operation resource for a "job-<token>" id.
+
+        Submitted jobs resolve to their Web Risk operation (via
+        fetch_operation), or to a done operation with a SUBMITTED state if
+        upstream accepted the job without naming one; queued jobs to a
+        pending pseudo-operation with a QUEUED or SUBMITTING state; failed
+        ones to a done operation with a FAILED state and the error.
+
+        Raises:
+            LookupError: If there is no such job.
+        """
+        job = self.get(job_id(operation))
+        if job is None:
+            raise LookupError(f"No submission job {operation}")
+        if job['state'] == SUBMITTED and job['operation']:
+            return fetch_operation(job['operation'].rsplit('/', 1)[-1])
+        resource = {
+            'name': operation,
+            'done': job['state'] in (SUBMITTED, FAILED),
+            'metadata': {'state': job['state'], 'uri': job['url'], 'attempts': job['attempts']},
+        }
+        if job['error'] and job['state'] == FAILED:
+            resource['error'] = {'message': job['error']}
+        return resource
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT (or ROLLBACK on error) on an autocommit connection."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+        except sqlite3.Error:
+            # A failed COMMIT (e.g. database is locked) leaves the transaction open, and this
+            # thread's connection could never BEGIN again
+            if self.conn.in_transaction:
+                self.conn.execute('ROLLBACK')
+            if exc_type is None:
+                raise
+        return False
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+def get_queue():
+    """Returns this process's queue at SUBMIT_QUEUE_PATH, starting its dispatcher; None if the queue is off."""
+    global _queue
+    with _queue_lock:
+        if _queue is None and QUEUE_PATH:
+            _queue = SubmitQueue()
+            _queue.start()
+    return _queue
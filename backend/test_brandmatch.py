@@ -0,0 +1,45 @@
+"""
+Brand and lookalike matching in brandmatch.
+
+    python -m pytest test_brandmatch.py
+"""
+import pytest
+import brandmatch
+
+BRANDS = ['apple', 'chase', 'google', 'examplecorp', 'paypal']
+
+# (domain, (brand, rule) expected, or None for no match)
+MATCH_CASES = [
+    ("examplecorp-login.net", ('examplecorp', brandmatch.EXACT)),
+    ("secure-appie.com", ('apple', brandmatch.HOMOGLYPH)),
+    ("paypa1.com", ('paypal', brandmatch.HOMOGLYPH)),
+    ("g00gle-login.com", ('google', brandmatch.HOMOGLYPH)),
+    ("xn--pple-43d.com", ('apple', brandmatch.IDNA_HOMOGLYPH)),
+    ("gooogle.com", ('google', brandmatch.REPETITION)),
+    ("login-gooogle.com", ('google', brandmatch.REPETITION)),
+    ("www.gooogle.co.uk", ('google', brandmatch.REPETITION)),
+    ("aple-support.com", ('apple', brandmatch.OMISSION)),
+    # Ordinary words containing a fragment of a brand
+    ("applications.net", None),
+    ("apply-now.org", None),
+    ("phase2.dev", None),
+    # Typo variants only count as whole tokens
+    ("purchasse.com", None),
+    ("gooogleservices.com", None),
+]
+
+
+@pytest.fixture(scope='module')
+def matcher():
+    return brandmatch.BrandMatcher(BRANDS)
+
+
+@pytest.mark.parametrize('domain, expected', MATCH_CASES)
+def test_match(matcher, domain, expected):
+    matches = [(m.brand, m.rule) for m in matcher.match(domain)]
+    assert matches == ([expected] if expected else [])
+
+
+@pytest.mark.parametrize('brand', BRANDS)
+def test_no_variant_is_part_of_the_brand(brand):
+    assert all(variant == brand or variant not in brand for variant in brandmatch.brand_variants(brand))
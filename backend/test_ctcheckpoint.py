@@ -0,0 +1,176 @@
+"""
+Checkpointing of CT log tailing: Watermark, CheckpointStore and the
+checkpoints tail_ct_logs commits (or hands out as markers).
+
+    python -m pytest test_ctcheckpoint.py
+"""
+from ctcheckpoint import CheckpointMarker, CheckpointStore, Watermark
+from ctfetch import Batch, FailedRange
+import pytest
+import ctlogs
+
+LOG = 'https://ct.example/log'
+TREE_SIZE = 30
+
+
+# --- Watermark ---
+
+def test_watermark_advances_over_contiguous_batches():
+    watermark = Watermark(0)
+    assert watermark.complete(0, 10)
+    assert watermark.complete(10, 5)
+    assert watermark.next_index == 15
+
+
+def test_watermark_waits_for_out_of_order_batches():
+    watermark = Watermark(0)
+    assert not watermark.complete(20, 10)
+    assert not watermark.complete(10, 10)
+    assert watermark.next_index == 0
+    assert watermark.complete(0, 10)
+    assert watermark.next_index == 30
+
+
+def test_watermark_does_not_move_past_a_gap():
+    watermark = Watermark(0)
+    watermark.complete(0, 10)
+    watermark.complete(20, 10)  # 10-19 failed
+    assert watermark.next_index == 10
+    assert watermark.complete(10, 10)
+    assert watermark.next_index == 30
+
+
+def test_watermark_ignores_refetches_behind_it():
+    watermark = Watermark(10)
+    assert not watermark.complete(0, 10)
+    assert not watermark.complete(5, 5)
+    assert watermark.next_index == 10
+
+
+def test_watermark_counts_the_part_of_a_refetch_past_it():
+    watermark = Watermark(10)
+    assert watermark.complete(5, 10)
+    assert watermark.next_index == 15
+
+
+def test_watermark_keeps_the_longer_of_two_batches_at_one_start():
+    watermark = Watermark(0)
+    watermark.complete(10, 10)
+    watermark.complete(10, 5)
+    watermark.complete(0, 10)
+    assert watermark.next_index == 20
+
+
+# --- CheckpointStore ---
+
+def test_checkpoint_store_persists_commits(tmp_path):
+    path = str(tmp_path / 'checkpoints.json')
+    store = CheckpointStore(path)
+    assert store.get(LOG) is None
+    store.commit(LOG, 42)
+    assert CheckpointStore(path).get(LOG) == 42
+    assert not (tmp_path / 'checkpoints.json.tmp').exists()
+
+
+def test_marker_commits_once_called():
+    committed = []
+    marker = CheckpointMarker(lambda: committed.append(True))
+    assert committed == []
+    marker.commit()
+    assert committed == [True]
+
+
+# --- tail_ct_logs ---
+
+class FakeFetcher:
+    """Plays back one planned poll per fetch() call: batches as (start, count), failed ranges as (start, error)."""
+
+    polls = []
+    requested = []  # the bounds of each fetch() call
+
+    def __init__(self, **kwargs):
+        self.failed_ranges = []
+
+    def get_tree_size(self, log_url):
+        return TREE_SIZE
+
+    def fetch(self, bounds):
+        FakeFetcher.requested.append(dict(bounds))
+        for start, size in FakeFetcher.polls.pop(0):
+            if isinstance(size, str):
+                self.failed_ranges.append(FailedRange(LOG, start, start + 9, size))
+            else:
+                yield Batch(LOG, start, [None] * size)
+
+
+@pytest.fixture
+def tail(monkeypatch, tmp_path):
+    """Runs one poll of tail_ct_logs over the planned batches; every entry is a hit carrying its index."""
+    path = str(tmp_path / 'checkpoints.json')
+
+    def batch_hits(matcher, batch, stats, index=None):
+        return ({'index': batch.start + i} for i in range(len(batch.entries)))
+
+    monkeypatch.setattr(ctlogs, 'CTFetcher', FakeFetcher)
+    monkeypatch.setattr(ctlogs, '_batch_hits', batch_hits)
+
+    def run(batches, checkpoint_markers=False):
+        FakeFetcher.polls, FakeFetcher.requested = [batches], []
+        return ctlogs.tail_ct_logs(['examplecorp'], [LOG], path, initial_index=0,
+                                   checkpoint_markers=checkpoint_markers)
+
+    run.checkpoint = lambda: CheckpointStore(path).get(LOG)
+    run.requested = lambda: FakeFetcher.requested
+    return run
+
+
+def test_tail_commits_out_of_order_batches_once_contiguous(tail):
+    hits = [hit['index'] for hit in tail([(10, 10), (0, 10), (20, 10)])]
+    assert sorted(hits) == list(range(TREE_SIZE))
+    assert tail.checkpoint() == TREE_SIZE
+
+
+def test_tail_does_not_commit_past_a_failed_range(tail):
+    hits = [hit['index'] for hit in tail([(0, 10), (10, 'HTTP 503'), (20, 10)])]
+    assert sorted(hits) == list(range(0, 10)) + list(range(20, 30))
+    assert tail.checkpoint() == 10
+
+    # The next run fetches from the gap again; hits after it are delivered twice, none are lost
+    hits = [hit['index'] for hit in tail([(10, 10), (20, 10)])]
+    assert tail.requested() == [{LOG: (10, TREE_SIZE - 1)}]
+    assert sorted(hits) == list(range(10, 30))
+    assert tail.checkpoint() == TREE_SIZE
+
+
+def test_tail_markers_follow_their_batch_and_commit_only_when_called(tail):
+    stream = list(tail([(10, 10), (0, 10), (20, 10)], checkpoint_markers=True))
+    markers = [i for i, item in enumerate(stream) if isinstance(item, CheckpointMarker)]
+    assert len(markers) == 3
+    # Every marker comes straight after its batch's ten hits
+    assert markers == [10, 21, 32]
+    assert tail.checkpoint() == 0
+
+    stream[markers[0]].commit()  # 10-19
+    assert tail.checkpoint() == 0
+    stream[markers[1]].commit()  # 0-9
+    assert tail.checkpoint() == 20
+    stream[markers[2]].commit()  # 20-29
+    assert tail.checkpoint() == TREE_SIZE
+
+
+def test_tail_resumes_from_the_last_committed_marker(tail):
+    stream = tail([(0, 10), (10, 10), (20, 10)], checkpoint_markers=True)
+    delivered = []
+    for item in stream:
+        if isinstance(item, CheckpointMarker):
+            item.commit()
+            if len(delivered) == 10:
+                break  # Stop after the first batch, as a crash would
+        else:
+            delivered.append(item['index'])
+    stream.close()
+    assert tail.checkpoint() == 10
+
+    hits = [hit['index'] for hit in tail([(10, 10), (20, 10)])]
+    assert tail.requested() == [{LOG: (10, TREE_SIZE - 1)}]
+    assert sorted(delivered + hits) == list(range(TREE_SIZE))
@@ -0,0 +1,66 @@
+"""
+The CT domain index in ctindex.
+
+    python -m pytest test_ctindex.py
+"""
+from concurrent.futures import ThreadPoolExecutor
+import ctindex
+
+LOG = 'https://ct.example/log'
+
+
+def test_add_keeps_the_earliest_sighting(tmp_path):
+    index = ctindex.DomainIndex(str(tmp_path / 'index.sqlite3'))
+    assert index.add([('login.example.co.uk', LOG, 5, 200), ('*.Example.co.uk.', LOG, 6, 300)]) == 2
+    assert index.add([('login.example.co.uk', LOG, 1, 100), ('new.example.co.uk', LOG, 7, 400)]) == 1
+    results = index.search_registrable('example.co.uk')
+    assert [r['domain'] for r in results] == ['new.example.co.uk', 'example.co.uk', 'login.example.co.uk']
+    assert results[2]['entry_index'] == 1
+    assert [r['domain'] for r in index.search_substring('login')] == ['login.example.co.uk']
+
+
+def test_concurrent_writers_do_not_fail_or_collide(tmp_path):
+    path = str(tmp_path / 'index.sqlite3')
+    ctindex.DomainIndex(path)
+
+    def batch(n):
+        # Consecutive batches overlap, and so do the batches of different writers
+        return [f'd{n * 10 + i}.example.com' for i in range(25)]
+
+    def write(worker):
+        index = ctindex.DomainIndex(path)  # A handle per writer, as separate tailer processes would have
+        for n in range(worker, worker + 20):
+            index.add([(domain, LOG, n, n) for domain in batch(n)])
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(write, range(4)))
+
+    index = ctindex.DomainIndex(path)
+    domains = {domain for n in range(3 + 20) for domain in batch(n)}
+    assert index.count() == len(domains)
+    # Every domain is indexed once, under its own trigrams
+    assert sorted(r['domain'] for r in index.search_substring('example', limit=1000)) == sorted(domains)
+    assert {r['domain'] for r in index.search_substring('d12')} == {d for d in domains if d.startswith('d12')}
+
+
+def test_readonly_snapshot(tmp_path):
+    path = str(tmp_path / 'index.sqlite3')
+    writer = ctindex.DomainIndex(path)
+    assert writer.empty()
+    writer.add([('login.example.com', LOG, 1, 100)])
+    writer._connection().close()  # The last connection folds the write-ahead log into the file
+
+    snapshot = ctindex.DomainIndex(path, readonly=True)
+    assert not snapshot.empty()
+    assert [r['domain'] for r in snapshot.search_substring('login')] == ['login.example.com']
+
+
+def test_get_index_does_not_create_the_file(monkeypatch, tmp_path):
+    path = tmp_path / 'index.sqlite3'
+    monkeypatch.setattr(ctindex, 'INDEX_PATH', str(path))
+    monkeypatch.setattr(ctindex, '_index', None)
+    assert ctindex.get_index() is None
+    assert not path.exists()
+
+    ctindex.DomainIndex(str(path))
+    assert ctindex.get_index().path == str(path)
@@ -0,0 +1,92 @@
+"""
+The submission queue in submitqueue, and /api/submit without one.
+
+    python -m pytest test_submitqueue.py
+"""
+from unittest import mock
+import json
+import pytest
+import main
+import submitqueue
+
+
+def submission(url='https://phish.example/login', abuse_type='SOCIAL_ENGINEERING', evidence='Copies our login page'):
+    return {
+        'submission': {'uri': url},
+        'threatInfo': {
+            'abuseType': abuse_type,
+            'threatConfidence': {'level': 'HIGH'},
+            'threatJustification': {'labels': ['MANUAL_VERIFICATION'], 'comments': [evidence]},
+        },
+        'threatDiscovery': {'platform': 'PLATFORM_UNSPECIFIED', 'regionCodes': ['US']},
+    }
+
+
+@pytest.fixture
+def queue(monkeypatch, tmp_path):
+    monkeypatch.setattr(submitqueue.SubmitQueue, 'start', lambda self: None)  # No dispatcher
+    return submitqueue.SubmitQueue(str(tmp_path / 'submissions.sqlite3'))
+
+
+def test_job_ids_are_opaque(queue):
+    first, _ = queue.enqueue('https://one.example/', submission('https://one.example/'))
+    second, _ = queue.enqueue('https://two.example/', submission('https://two.example/'))
+    tokens = [submitqueue.job_id(first), submitqueue.job_id(second)]
+    assert all(len(token) >= 20 and not token.isdigit() for token in tokens)
+    assert queue.get(tokens[0])['url'] == 'https://one.example'
+    assert queue.get('1') is None
+
+
+def test_a_resubmitted_url_gets_its_job(queue):
+    operation, merged = queue.enqueue('https://phish.example/login', submission())
+    assert not merged
+    assert queue.enqueue('https://phish.example/login', submission()) == (operation, True)
+
+
+
+def test_another_abuse_type_is_a_new_job(queue):
+    operation, _ = queue.enqueue('https://phish.example/login', submission())
+    other, merged = queue.enqueue('https://phish.example/login', submission(abuse_type='MALWARE'))
+    assert other != operation and not merged
+
+
+def test_new_evidence_is_added_to_a_queued_job(queue):
+    operation, _ = queue.enqueue('https://phish.example/login', submission())
+    assert queue.enqueue('https://phish.example/login', submission(evidence='Asks for card numbers')) == \
+        (operation, True)
+    request = json.loads(queue.get(submitqueue.job_id(operation))['request'])
+    assert request['threatInfo']['threatJustification']['comments'] == ['Copies our login page',
+                                                                        'Asks for card numbers']
+
+
+def test_new_evidence_for_a_sent_job_is_a_new_job(queue):
+    operation, _ = queue.enqueue('https://phish.example/login', submission())
+    with queue._transaction() as conn:
+        conn.execute('UPDATE jobs SET state = ?', (submitqueue.SUBMITTED,))
+    assert queue.enqueue('https://phish.example/login', submission()) == (operation, True)
+    other, merged = queue.enqueue('https://phish.example/login', submission(evidence='Asks for card numbers'))
+    assert other != operation and not merged
+
+
+def test_unknown_job_ids_are_not_found(queue):
+    with pytest.raises(LookupError):
+        queue.job_operation('job-guessed', lambda operation: None)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv('GOOGLE_CLOUD_PROJECT_NUMBER', '123')
+    monkeypatch.setattr(submitqueue, 'get_queue', lambda: None)
+    monkeypatch.setattr(main.oppoller, 'get_poller', mock.Mock())
+    return main.app.test_client()
+
+
+def test_submit_is_sent_at_once_without_a_queue(monkeypatch, client):
+    response = mock.Mock(status_code=200, json=lambda: {'name': 'projects/123/operations/abc'})
+    post = mock.Mock(return_value=response)
+    monkeypatch.setattr(submitqueue, 'post_submission', post)
+    reply = client.post('/api/submit', json={'url': 'phish.example/login', 'evidence': 'Copies our login page',
+                                             'abuseType': 'SOCIAL_ENGINEERING'})
+    assert reply.status_code == 200
+    assert reply.json['operation'] == 'projects/123/operations/abc'
+    assert post.call_count == 1
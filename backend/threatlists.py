@@ -0,0 +1,373 @@
+"""
+Local copy of the Web Risk threat lists.
+
+The MALWARE, SOCIAL_ENGINEERING and UNWANTED_SOFTWARE lists are synchronised
+with threatLists:computeDiff and stored on disk as sorted, fixed-width hash
+prefix files. Readers memory-map those files, so every gunicorn worker on an
+instance shares one copy of the data through the page cache, and only one
+worker (whichever holds the sync lock) talks to computeDiff at a time.
+
+A URL is answered locally when none of its lookup hashes match a prefix. Only
+a prefix match needs a hashes:search call to confirm the full hash. See
+https://cloud.google.com/web-risk/docs/update-api for the protocol.
+"""
+from urlcanon import lookup_hashes
+from utils import parse_timestamp
+import clients
+import base64
+import bisect
+import fcntl
+import hashlib
+import json
+import logging
+import mmap
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+THREAT_TYPES = ["MALWARE", "SOCIAL_ENGINEERING", "UNWANTED_SOFTWARE"]
+
+# Point this at a local stand-in (see stubserver.py) to run offline.
+API_ROOT = os.getenv('WEBRISK_API_ROOT', 'https://webrisk.googleapis.com/v1')
+DB_DIR = os.getenv('THREATLIST_DIR', '/tmp/webrisk-threatlists')
+ENABLED = os.getenv('THREATLIST_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+MAX_DATABASE_ENTRIES = int(os.getenv('THREATLIST_MAX_DATABASE_ENTRIES', '0'))
+
+RELOAD_INTERVAL = 5           # seconds between checks for a newer on-disk generation
+MIN_SYNC_INTERVAL = 60        # never call computeDiff more often than this
+MAX_SYNC_INTERVAL = 30 * 60
+FULL_HASH_CACHE_SIZE = 10000
+
+
+class PrefixFile:
+    """
+    A read-only, memory-mapped view over a sorted file of fixed-width prefixes.
+
+    The object behaves like a sequence of bytes records, which lets the
+    standard bisect module do the binary search without copying the file.
+    """
+
+    def __init__(self, path, width):
+        self.width = width
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self._count = size // width
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        start = index * self.width
+        return self._map[start:start + self.width]
+
+    def __contains__(self, prefix):
+        index = bisect.bisect_left(self, prefix)
+        return index < self._count and self[index] == prefix
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+
+class ThreatList:
+    """The on-disk prefixes and sync state for a single threat type."""
+
+    def __init__(self, threat_type, directory):
+        self.threat_type = threat_type
+        self.directory = directory
+        self.meta = {}
+        self.files = {}
+        self._loaded_generation = None
+
+    @property
+    def meta_path(self):
+        return os.path.join(self.directory, f'{self.threat_type}.json')
+
+    def data_path(self, width, generation):
+        return os.path.join(self.directory, f'{self.threat_type}.{generation}.{width}')
+
+    @property
+    def ready(self):
+        return bool(self.meta.get('versionToken'))
+
+    def reload(self):
+        """Maps the newest generation written by any worker, if it changed."""
+        try:
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return
+        if meta.get('generation') == self._loaded_generation:
+            self.meta = meta
+            return
+
+        files = {}
+        try:
+            for width in meta.get('widths', []):
+                files[width] = PrefixFile(self.data_path(width, meta['generation']), width)
+        except OSError:
+            # A newer generation replaced this one between reading the metadata
+            # and opening the files; the next reload will pick it up.
+            for prefix_file in files.values():
+                prefix_file.close()
+            return
+
+        # The old maps are not closed here: a lookup on another thread may still
+        # be bisecting them, and they are unmapped once no longer referenced.
+        self.files, self.meta = files, meta
+        self._loaded_generation = meta.get('generation')
+
+    def matching_prefixes(self, full_hash):
+        return [full_hash[:width] for width, prefix_file in self.files.items()
+                if full_hash[:width] in prefix_file]
+
+    def all_prefixes(self):
+        """Returns every stored prefix, sorted the way computeDiff indexes them."""
+        prefixes = []
+        for prefix_file in self.files.values():
+            prefixes.extend(prefix_file[i] for i in range(len(prefix_file)))
+        prefixes.sort()
+        return prefixes
+
+    def write(self, prefixes, version_token, next_diff):
+        """Atomically publishes a new generation of this list."""
+        generation = f'{int(time.time() * 1000)}-{os.getpid()}'
+        by_width = {}
+        for prefix in prefixes:
+            by_width.setdefault(len(prefix), []).append(prefix)
+
+        for width, group in by_width.items():
+            path = self.data_path(width, generation)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(b''.join(group))
+            os.replace(path + '.tmp', path)
+
+        meta = {
+            'generation': generation,
+            'widths': sorted(by_width),
+            'versionToken': version_token,
+            'nextDiff': next_diff,
+            'count': len(prefixes),
+        }
+        with open(self.meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(self.meta_path + '.tmp', self.meta_path)
+
+        previous = self.meta
+        self.reload()
+        # Workers that still map the old files keep them alive until they remap.
+        if previous.get('generation') and previous['generation'] != generation:
+            for width in previous.get('widths', []):
+                try:
+                    os.remove(self.data_path(width, previous['generation']))
+                except OSError:
+                    pass
+
+
+class ThreatDatabase:
+    """Keeps the local threat lists in sync and answers lookups against them."""
+
+    def __init__(self, directory=DB_DIR, api_root=API_ROOT):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.api_root = api_root
+        self.lists = {t: ThreatList(t, directory) for t in THREAT_TYPES}
+        self._lock = threading.Lock()
+        self._last_reload = 0
+        self._full_hashes = {}
+        self._sync_thread = None
+        self.session = clients.api_session()
+        self._reload(force=True)
+
+    @property
+    def ready(self):
+        self._reload()
+        return all(threat_list.ready for threat_list in self.lists.values())
+
+    def _reload(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_reload < RELOAD_INTERVAL:
+            return
+        with self._lock:
+            self._last_reload = now
+            for threat_list in self.lists.values():
+                threat_list.reload()
+
+    # --- Lookups ---
+
+    def lookup(self, url, api_key):
+        """
+        Checks a URL against the local lists.
+
+        Returns a dict shaped like a uris:search response: empty when the URL
+        is safe, or {'threat': {'threatTypes': [...], 'expireTime': ...}}.
+        """
+        self._reload()
+        candidates = {}
+        for full_hash in lookup_hashes(url):
+            for threat_list in self.lists.values():
+                for prefix in threat_list.matching_prefixes(full_hash):
+                    candidates.setdefault(prefix, set()).add(full_hash)
+
+        found_types, expire_times = set(), []
+        for prefix, full_hashes in candidates.items():
+            for threat in self._search_hashes(prefix, api_key):
+                if threat['hash'] in full_hashes:
+                    found_types.update(threat['threatTypes'])
+                    expire_times.append(threat['expireTime'])
+
+        if not found_types:
+            return {}
+        return {'threat': {
+            'threatTypes': [t for t in THREAT_TYPES if t in found_types],
+            'expireTime': min(expire_times, key=parse_timestamp),
+        }}
+
+    def _search_hashes(self, prefix, api_key):
+        """Calls hashes:search for a prefix, honouring the response's cache durations."""
+        cached = self._full_hashes.get(prefix)
+        now = time.time()
+        if cached and cached[0] > now:
+            return [t for t in cached[1] if parse_timestamp(t['expireTime']) > now]
+
+        response = self.session.get(
+            f"{self.api_root}/hashes:search",
+            params={
+                'hashPrefix': base64.b64encode(prefix).decode('ascii'),
+                'threatTypes': THREAT_TYPES,
+            },
+            headers=clients.api_key_headers(api_key),
+            timeout=clients.REQUEST_TIMEOUT,
+        )
+        response.raise_for_status()
+        data = response.json() if response.text else {}
+
+        threats = [{
+            'threatTypes': t.get('threatTypes', []),
+            'hash': base64.b64decode(t['hash']),
+            'expireTime': t['expireTime'],
+        } for t in data.get('threats', [])]
+
+        negative_expire = data.get('negativeExpireTime')
+        expires = parse_timestamp(negative_expire) if negative_expire else now
+        if len(self._full_hashes) >= FULL_HASH_CACHE_SIZE:
+            self._full_hashes.clear()
+        self._full_hashes[prefix] = (expires, threats)
+        return threats
+
+    # --- Synchronisation ---
+
+    def start_sync(self, api_key):
+        """Starts the background sync thread once per process."""
+        with self._lock:
+            if self._sync_thread is None:
+                self._sync_thread = threading.Thread(
+                    target=self._sync_forever, args=(api_key,), name='threatlist-sync', daemon=True
+                )
+                self._sync_thread.start()
+
+    def _sync_forever(self, api_key):
+        failures = 0
+        while True:
+            try:
+                delay = self.sync_once(api_key)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                delay = min(MAX_SYNC_INTERVAL, MIN_SYNC_INTERVAL * 2 ** failures)
+                logger.error(f"Threat list sync failed (attempt {failures}): {str(e)}")
+            time.sleep(delay)
+
+    def sync_once(self, api_key):
+        """
+        Brings every due list up to date, unless another worker is already doing it.
+
+        Returns the number of seconds until the next list is due.
+        """
+        lock_path = os.path.join(self.directory, '.sync.lock')
+        with open(lock_path, 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return MIN_SYNC_INTERVAL
+            try:
+                self._reload(force=True)
+                for threat_list in self.lists.values():
+                    if threat_list.meta.get('nextDiff', 0) <= time.time():
+                        self._sync_list(threat_list, api_key)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        next_due = min(l.meta.get('nextDiff', 0) for l in self.lists.values())
+        return max(MIN_SYNC_INTERVAL, min(MAX_SYNC_INTERVAL, next_due - time.time()))
+
+    def _sync_list(self, threat_list, api_key):
+        params = {
+            'threatType': threat_list.threat_type,
+            'versionToken': threat_list.meta.get('versionToken', ''),
+            'constraints.supportedCompressions': 'RAW',
+        }
+        if MAX_DATABASE_ENTRIES:
+            params['constraints.maxDatabaseEntries'] = MAX_DATABASE_ENTRIES
+
+        response = self.session.get(
+            f"{self.api_root}/threatLists:computeDiff", params=params, headers=clients.api_key_headers(api_key),
+            timeout=clients.REQUEST_TIMEOUT
+        )
+        response.raise_for_status()
+        diff = response.json()
+
+        prefixes = apply_diff(
+            [] if diff.get('responseType') == 'RESET' else threat_list.all_prefixes(), diff
+        )
+        next_diff = diff.get('recommendedNextDiff')
+        next_diff = parse_timestamp(next_diff) if next_diff else time.time() + MIN_SYNC_INTERVAL
+
+        expected = diff.get('checksum', {}).get('sha256')
+        if expected and base64.b64decode(expected) != hashlib.sha256(b''.join(prefixes)).digest():
+            # Start over from an empty database on the next sync.
+            logger.error(f"Checksum mismatch for {threat_list.threat_type}; resetting local list")
+            threat_list.write([], '', time.time())
+            return
+
+        threat_list.write(prefixes, diff.get('newVersionToken', ''), next_diff)
+        logger.info(f"Synced {threat_list.threat_type}: {len(prefixes)} prefixes")
+
+
+def apply_diff(prefixes, diff):
+    """
+    Applies a RAW-encoded computeDiff response to a sorted list of prefixes.
+
+    Removal indices refer to positions in the sorted list before any
+    additions, so they are applied first.
+    """
+    removals = set(diff.get('removals', {}).get('rawIndices', {}).get('indices', []))
+    if removals:
+        prefixes = [p for i, p in enumerate(prefixes) if i not in removals]
+
+    for addition in diff.get('additions', {}).get('rawHashes', []):
+        size = addition['prefixSize']
+        raw = base64.b64decode(addition.get('rawHashes', ''))
+        prefixes.extend(raw[i:i + size] for i in range(0, len(raw), size))
+
+    prefixes.sort()
+    return prefixes
+
+
+_database = None
+_database_lock = threading.Lock()
+
+def get_database(api_key):
+    """Returns this process's database, starting its sync thread on first use."""
+    global _database
+    if not ENABLED:
+        return None
+    with _database_lock:
+        if _database is None:
+            _database = ThreatDatabase()
+    _database.start_sync(api_key)
+    return _database
@@ -0,0 +1,204 @@
+"""
+URL canonicalization and lookup expressions as Web Risk defines them.
+
+See https://cloud.google.com/web-risk/docs/urls-hashing. A URL is
+canonicalized by removing tab/CR/LF and the fragment, percent-unescaping
+until nothing changes, lowercasing the host, collapsing its dots and
+normalizing IP addresses in any legal encoding, resolving "." and ".."
+path segments and repeated slashes, and finally re-escaping control,
+non-ASCII, "#" and "%" characters. Everything is done per byte, as the
+spec does: non-ASCII input is taken as UTF-8 and unescaped bytes need not
+be valid UTF-8.
+
+Lookups then check the host-suffix/path-prefix expressions of the
+canonical URL, or their SHA-256 hashes. All three steps are memoized, and
+lookup_key gives the scheme-less canonical form, so equivalent spellings of
+a URL share one cache entry and one upstream call.
+"""
+from functools import lru_cache
+import hashlib
+import os
+import re
+
+CACHE_SIZE = int(os.getenv('URL_CANON_CACHE_SIZE', '65536'))
+
+_SCHEME = re.compile(r'([a-zA-Z][a-zA-Z0-9+.-]*)://')
+_ESCAPE_SEQUENCE = re.compile(r'%([0-9a-fA-F]{2})')
+_IP_PART = re.compile(r'0[xX][0-9a-fA-F]*|0[0-7]*|[1-9][0-9]*')
+_DOTS = re.compile(r'\.{2,}')
+_REMOVED = str.maketrans('', '', '\t\r\n')
+_ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+_ESCAPED = str.maketrans({c: f'%{c:02X}' for c in [*range(0x21), *range(0x7f, 0x100), ord('#'), ord('%')]})
+_WHITESPACE = ' \t\n\r\f\v'
+
+MAX_HOST_SUFFIXES = 5
+MAX_PATH_PREFIXES = 4
+
+
+def _unescape(text):
+    while True:
+        unescaped = _ESCAPE_SEQUENCE.sub(lambda m: chr(int(m.group(1), 16)), text)
+        if unescaped == text:
+            return text
+        text = unescaped
+
+
+def _normalize_ip(host):
+    """
+    Returns host as a dotted quad if it parses as an IPv4 address, else None.
+
+    Accepts what inet_aton does: one to four parts, each decimal, octal
+    (leading 0) or hex (0x), with the last part filling the remaining bytes,
+    so 3279880203 and 0xc3.0177.11 are both 195.127.0.11.
+    """
+    parts = host.split('.')
+    if len(parts) > 4 or not all(_IP_PART.fullmatch(part) for part in parts):
+        return None
+    values = []
+    for part in parts:
+        if part[:2] in ('0x', '0X'):
+            values.append(int(part[2:] or '0', 16))
+        elif part.startswith('0'):
+            values.append(int(part, 8))
+        else:
+            values.append(int(part))
+    *leading, last = values
+    if any(v > 255 for v in leading) or last >= 256 ** (5 - len(values)):
+        return None
+    number = last
+    for i, value in enumerate(leading):
+        number += value << (8 * (3 - i))
+    return '.'.join(str(number >> shift & 0xff) for shift in (24, 16, 8, 0))
+
+
+def _canonical_host(host):
+    host = host.rpartition('@')[2]
+    if not host.endswith(']'):
+        name, colon, port = host.rpartition(':')
+        if colon and (port.isdigit() or not port):
+            host = name
+    host = _DOTS.sub('.', host.strip('.'))
+    if not host.isascii():
+        try:
+            host = host.encode('latin-1').decode('utf-8').encode('idna').decode('ascii')
+        except UnicodeError:
+            pass  # Not a valid IDN; the bytes are escaped as they are
+    host = host.translate(_ASCII_LOWER)
+    return _normalize_ip(host) or host
+
+
+def _canonical_path(path):
+    segments = []
+    for segment in path.split('/'):
+        if segment == '..':
+            if segments:
+                segments.pop()
+        elif segment not in ('', '.'):
+            segments.append(segment)
+    canonical = '/' + '/'.join(segments)
+    if segments and (path.endswith('/') or path.rsplit('/', 1)[-1] in ('.', '..')):
+        canonical += '/'
+    return canonical
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def canonicalize(url):
+    """
+    Returns the Web Risk canonical form of a URL.
+
+    Args:
+        url (str or bytes): The URL as typed or found, with or without a scheme.
+                            bytes are taken as-is; str is encoded as UTF-8.
+
+    Returns:
+        str: The canonical URL, e.g. "http://www.google.com/" for "www.GOOgle.com".
+    """
+    # Work on one character per byte from here on
+    url = url.decode('latin-1') if isinstance(url, bytes) else url.encode('utf-8').decode('latin-1')
+    url = url.strip(_WHITESPACE).translate(_REMOVED).split('#', 1)[0]
+    url = _unescape(url)
+
+    match = _SCHEME.match(url)
+    if match:
+        scheme, rest = match.group(1).translate(_ASCII_LOWER), url[match.end():]
+    else:
+        scheme, rest = 'http', url
+    rest, has_query, query = rest.partition('?')
+    host, slash, path = rest.partition('/')
+
+    canonical = f"{scheme}://{_canonical_host(host).translate(_ESCAPED)}" \
+                f"{_canonical_path(slash + path).translate(_ESCAPED)}"
+    if has_query:
+        canonical += '?' + query.translate(_ESCAPED)
+    return canonical
+
+
+def lookup_key(url):
+    """
+    Returns the canonical URL without its scheme.
+
+    Web Risk matches expressions that have no scheme, so this is the finest
+    key a verdict can differ on: http and https forms of a URL share it.
+    """
+    return canonicalize(url).partition('://')[2]
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def lookup_expressions(url):
+    """
+    Returns the host-suffix/path-prefix expressions Web Risk matches a URL against.
+
+    These are the exact host plus up to four suffixes of its last five
+    labels (none for an IP address), each combined with the exact path and
+    query, the exact path, and up to four path prefixes starting at "/".
+    """
+    host, _, path_and_query = lookup_key(url).partition('/')
+    path, has_query, query = ('/' + path_and_query).partition('?')
+
+    hosts = [host]
+    if _normalize_ip(host) is None:
+        labels = host.split('.')
+        for start in range(max(1, len(labels) - MAX_HOST_SUFFIXES), len(labels) - 1):
+            hosts.append('.'.join(labels[start:]))
+
+    paths = [f'{path}?{query}'] if has_query else []
+    paths.append(path)
+    prefix = '/'
+    paths.append(prefix)
+    for segment in path.split('/')[1:-1][:MAX_PATH_PREFIXES - 1]:
+        prefix = f'{prefix}{segment}/'
+        paths.append(prefix)
+
+    return tuple(dict.fromkeys(h + p for h in hosts for p in paths))
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def lookup_hashes(url):
+    """Returns the SHA-256 digests of a URL's lookup expressions."""
+    return tuple(hashlib.sha256(e.encode('latin-1')).digest() for e in lookup_expressions(url))
+
+
+def canonicalize_many(urls):
+    """Returns {url: canonical URL} for many URLs, canonicalizing each distinct URL once."""
+    return {url: canonicalize(url) for url in dict.fromkeys(urls)}
+
+
+def lookup_hashes_many(urls):
+    """
+    Returns {url: lookup hashes} for many URLs.
+
+    Each distinct expression is hashed once across the whole batch, which
+    matters when many URLs share a host and therefore most of their
+    host-suffix expressions.
+    """
+    digests = {}
+    results = {}
+    for url in dict.fromkeys(urls):
+        hashes = []
+        for expression in lookup_expressions(url):
+            digest = digests.get(expression)
+            if digest is None:
+                digest = digests[expression] = hashlib.sha256(expression.encode('latin-1')).digest()
+            hashes.append(digest)
+        results[url] = tuple(hashes)
+    return results
@@ -1,9 +1,16 @@
+from datetime import datetime, timezone
+
+
 def format_url(url):
     """
     Ensures URLs are properly formatted for the Web Risk API.
     
     The function handles common user input patterns and converts them
     to properly formatted URLs that the API can process.
+
+    Only the display form is tidied here; use urlcanon.lookup_key when
+    comparing URLs, since different spellings of the same URL format
+    differently.
     """
     url = url.strip()
     
@@ -36,4 +43,18 @@ def validate_submission_evidence(evidence, submission_type):
     if found_keywords < 2:
         return False, f"Evidence should describe how this violates {submission_type} policies"
         
-    return True, "Evidence is sufficient"
\ No newline at end of file
+    return True, "Evidence is sufficient"
+
+def parse_timestamp(value):
+    """
+    Converts an RFC 3339 timestamp returned by the Web Risk API to epoch seconds.
+
+    Python's datetime.fromisoformat does not accept the trailing 'Z' or the
+    nanosecond precision the API uses, so the fraction is handled separately.
+    """
+    value = value.rstrip('Z')
+    base, _, fraction = value.partition('.')
+    seconds = datetime.strptime(base, '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc).timestamp()
+    if fraction:
+        seconds += float(f'0.{fraction}')
+    return seconds
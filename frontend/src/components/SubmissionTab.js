@@ -1,5 +1,6 @@
-import React, { useState } from 'react';
+import React, { useEffect, useState } from 'react';
 import { Shield, AlertTriangle, Clock, CheckCircle } from 'lucide-react';
+import { watchSubmissions } from './watchSubmissions';
 
 // This component provides guidelines to users about what URLs are appropriate to submit
 const SubmissionGuidelines = () => (
@@ -153,6 +154,12 @@ const SubmissionHistory = ({ submissions, onRefreshStatus }) => {
           text: 'Not added to blocklist',
           className: 'bg-gray-100 text-gray-700'
         };
+      case 'FAILED':
+        return {
+          icon: <AlertTriangle className="h-5 w-5 text-red-500" />,
+          text: 'Submission failed',
+          className: 'bg-red-100 text-red-700'
+        };
       default:
         return {
           icon: <Clock className="h-5 w-5 text-blue-500" />,
@@ -217,6 +224,24 @@ const SubmissionTab = () => {
     setSubmissions([submission, ...submissions]);
   };
 
+  // Receive status changes of pending submissions as the backend sees them
+  const pendingOperationIds = submissions
+    .filter(submission => submission.status === 'PENDING')
+    .map(submission => submission.operation.split('/').pop())
+    .join(',');
+
+  useEffect(() => {
+    if (!pendingOperationIds) return undefined;
+
+    return watchSubmissions(pendingOperationIds.split(','), (id, data) => {
+      setSubmissions(current => current.map(submission =>
+        submission.operation.split('/').pop() === id
+          ? { ...submission, status: data.status }
+          : submission
+      ));
+    });
+  }, [pendingOperationIds]);
+
   // Refresh the status of all pending submissions
   const refreshSubmissionStatus = async () => {
     const updatedSubmissions = await Promise.all(
@@ -1,5 +1,6 @@
-import React, { useState } from 'react';
+import React, { useEffect, useState } from 'react';
 import { Shield, AlertTriangle, CheckCircle, Clock, RefreshCw } from 'lucide-react';
+import { watchSubmissions } from './watchSubmissions';
 
 const STORAGE_KEY = 'webRiskSubmissions';
 const backendBaseUrl = 'https://backend-dot-tamw-webrisk-demo.uc.r.appspot.com'; // e.g. https://backend-dot-tamw-webrisk-demo.uc.r.appspot.com
@@ -63,6 +64,34 @@ const WebRiskDemo = () => {
     UNWANTED_SOFTWARE: 'The URI contains unwanted software'
   };
 
+  // Follow every pending submission with long-polls; the backend polls Web
+  // Risk on a shared schedule and answers as soon as a status changes.
+  const pendingOperationIds = submissions
+    .filter(sub => sub.status === 'PENDING' && sub.operation)
+    .map(sub => sub.operation.split('/').pop())
+    .join(',');
+
+  useEffect(() => {
+    if (!pendingOperationIds) return undefined;
+
+    return watchSubmissions(pendingOperationIds.split(','), (id, data) => {
+      setSubmissions(current => {
+        const updatedSubmissions = current.map(sub =>
+          sub.operation && sub.operation.split('/').pop() === id
+            ? {
+                ...sub,
+                status: data.status,
+                lastUpdated: new Date().toISOString(),
+                details: data.details
+              }
+            : sub
+        );
+        saveSubmissionsToStorage(updatedSubmissions);
+        return updatedSubmissions;
+      });
+    });
+  }, [pendingOperationIds]);
+
   const clearSubmissionHistory = () => {
     if (window.confirm('Are you sure you want to clear all submission history?')) {
       setSubmissions([]);
@@ -260,6 +289,12 @@ const WebRiskDemo = () => {
           text: 'Not added',
           className: 'bg-gray-100 text-gray-700'
         };
+      case 'FAILED':
+        return {
+          icon: <AlertTriangle className="h-5 w-5 text-red-500" />,
+          text: 'Submission failed',
+          className: 'bg-red-100 text-red-700'
+        };
       default:
         return {
           icon: <Clock className="h-5 w-5 text-blue-500" />,
@@ -0,0 +1,48 @@
+// Follows pending submissions by long-polling /api/submission/<id>?wait=&version=.
+// Each request returns as soon as the backend's shared poller sees the status
+// change, or unchanged once the wait is over. Unlike a Server-Sent Events
+// stream this works through proxies and runtimes that buffer responses (App
+// Engine standard), and nothing stays open once every submission is done.
+const LONG_POLL_WAIT_SECONDS = 50;
+// Pause before asking again when a request came back without news (the
+// backend was too busy to wait, or had no status yet) or failed outright
+const RETRY_DELAY_MS = 5000;
+const RETRYABLE_STATUSES = [503, 504];
+
+const sleep = (ms) => new Promise(resolve => setTimeout(resolve, ms));
+
+// Calls onStatus(id, data) with each new status of every operation id until
+// it is done. Returns a function that stops watching.
+export const watchSubmissions = (operationIds, onStatus) => {
+  const controller = new AbortController();
+
+  const watch = async (id) => {
+    let version = 0;
+    while (!controller.signal.aborted) {
+      try {
+        const response = await fetch(
+          `/api/submission/${encodeURIComponent(id)}?wait=${LONG_POLL_WAIT_SECONDS}&version=${version}`,
+          { signal: controller.signal }
+        );
+        const data = await response.json();
+        if (response.ok && data.version > version) {
+          version = data.version;
+          onStatus(id, data);
+          if (data.details?.done) return;
+          continue;
+        }
+        if (!response.ok && !RETRYABLE_STATUSES.includes(response.status)) {
+          console.error(`Stopped watching submission ${id}:`, data.error);
+          return;
+        }
+      } catch (error) {
+        if (controller.signal.aborted) return;
+        console.error('Error updating status:', error);
+      }
+      await sleep(RETRY_DELAY_MS);
+    }
+  };
+
+  operationIds.forEach(watch);
+  return () => controller.abort();
+};